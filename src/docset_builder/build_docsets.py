@@ -1,43 +1,166 @@
-"""This module contains the implementation for building docsets from the built documentation"""
-import subprocess
+"""This module contains the implementation for building docsets from the built documentation
+
+The docset is built in-process, with doc2dash as a library. The search index entries are written
+to the docSet.dsidx database in batched transactions and the HTML files are patched with the
+table of contents anchors, the most expensive part for large docs, in a pool of processes. The
+icons are prepared (downscaled and cached) by the icons module.
+
+"""
+import multiprocessing
+import shutil
+import sqlite3
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
 from pathlib import Path
+from typing import Iterable, Optional
 
 import structlog
 from click import ClickException
+from doc2dash import docsets, parsers  # type: ignore[import]
+from doc2dash.parsers.types import EntryType, Parser, ParserEntry  # type: ignore[import]
 
 from docset_builder.data_structures import DocBuildInfo
+from docset_builder.icons import prepare_icons
 
 LOG = structlog.get_logger(mod="build_ds")
 
+# The number of search index entries written per transaction
+INDEX_BATCH_SIZE = 10_000
+# Below this number of HTML files to patch, starting a process pool is not worth it
+MIN_FILES_FOR_PROCESS_POOL = 20
+
 
 def build_docset(built_docs_dir: Path, docbuild_info: DocBuildInfo, docset_build_dir: Path) -> Path:
-    """Build docset into `docset_build_dir` from docs in `build_docs_dir`"""
+    """Build docset into `docset_build_dir` from docs in `build_docs_dir`
+
+    The HTML files are patched by up to `docbuild_info.build_jobs` processes. Returns the path of
+    the built docset.
+
+    Raises:
+        ClickException: If doc2dash does not recognize the documentation format or the start page
+            does not exist
+
+    """
     LOG.info(
         "Build docset",
         built_docs_dir=built_docs_dir,
         docbuild_info=docbuild_info,
         docset_build_dir=docset_build_dir,
     )
-    # doc2dash --index-page index.html
-    #   ~/.local/share/docset-builder/repositories/arrow/docs/_build/html/
-    run_args: tuple[str, ...] = ("doc2dash",)
+    parser_type, name = parsers.get_doctype(built_docs_dir)
+    if parser_type is None:
+        raise ClickException(f"doc2dash does not know the documentation format in {built_docs_dir}")
 
+    index_page = None
     if docbuild_info.start_page:
-        run_args += ("--index-page", docbuild_info.start_page)
+        index_page = Path(docbuild_info.start_page)
+        if not (built_docs_dir / index_page).exists():
+            raise ClickException(f"The start page {index_page} does not exist in {built_docs_dir}")
     else:
         LOG.debug("Built without start page")
 
-    # TODO Downsize icon:
-    if docbuild_info.icon_path:
-        run_args += ("--icon", str(docbuild_info.icon_path))
-    else:
-        LOG.debug("Built without icon")
+    icon_dir = _prepare_icons(docbuild_info.icon_path)
 
-    run_args += (str(built_docs_dir),)
-    subprocess.run(run_args, cwd=docset_build_dir)
-    for directory in docset_build_dir.iterdir():
-        return directory
-    raise ClickException(
-        "There does not appear to have been built anything in the temporary build dir: "
-        f"{docset_build_dir}"
+    # The same name as the doc2dash command line tool gives the docset
+    docset_path: Path = (docset_build_dir / name).with_suffix(".docset")
+    docset = docsets.prepare_docset(
+        source=built_docs_dir,
+        dest=docset_path,
+        name=name,
+        index_page=index_page,
+        enable_js=False,
+        online_redirect_url=None,
+        icon=icon_dir / "icon.png" if icon_dir else None,
     )
+    if icon_dir and (icon_dir / "icon@2x.png").exists():
+        shutil.copy2(icon_dir / "icon@2x.png", docset_path / "icon@2x.png")
+
+    parser = parser_type(docset.docs)
+    entries = list(parser.parse())
+    try:
+        _write_search_index(docset.db_conn, entries)
+    finally:
+        docset.db_conn.close()
+
+    failed = _patch_anchors(parser, docset.docs, entries, workers=_workers(docbuild_info))
+    LOG.info("Docset built", docset_path=docset_path, entries=len(entries), failed_anchors=failed)
+    return docset_path
+
+
+def _prepare_icons(icon_path: Optional[Path]) -> Optional[Path]:
+    """Return the directory with the docset icons prepared from `icon_path`, if possible"""
+    if not icon_path:
+        LOG.debug("Built without icon")
+        return None
+    return prepare_icons(icon_path)
+
+
+def _workers(docbuild_info: DocBuildInfo) -> int:
+    """Return the number of processes to patch the HTML files with"""
+    build_jobs = docbuild_info.build_jobs
+    return int(build_jobs) if build_jobs and build_jobs.isdigit() else 1
+
+
+def _write_search_index(connection: sqlite3.Connection, entries: Iterable[ParserEntry]) -> None:
+    """Write the search index `entries` to the docSet.dsidx `connection` in batches"""
+    # The database is a new file in a temporary directory, so there is nothing to protect
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA journal_mode = MEMORY")
+    rows = (entry.as_tuple() for entry in entries)
+    while batch := list(islice(rows, INDEX_BATCH_SIZE)):
+        with connection:
+            connection.executemany("INSERT INTO searchIndex VALUES (NULL, ?, ?, ?)", batch)
+
+
+def _patch_anchors(
+    parser: Parser, docs_dir: Path, entries: Iterable[ParserEntry], workers: int
+) -> int:
+    """Patch the HTML files in `docs_dir` with table of contents anchors for `entries`
+
+    Each file is parsed and patched on its own, in a pool of `workers` processes, if there are
+    enough of them. Returns the number of entries whose anchor could not be found.
+
+    """
+    entries_by_file: dict[str, list[tuple[str, EntryType, str]]] = defaultdict(list)
+    for entry in entries:
+        path_parts = entry.path.split("#")
+        # Entries without anchors, e.g. classes in pydoctor, have nothing to patch
+        if len(path_parts) == 2:
+            file_name, anchor = path_parts
+            entries_by_file[urllib.parse.unquote(file_name)].append(
+                (entry.name, entry.type, anchor)
+            )
+
+    paths = [docs_dir / file_name for file_name in entries_by_file]
+    if workers <= 1 or len(paths) < MIN_FILES_FOR_PROCESS_POOL:
+        failed = sum(map(_patch_file, repeat(parser), paths, entries_by_file.values()))
+    else:
+        # The pipelines run in threads, which rules out forking
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            chunk_size = max(1, len(paths) // (workers * 4))
+            failed = sum(
+                executor.map(
+                    _patch_file,
+                    repeat(parser),
+                    paths,
+                    entries_by_file.values(),
+                    chunksize=chunk_size,
+                )
+            )
+
+    if failed:
+        LOG.warning("Failed to add anchors for some table of contents entries", failed=failed)
+    return failed
+
+
+def _patch_file(parser: Parser, path: Path, entries: list[tuple[str, EntryType, str]]) -> int:
+    """Patch the file at `path` with anchors for `entries` and return the number that failed"""
+    failed = 0
+    with parser.make_patcher_for_file(path) as patch:
+        for name, entry_type, anchor in entries:
+            if not patch(name, entry_type, anchor, f"//apple_ref/cpp/{entry_type.value}/{name}"):
+                failed += 1
+    return failed
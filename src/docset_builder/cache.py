@@ -1,30 +1,35 @@
 """Cache implementation"""
-import json
+import time
 from typing import Optional
 
 import structlog
-from attrs import asdict
 
-from .data_structures import PyPIInfo
-from .directories import PYPI_CACHE_DIR
+from . import metadata_store
+from .data_structures import PyPICacheEntry, PyPIInfo
 
 LOG = structlog.get_logger(mod="cache")
 
 
-def load_pypi_info(package_name: str) -> Optional[PyPIInfo]:
-    """Return PyPi information"""
-    cache_path = PYPI_CACHE_DIR / f"{package_name}.json"
-    if cache_path.is_file():
-        LOG.msg("pypi cache hit", package_name=package_name)
-        with open(cache_path) as file_:
-            return PyPIInfo(**json.load(file_))
-    LOG.msg("pypi cache miss", package_name=package_name)
-    return None
+def load_pypi_cache_entry(package_name: str, api: str) -> Optional[PyPICacheEntry]:
+    """Return the cached PyPI information, with its validators, for `package_name` and `api`"""
+    cache_entry = metadata_store.load_pypi_cache_entry(package_name, api)
+    if cache_entry is None:
+        LOG.msg("pypi cache miss", package_name=package_name, api=api)
+    else:
+        LOG.msg("pypi cache hit", package_name=package_name, api=api)
+    return cache_entry
 
 
-def cache_pypi_info(package_name: str, pypi_info: PyPIInfo) -> None:
-    """Cache the `pypi_info` for `package_name`"""
-    cache_path = PYPI_CACHE_DIR / f"{package_name}.json"
-    with open(cache_path, "w") as file_:
-        json.dump(asdict(pypi_info), file_)
-    LOG.msg("Cached pypi info", package_name=package_name, pypi_info=pypi_info)
+def cache_pypi_info(
+    package_name: str,
+    pypi_info: PyPIInfo,
+    api: str,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+) -> None:
+    """Cache the `pypi_info` for `package_name` along with its validators, fetched now from `api`"""
+    cache_entry = PyPICacheEntry(
+        pypi_info=pypi_info, etag=etag, last_modified=last_modified, fetched_at=time.time()
+    )
+    metadata_store.store_pypi_cache_entry(package_name, api, cache_entry)
+    LOG.msg("Cached pypi info", package_name=package_name, api=api, pypi_info=pypi_info, etag=etag)
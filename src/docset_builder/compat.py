@@ -6,5 +6,22 @@ try:
 except ImportError:
     from typing_extensions import TypeAlias
 
+# ijson is an optional dependency, which enables streaming parsing of the PyPI JSON documents
+try:
+    import ijson  # type: ignore[import]
+except ImportError:
+    ijson = None
+
+# Pillow is an optional dependency, which enables downscaling the docset icons
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+# cairosvg is an optional dependency, which enables making docset icons from SVG images
+try:
+    import cairosvg  # type: ignore[import]
+except ImportError:
+    cairosvg = None
 
-__all__ = ["TypeAlias"]
+__all__ = ["TypeAlias", "ijson", "PILImage", "cairosvg"]
@@ -2,10 +2,22 @@
 from pathlib import Path
 from typing import Any
 
+# The installer backends for doc build virtual environments
+INSTALLER_NAMES = ("auto", "pip", "uv")
+
 
 def __getattr__(name: str) -> Any:
     """Return configuration item `name`"""
     if name == "install_base_dir":
         return Path("~/").expanduser() / ".local" / "share" / "Zeal" / "Zeal" / "docsets"
+    elif name == "pypi_cache_ttl":
+        # Seconds to serve PyPI information from the cache before revalidating it
+        return 24 * 60 * 60
+    elif name == "installer":
+        # The installer backend for doc build virtual environments: "auto", "pip" or "uv"
+        return "auto"
+    elif name == "use_base_environments":
+        # Install doc toolchains into shared base environments layered into the virtual envs
+        return True
     else:
         raise ValueError(f"Config key '{name} is not known")
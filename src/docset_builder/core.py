@@ -13,23 +13,45 @@ covers only searching tox.ini, but other configs will be added
   * Build the docs
   * Search for the build docs and return the location of the build docs
 * Build the docset from the build docs
-* Install (copy) the docset
+* Install (link) the docset
 
 """
 
-import tempfile
+from functools import partial
 from pathlib import Path
-from typing import Optional, Sequence
+from typing import Mapping, Optional, Sequence
 
 import structlog
+from click import ClickException
 
+from . import instrumentation, metadata_store
 from .build_docsets import build_docset
-from .docset_library import install_docset
+from .data_structures import PyPIInfo
+from .docset_archive import ArchiveOptions, write_docset_archive
+from .docset_library import (
+    deduplicate_installed_docsets,
+    install_docset,
+    new_docset_version_dir,
+    print_deduplication_report,
+    wait_for_garbage_collection,
+)
+from .incremental import is_up_to_date, make_build_fingerprint
+from .instrumentation import measure
 from .post_build_search import _search_for_built_docs
-from .pypi import get_information_for_package
-from .repositories import clone_or_update
+from .pypi import get_information_for_package, get_information_for_packages
+from .repositories import clone_or_update, current_commit_hash, current_tree_hash
+from .repository_index import build_repository_index
 from .repository_search import get_docbuild_information
-from .virtual_environments import build_docs
+from .scheduler import (
+    StageLimits,
+    make_stage_limits,
+    print_summary,
+    resolve_build_jobs,
+    resolve_stage_limits,
+    run_pipelines,
+    stage,
+)
+from .virtual_environments import InstallerBackend, build_docs, get_installer_backend
 
 LOG = structlog.get_logger(mod="core")
 
@@ -39,46 +61,199 @@ def install(
     build_only: bool = False,
     test_file_dump_path: Optional[Path] = None,
     use_cache: bool = True,
+    pypi_cache_ttl: Optional[float] = None,
+    jobs: int = 1,
+    stage_limit_overrides: Optional[Mapping[str, int]] = None,
+    force: bool = False,
+    installer: Optional[str] = None,
+    build_jobs: Optional[str] = None,
+    metrics_out: Optional[Path] = None,
+    archive_options: Optional[ArchiveOptions] = None,
+    deduplicate: bool = False,
 ) -> None:
-    """Install docsets for `packages`"""
-    for package_name in package_names:
-        logger = LOG.bind(package=package_name)
-        logger.info("Installing", build_only=build_only, test_file_dump_path=test_file_dump_path)
+    """Install docsets for `packages`
 
-        pypi_info = get_information_for_package(package_name, use_cache=use_cache)
-        pypi_info.ensure_pypi_info_is_sufficient()
-        logger.info("Got PyPI info", pypi_info=pypi_info)
+    The packages are processed by independent pipelines run by `jobs` workers. A failure for one
+    package does not stop the others; instead a summary is printed at the end and a
+    ClickException is raised if any of them failed.
 
+    Packages whose installed docset was built from exactly what would be built now are skipped,
+    unless `force` is set.
+
+    The doc build virtual environments are set up with the `installer` backend ("auto", "pip" or
+    "uv"), which defaults to the configured one.
+
+    Doc builds that support it are run with `build_jobs` parallel jobs. By default ("auto"), the
+    CPUs are divided between the builds that may run at the same time.
+
+    The time spent in each stage and the cache hits and misses are printed at the end and, if
+    `metrics_out` is given, written to it as a JSON report.
+
+    If `archive_options` are given, each built docset is also written as a compressed archive for
+    distribution, possibly with a feed.
+
+    If `deduplicate` is set, the identical static assets of all installed docsets are hard linked
+    to a shared content store afterwards.
+
+    """
+    instrumentation.reset()
+    installer_backend = get_installer_backend(installer)
+    stage_limits = make_stage_limits(jobs, stage_limit_overrides)
+    concurrent_builds = min(
+        resolve_stage_limits(jobs, stage_limit_overrides)["build"], max(1, len(package_names))
+    )
+    build_jobs = resolve_build_jobs(build_jobs, concurrent_builds)
+    LOG.debug("Resolved build jobs", build_jobs=build_jobs, concurrent_builds=concurrent_builds)
+
+    # The PyPI information for all packages is fetched up front in one concurrent batch
+    pypi_errors: dict[str, str] = {}
+    with measure(None, "pypi"):
+        pypi_infos = get_information_for_packages(
+            package_names,
+            use_cache=use_cache,
+            cache_ttl=pypi_cache_ttl,
+            max_concurrency=resolve_stage_limits(jobs, stage_limit_overrides)["pypi"],
+            errors=pypi_errors,
+        )
+
+    pipeline = partial(
+        _install_package,
+        pypi_infos=pypi_infos,
+        pypi_errors=pypi_errors,
+        build_only=build_only,
+        test_file_dump_path=test_file_dump_path,
+        use_cache=use_cache,
+        pypi_cache_ttl=pypi_cache_ttl,
+        force=force,
+        installer=installer_backend,
+        build_jobs=build_jobs,
+        archive_options=archive_options,
+    )
+    results = run_pipelines(package_names, pipeline, jobs=jobs, stage_limits=stage_limits)
+    wait_for_garbage_collection()
+    if deduplicate and not build_only:
+        print_deduplication_report(deduplicate_installed_docsets())
+    print_summary(results)
+    instrumentation.print_metrics_summary()
+    if metrics_out:
+        instrumentation.write_report(metrics_out, results, jobs)
+
+    if failed := [result.package_name for result in results if not result.succeeded]:
+        raise ClickException(
+            f"Failed to install docsets for {len(failed)} of {len(results)} packages: {failed}"
+        )
+
+
+def _install_package(
+    package_name: str,
+    stage_limits: StageLimits,
+    pypi_infos: Mapping[str, PyPIInfo],
+    pypi_errors: Optional[Mapping[str, str]] = None,
+    build_only: bool = False,
+    test_file_dump_path: Optional[Path] = None,
+    use_cache: bool = True,
+    pypi_cache_ttl: Optional[float] = None,
+    force: bool = False,
+    installer: Optional[InstallerBackend] = None,
+    build_jobs: Optional[str] = None,
+    archive_options: Optional[ArchiveOptions] = None,
+) -> Optional[str]:
+    """Run the full install pipeline for `package_name`
+
+    Returns a note if the pipeline was cut short, e.g. because the docset was up to date.
+
+    """
+    logger = LOG.bind(package=package_name)
+    logger.info("Installing", build_only=build_only, test_file_dump_path=test_file_dump_path)
+
+    if pypi_errors and package_name in pypi_errors:
+        # The batch already retried with backoff, so do not go through that again
+        raise ClickException(pypi_errors[package_name])
+    if not (pypi_info := pypi_infos.get(package_name)):
+        # Not in the batch, so fetch it on its own
+        with stage(stage_limits, "pypi"), measure(package_name, "pypi"):
+            pypi_info = get_information_for_package(
+                package_name, use_cache=use_cache, cache_ttl=pypi_cache_ttl
+            )
+    pypi_info.ensure_pypi_info_is_sufficient()
+    logger.info("Got PyPI info", pypi_info=pypi_info)
+
+    with stage(stage_limits, "repository"), measure(package_name, "repository"):
         local_repository_path, checked_out_tag = clone_or_update(package_name, pypi_info=pypi_info)
-        logger.info("Cloned and/or updated repo", dir=local_repository_path)
+    logger.info("Cloned and/or updated repo", dir=local_repository_path)
 
+    with stage(stage_limits, "search"), measure(package_name, "search"):
+        # One index of the checkout is shared by the searches before and after the build
+        repository_index = build_repository_index(local_repository_path)
         docbuild_information = get_docbuild_information(
-            package_name, repository_path=local_repository_path
+            package_name,
+            repository_path=local_repository_path,
+            repository_index=repository_index,
+            tree_hash=current_tree_hash(local_repository_path),
+            use_cache=use_cache,
         )
-        logger.info("Got docbuild information", docbuild_information=docbuild_information)
-        docbuild_information.ensure_info_is_sufficient()
-        return
+    # Set after loading the (possibly cached) docbuild information, as it depends on this run
+    with docbuild_information.set_source("Command line"):
+        docbuild_information.build_jobs = build_jobs
+    logger.info("Got docbuild information", docbuild_information=docbuild_information)
+    docbuild_information.ensure_info_is_sufficient()
 
-        build_docs(
+    fingerprint = make_build_fingerprint(
+        checked_out_tag,
+        commit_hash=current_commit_hash(local_repository_path),
+        docbuild_info=docbuild_information,
+    )
+    up_to_date = not (force or build_only) and is_up_to_date(package_name, fingerprint)
+    instrumentation.count_hit("installed_docset", hit=up_to_date)
+    if up_to_date:
+        logger.info("Installed docset is up to date, skip", version=checked_out_tag)
+        return f"{checked_out_tag} already installed"
+
+    with stage(stage_limits, "build"):
+        build_output_dir = build_docs(
             package_name=package_name,
             local_repository=local_repository_path,
             docbuild_information=docbuild_information,
+            installer=installer,
         )
-        logger.info("Docs built")
-        built_docs_dir = _search_for_built_docs(
-            docbuild_information=docbuild_information, local_repository=local_repository_path
-        )
+    metadata_store.record_build(package_name, docbuild_information)
+    logger.info("Docs built")
+
+    with stage(stage_limits, "docset"), new_docset_version_dir(
+        package_name, version=checked_out_tag, keep=not build_only
+    ) as docset_version_dir:
+        with measure(package_name, "post_build_search"):
+            built_docs_dir = _search_for_built_docs(
+                docbuild_information=docbuild_information,
+                local_repository=local_repository_path,
+                repository_index=repository_index,
+                build_output_dir=build_output_dir,
+            )
         logger.info("Docs located", path=built_docs_dir)
 
-        with tempfile.TemporaryDirectory() as tmp_dir_name:
-            tmp_dir = Path(tmp_dir_name)
+        with measure(package_name, "doc2dash"):
             docset_build_dir = build_docset(
                 built_docs_dir=built_docs_dir,
                 docbuild_info=docbuild_information,
-                docset_build_dir=tmp_dir,
+                docset_build_dir=docset_version_dir,
             )
-            logger.info("Docset built", docset_build_dir=docset_build_dir)
+        logger.info("Docset built", docset_build_dir=docset_build_dir)
+
+        if archive_options:
+            with measure(package_name, "archive"):
+                archive_path = write_docset_archive(
+                    docset_build_dir, version=checked_out_tag, options=archive_options
+                )
+            logger.info("Docset archive written", archive_path=archive_path)
+
+        if not build_only:
+            with stage(stage_limits, "install"), measure(package_name, "install"):
+                install_docset(
+                    docset_build_dir,
+                    package_name=package_name,
+                    version=checked_out_tag,
+                    fingerprint=fingerprint,
+                )
+            logger.info("Docset installed")
 
-            if not build_only:
-                install_docset(docset_build_dir)
-                logger.info("Docset installed")
+    return None
@@ -1,6 +1,7 @@
 """This module implements shared data structures"""
+import hashlib
 from contextlib import contextmanager
-from json import dump
+from json import dump, dumps
 from pathlib import Path
 from typing import Mapping, Optional, Tuple, TypeVar, cast, Iterator, Any
 
@@ -15,6 +16,26 @@ from docset_builder.directories import REPOSITORIES_DIR
 # FIXME figure out if I can use annotated types to set required fields
 
 
+@define
+class PackageResult:
+    """The outcome of running the install pipeline for a single package
+
+    Attributes:
+        package_name (str): The name of the package
+        succeeded (bool): Whether the whole pipeline completed for the package
+        duration (float): The wall clock duration of the pipeline in seconds
+        error (str): The error message, if the pipeline failed
+        note (str): A note from a successful pipeline, e.g. that it was skipped
+
+    """
+
+    package_name: str
+    succeeded: bool
+    duration: float
+    error: Optional[str] = None
+    note: Optional[str] = None
+
+
 @define
 class PyPIInfo:
     """PyPI information about package"""
@@ -53,22 +74,140 @@ class PyPIInfo:
             raise ClickException(error_message)
 
 
+@define
+class PyPICacheEntry:
+    """A cached piece of PyPI information along with what is needed to revalidate it
+
+    Attributes:
+        pypi_info (PyPIInfo): The cached PyPI information
+        etag (str): The ETag header of the response the information was extracted from
+        last_modified (str): The Last-Modified header of the response the information was
+            extracted from
+        fetched_at (float): The time (seconds since the epoch) the information was last fetched
+            or revalidated
+
+    """
+
+    pypi_info: PyPIInfo
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    fetched_at: float = 0.0
+
+    def is_fresh(self, ttl: float, now: float) -> bool:
+        """Return whether this entry is younger than `ttl` seconds at the time `now`"""
+        return now - self.fetched_at < ttl
+
+    def conditional_request_headers(self) -> dict[str, str]:
+        """Return the headers for a conditional request for the cached information"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+@define(frozen=True)
+class BuildFingerprint:
+    """Everything that determines the contents of a built docset
+
+    Attributes:
+        package_version (str): The version (checked out tag) the docset is built from
+        commit_hash (str): The hash of the checked out commit
+        tool_versions (dict[str, str]): The versions of the tools used to build the docset
+        docbuild_info_hash (str): A hash of the resolved docbuild information
+
+    """
+
+    package_version: str
+    commit_hash: str
+    tool_versions: dict[str, str]
+    docbuild_info_hash: str
+
+    def digest(self) -> str:
+        """Return a digest of the whole fingerprint"""
+        data = dumps(asdict(self), sort_keys=True).encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+
+
+@define
+class InstalledDocset:
+    """Record of an installed docset
+
+    Attributes:
+        docset_name (str): The name of the docset directory, e.g. "arrow.docset"
+        package_name (str): The name of the package the docset was built for
+        version (str): The version (checked out tag) the docset was built from
+        installed_at (float): The time (seconds since the epoch) the docset was installed
+        commit_hash (str): The hash of the commit the docset was built from
+        tool_versions (str): The versions of the tools used to build the docset, as JSON
+        docbuild_info_hash (str): A hash of the docbuild information used to build the docset
+        fingerprint (str): The digest of the `BuildFingerprint` of the docset
+
+    """
+
+    docset_name: str
+    package_name: Optional[str]
+    version: Optional[str]
+    installed_at: float
+    commit_hash: Optional[str] = None
+    tool_versions: Optional[str] = None
+    docbuild_info_hash: Optional[str] = None
+    fingerprint: Optional[str] = None
+
+
+@define
+class CacheStatistics:
+    """Hits and misses of a cache, e.g. of the shared package cache
+
+    Attributes:
+        hits (int): The number of lookups that were served from the cache
+        misses (int): The number of lookups that were not, e.g. packages that had to be downloaded
+
+    """
+
+    hits: int = 0
+    misses: int = 0
+
+    def __add__(self, other: "CacheStatistics") -> "CacheStatistics":
+        """Return the sum of these and the `other` statistics"""
+        return CacheStatistics(hits=self.hits + other.hits, misses=self.misses + other.misses)
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        """The fraction of packages that were hits, or None if there were none at all"""
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+
 DocBuildInfoDict = TypedDict(
     "DocBuildInfoDict",
     {
-        "basedir_for_building_docs": str,
-        "deps": list[str],
-        "commands": list[str],
-        "icon_path": str,
-        "start_page": str,
+        "package_name": Optional[str],
+        "basedir_for_building_docs": Optional[str],
+        "doc_build_command_deps": Optional[list[str]],
+        "doc_build_commands": Optional[list[str]],
+        "all_deps": Optional[list[str]],
+        "use_icon": bool,
+        "icon_path": Optional[str],
+        "start_page": Optional[str],
+        "build_jobs": Optional[str],
+        "_sources": dict[str, str],
     },
+    total=False,
 )
 
+_DOC_BUILD_INFO_PATH_FIELDS = ("basedir_for_building_docs", "icon_path")
+# Fields that do not change the content of the built docs
+_DOC_BUILD_INFO_NON_CONTENT_FIELDS = ("build_jobs",)
+# Replaced by the number of parallel build jobs in doc build commands
+BUILD_JOBS_PLACEHOLDER = "{build_jobs}"
+
 ValueType = TypeVar("ValueType")
 
 
 def _on_setattr(
-    instance: "DocBuildInfo", attribute: Attribute[ValueType], value: ValueType
+    instance: "DocBuildInfo", attribute: "Attribute[ValueType]", value: ValueType
 ) -> ValueType:
     """Enforce set-once-sourced behavior
 
@@ -104,6 +243,7 @@ class DocBuildInfo:
         use_icon (bool): Indicate whether an icon should be used
         icon_path (Path): Path of the project icon
         start_page (str): The name of the start page within the docbuild folder
+        build_jobs (str): The number of parallel jobs for the doc build tool, e.g. "4"
 
     """
 
@@ -115,6 +255,7 @@ class DocBuildInfo:
     use_icon: bool = field(default=False, on_setattr=_on_setattr)
     icon_path: Optional[Path] = field(default=None, on_setattr=_on_setattr)
     start_page: Optional[str] = field(default=None, on_setattr=_on_setattr)
+    build_jobs: Optional[str] = field(default=None, on_setattr=_on_setattr)
 
     _sources: dict[str, str] = field(init=False, factory=dict, alias="_sources")
     _current_source: Optional[str] = field(init=False, default=None, alias="_current_source")
@@ -181,19 +322,53 @@ class DocBuildInfo:
         with open(dump_file_path, "w") as file_:
             dump(data, file_, indent=4)
 
+    def content_hash(self) -> str:
+        """Return a hash of the values of this object, not including their sources
+
+        Values that do not change the content of the built docs, like `build_jobs`, are left out.
+
+        """
+        data = {
+            k: v
+            for k, v in self.to_dict().items()
+            if not k.startswith("_") and k not in _DOC_BUILD_INFO_NON_CONTENT_FIELDS
+        }
+        return hashlib.sha256(dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def to_dict(self) -> DocBuildInfoDict:
+        """Return this object as a JSON serializable dict, including the sources of the values"""
+        data = asdict(self, filter=lambda attribute, _: attribute.name != "_current_source")
+        for path_field_name in _DOC_BUILD_INFO_PATH_FIELDS:
+            if data[path_field_name] is not None:
+                data[path_field_name] = str(data[path_field_name])
+        return cast(DocBuildInfoDict, data)
+
     @classmethod
     def from_dict(cls, data: DocBuildInfoDict) -> Self:
-        """Return DocBuildInfo from json `data`"""
-        raise NotImplementedError  # Update later
-        return cls(
-            basedir_for_building_docs=Path(data["basedir_for_building_docs"])
-            if data["basedir_for_building_docs"]
-            else None,
-            doc_build_command_deps=tuple(data["deps"]) if data["deps"] else None,
-            doc_build_commands=tuple(data["commands"]) if data["commands"] else None,
-            icon_path=Path(data["icon_path"]) if data["icon_path"] else None,
-            start_page=data["start_page"],
-        )
+        """Return DocBuildInfo from json `data`, as returned by `to_dict`
+
+        If `data` contains the sources of the values, they are restored as well.
+
+        Raises:
+            ValueError: If `data` contains keys that are not fields, e.g. from an older format
+
+        """
+        field_names = {field_.name for field_ in fields(cls)}
+        if unknown_keys := set(data) - field_names - {"_sources"}:
+            raise ValueError(f"Unknown DocBuildInfo keys: {sorted(unknown_keys)}")
+        docbuild_info = cls()
+        with docbuild_info.set_source("from_dict"):
+            for field_ in fields(cls):
+                if field_.name.startswith("_") or field_.name not in data:
+                    continue
+                value = data[field_.name]  # type: ignore[literal-required]
+                if field_.name in _DOC_BUILD_INFO_PATH_FIELDS and value is not None:
+                    value = Path(value)
+                setattr(docbuild_info, field_.name, value)
+
+        if "_sources" in data:
+            docbuild_info._sources = dict(data["_sources"])
+        return docbuild_info
 
     def ensure_info_is_sufficient(self) -> None:
         """Raise ClickException if this object has insufficient info to proceed"""
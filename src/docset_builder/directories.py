@@ -1,4 +1,8 @@
-"""This module contains commonly used modules"""
+"""This module contains commonly used modules
+
+The directories are not created on import, but where they are first written to, with `ensure_dir`.
+
+"""
 
 from pathlib import Path
 
@@ -12,25 +16,47 @@ LOG = structlog.get_logger(mod="cache")
 
 
 BASE_CACHE_DIR = Path(user_data_dir(APPLICATION_NAME, TEAM_NAME))
-BASE_CACHE_DIR.mkdir(exist_ok=True)
-PYPI_CACHE_DIR = BASE_CACHE_DIR / "pypi"
-PYPI_CACHE_DIR.mkdir(exist_ok=True)
+METADATA_STORE_PATH = BASE_CACHE_DIR / "metadata.sqlite"
 REPOSITORIES_DIR = BASE_CACHE_DIR / "repositories"
-REPOSITORIES_DIR.mkdir(exist_ok=True)
 VENV_DIR = BASE_CACHE_DIR / "venvs"
-VENV_DIR.mkdir(exist_ok=True)
+# Stable per-package build output, for incremental doc builds
+BUILD_OUTPUT_DIR = BASE_CACHE_DIR / "build_output"
+# Base environments with doc toolchains, that are layered into the package virtual environments
+BASE_VENV_DIR = BASE_CACHE_DIR / "base_venvs"
+# Versions of built docsets, that the installed docsets link to
+DOCSET_STORE_DIR = BASE_CACHE_DIR / "docsets"
+# Static assets shared by the docsets, by content hash, that identical files are hard linked to
+CONTENT_STORE_DIR = BASE_CACHE_DIR / "content_store"
+# Docset icons prepared from the project icons, by hash of the source image
+ICON_CACHE_DIR = BASE_CACHE_DIR / "icons"
+# Download and wheel caches of the installers, shared by all virtual environments
+PACKAGE_CACHE_DIR = BASE_CACHE_DIR / "package_cache"
+# Pre-built wheels, that all installs look in before the package index
+WHEELHOUSE_DIR = PACKAGE_CACHE_DIR / "wheelhouse"
 
 CONFIG_DIR = Path(user_config_dir(APPLICATION_NAME, TEAM_NAME))
-CONFIG_DIR.mkdir(exist_ok=True)
+# Replaced by the metadata store, only kept to import it into the store
 INSTALLED_DOCSETS_INDEX = CONFIG_DIR / "installed_docsets.json"
 
 
+def ensure_dir(path: Path) -> Path:
+    """Return `path`, after creating the directory (and its parents) if it does not exist"""
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
 def log_cache_dirs() -> None:
     """Log the cache dirs"""
     LOG.info(
         "cache dirs",
         base=BASE_CACHE_DIR,
-        pypi=PYPI_CACHE_DIR,
+        metadata_store=METADATA_STORE_PATH,
         repo=REPOSITORIES_DIR,
         venv=VENV_DIR,
+        base_venv=BASE_VENV_DIR,
+        build_output=BUILD_OUTPUT_DIR,
+        package_cache=PACKAGE_CACHE_DIR,
+        docset_store=DOCSET_STORE_DIR,
+        content_store=CONTENT_STORE_DIR,
+        icons=ICON_CACHE_DIR,
     )
@@ -0,0 +1,272 @@
+"""This module implements writing docsets as compressed archives, for distribution
+
+Dash and Zeal can install docsets from feeds, which point at a gzipped tarball of the docset. The
+tarball is streamed straight from a walk of the docset, through pigz for multi-threaded
+compression, if it is available, and otherwise through gzip.
+
+Optionally, an index of the members of the archive is written next to it. Like tarix, the index
+gives random access into the compressed archive: the compression is restarted at tar member
+boundaries every `INDEX_RESTART_INTERVAL` bytes, by starting a new gzip member, and the index
+holds the offset of the gzip member each tar member starts in. To read a tar member, seek to
+"gzip_member_offset" in the archive, decompress from there, skip to "offset" (counting from
+"gzip_member_start") and read the tar member. Gzip and tar readers read the archive as usual.
+
+"""
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import IO, Any, Iterator, Optional, cast
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+import structlog
+from attrs import define
+
+from .directories import ensure_dir
+
+LOG = structlog.get_logger(mod="archive")
+
+ARCHIVE_SUFFIX = ".tgz"
+INDEX_SUFFIX = ".index.json"
+FEED_SUFFIX = ".xml"
+# The number of uncompressed bytes after which the compression of an indexed archive is restarted
+# at the next tar member, which is a trade-off between compression ratio and how much has to be
+# decompressed to get to a member
+INDEX_RESTART_INTERVAL = 1024 * 1024
+FEED_TEMPLATE = """\
+<entry>
+    <version>{version}</version>
+    <url>{url}</url>
+</entry>
+"""
+
+
+@define
+class ArchiveOptions:
+    """Options for writing docset archives
+
+    Attributes:
+        archive_dir (Path): The directory to write the archives (and indexes and feeds) to
+        compression_level (int): The gzip compression level, from 1 (fastest) to 9 (smallest)
+        threads (int): The number of compression threads, more than 1 requires pigz unless an
+            index is written
+        write_index (bool): Whether to write an index of the members of the archive, for
+            random access into it
+        feed_base_url (str): The URL the archives are served from. If given, a feed is written for
+            each archive.
+
+    """
+
+    archive_dir: Path
+    compression_level: int = 6
+    threads: int = 1
+    write_index: bool = False
+    feed_base_url: Optional[str] = None
+
+
+def write_docset_archive(docset_path: Path, version: str, options: ArchiveOptions) -> Path:
+    """Write the docset at `docset_path` as an archive to `options.archive_dir`
+
+    The archive replaces any existing one atomically. Returns the path of the archive.
+
+    """
+    archive_path = ensure_dir(options.archive_dir) / f"{docset_path.stem}{ARCHIVE_SUFFIX}"
+    LOG.info("Write docset archive", docset_path=docset_path, archive_path=archive_path)
+
+    temporary_path = archive_path.with_name(f".{archive_path.name}.tmp")
+    try:
+        index = _write_archive(docset_path, temporary_path, options)
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+    os.replace(temporary_path, archive_path)
+
+    if options.write_index:
+        index_path = archive_path.with_name(archive_path.name + INDEX_SUFFIX)
+        with open(index_path, "w") as file_:
+            json.dump(index, file_)
+    if options.feed_base_url:
+        write_docset_feed(archive_path, version, options.feed_base_url)
+    LOG.info("Wrote docset archive", archive_path=archive_path, members=len(index))
+    return archive_path
+
+
+def _write_archive(
+    docset_path: Path, archive_path: Path, options: ArchiveOptions
+) -> list[dict[str, Any]]:
+    """Write the docset at `docset_path` as an archive to `archive_path`
+
+    Returns the index of the members of the archive.
+
+    """
+    index = []
+    with ExitStack() as stack:
+        file_ = stack.enter_context(open(archive_path, "wb"))
+        if options.write_index:
+            # Written in-process, since pigz does not tell where its output can be read from
+            gzip_members = _GzipMembersWriter(file_, options.compression_level, options.threads)
+            stack.callback(gzip_members.close)
+            tar = stack.enter_context(
+                tarfile.open(
+                    fileobj=cast(IO[bytes], gzip_members), mode="w", format=tarfile.PAX_FORMAT
+                )
+            )
+        else:
+            stream = stack.enter_context(
+                _compressed(file_, options.compression_level, options.threads)
+            )
+            tar = stack.enter_context(
+                tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT)
+            )
+
+        for path in _walk(docset_path):
+            tarinfo = tar.gettarinfo(path, arcname=str(path.relative_to(docset_path.parent)))
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = ""
+            # The offset of the member header in the uncompressed tar stream
+            member: dict[str, Any] = {
+                "name": tarinfo.name,
+                "offset": tar.offset,
+                "size": tarinfo.size,
+            }
+            if options.write_index:
+                if tar.offset - gzip_members.member_starts[-1] >= INDEX_RESTART_INTERVAL:
+                    gzip_members.restart()
+                member["gzip_member"] = len(gzip_members.member_starts) - 1
+            index.append(member)
+            if tarinfo.isreg():
+                with open(path, "rb") as member_file:
+                    tar.addfile(tarinfo, member_file)
+            else:
+                tar.addfile(tarinfo)
+
+    if options.write_index:
+        # The offsets of the gzip members are only known once they are all written
+        for member in index:
+            gzip_member = member.pop("gzip_member")
+            member["gzip_member_offset"] = gzip_members.member_offsets[gzip_member]
+            member["gzip_member_start"] = gzip_members.member_starts[gzip_member]
+    return index
+
+
+def write_docset_feed(archive_path: Path, version: str, base_url: str) -> Path:
+    """Write the feed for the docset archive at `archive_path` served from `base_url`
+
+    Returns the path of the feed, which has the name of the docset.
+
+    """
+    feed_path = archive_path.with_suffix(FEED_SUFFIX)
+    url = f"{base_url.rstrip('/')}/{quote(archive_path.name)}"
+    feed_path.write_text(FEED_TEMPLATE.format(version=escape(version), url=escape(url)))
+    LOG.debug("Wrote docset feed", feed_path=feed_path, url=url)
+    return feed_path
+
+
+def _walk(directory: Path) -> Iterator[Path]:
+    """Return `directory` and everything under it, in sorted order, without following links"""
+    for current_directory, dir_names, file_names in os.walk(directory):
+        current_path = Path(current_directory)
+        # Links to directories are listed as directories, but are archived as the links they are
+        links = [name for name in dir_names if (current_path / name).is_symlink()]
+        dir_names[:] = sorted(set(dir_names) - set(links))
+        yield current_path
+        for name in sorted(file_names + links):
+            yield current_path / name
+
+
+@contextmanager
+def _compressed(file_: IO[bytes], compression_level: int, threads: int) -> Iterator[IO[bytes]]:
+    """Return a stream that writes gzip compressed to `file_`
+
+    The compression runs in a pigz process with `threads` threads, if more than one is asked for
+    and pigz is installed.
+
+    """
+    pigz = shutil.which("pigz") if threads > 1 else None
+    if pigz is None:
+        with gzip.GzipFile(fileobj=file_, mode="wb", compresslevel=compression_level) as stream:
+            yield cast(IO[bytes], stream)
+        return
+
+    LOG.debug("Compress with pigz", threads=threads)
+    with subprocess.Popen(
+        [pigz, f"-{compression_level}", "--processes", str(threads), "--stdout"],
+        stdin=subprocess.PIPE,
+        stdout=file_,
+    ) as process:
+        try:
+            yield process.stdin
+        finally:
+            process.stdin.close()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+class _GzipMembersWriter:
+    """A stream that writes gzip compressed to `file_`, as a series of independent gzip members
+
+    Gzip readers decompress the members as one stream, but since the compression starts over in
+    each of them, reading can also start at any of them. The members are compressed in `threads`
+    threads, which run in parallel since zlib releases the GIL.
+
+    Attributes:
+        member_starts (list[int]): The offset in the uncompressed stream of each gzip member
+        member_offsets (list[int]): The offset in `file_` of each gzip member written so far
+
+    """
+
+    def __init__(self, file_: IO[bytes], compression_level: int, threads: int) -> None:
+        self.member_starts = [0]
+        self.member_offsets: list[int] = []
+        self._file = file_
+        self._compression_level = compression_level
+        self._buffer: list[bytes] = []
+        self._position = 0
+        self._max_pending = 2 * threads
+        self._pending: deque[Future[bytes]] = deque()
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="gzip")
+
+    def write(self, data: bytes) -> int:
+        """Write `data` to the current gzip member"""
+        self._buffer.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        """Return the position in the uncompressed stream"""
+        return self._position
+
+    def restart(self) -> None:
+        """Start a new gzip member at the current position"""
+        self._compress_buffer()
+        self.member_starts.append(self._position)
+
+    def close(self) -> None:
+        """Write out the gzip members that are left, does not close `file_`"""
+        self._compress_buffer()
+        while self._pending:
+            self._write_member()
+        self._executor.shutdown()
+
+    def _compress_buffer(self) -> None:
+        """Compress the buffered data into a gzip member in the background"""
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._pending.append(
+            self._executor.submit(gzip.compress, data, self._compression_level, mtime=0)
+        )
+        while len(self._pending) > self._max_pending:
+            self._write_member()
+
+    def _write_member(self) -> None:
+        """Write the oldest of the gzip members being compressed, when it is done"""
+        compressed = self._pending.popleft().result()
+        self.member_offsets.append(self._file.tell())
+        self._file.write(compressed)
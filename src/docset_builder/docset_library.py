@@ -1,37 +1,367 @@
-"""This modules implements functions for docset library management"""
-import json
+"""This modules implements functions for docset library management
+
+Docsets are built in place in a versioned store (`DOCSET_STORE_DIR/<package>/<version dir>`) and
+installed by atomically replacing a symbolic link in the install directory with one to the new
+version, so the docset never disappears from under the docset browser and installing takes the
+same time regardless of the size of the docset. The versions that are no longer installed are
+removed in a background thread. A per-package lock keeps that from removing a version that another
+process is still building.
+
+Optionally, the static assets (theme CSS, JavaScript, fonts, images) that are identical across the
+installed docsets are deduplicated by hard linking them to a single copy in a content store,
+keyed by the hash of the content. Installed docsets are never modified in place, a new version is
+a new directory, so sharing the files is safe, and removing a docset only removes its links. Files
+in the store that no docset links to any more are pruned.
+
+"""
+import fcntl
+import hashlib
+import os
 import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import cast
+from typing import Callable, Iterator, Optional, cast
 
 import structlog
+from attrs import define
+from click import ClickException
+from rich.console import Console
+from rich.table import Table
 
-from . import config
-from .directories import INSTALLED_DOCSETS_INDEX
+from . import config, metadata_store
+from .data_structures import BuildFingerprint
+from .directories import CONTENT_STORE_DIR, DOCSET_STORE_DIR, ensure_dir
 
 LOG = structlog.get_logger(mod="ds_lib")
 
+# The files that are deduplicated; pages are unique to each docset and are patched by doc2dash
+STATIC_ASSET_SUFFIXES = frozenset(
+    (
+        ".css",
+        ".js",
+        ".map",
+        ".woff",
+        ".woff2",
+        ".ttf",
+        ".otf",
+        ".eot",
+        ".svg",
+        ".png",
+        ".gif",
+        ".jpg",
+        ".ico",
+    )
+)
+HASH_CHUNK_SIZE = 1024**2
+
+_GARBAGE_COLLECTORS: list[threading.Thread] = []
+
+
+@contextmanager
+def new_docset_version_dir(package_name: str, version: str, keep: bool = True) -> Iterator[Path]:
+    """Return a new directory in the docset store to build a docset for `package_name` in
+
+    The directory is removed again when the context exits with an exception or if `keep` is
+    False.
+
+    """
+    package_dir = ensure_dir(DOCSET_STORE_DIR / package_name)
+    with _package_lock(package_dir, exclusive=False):
+        prefix = f"{version.replace('/', '_')}-"
+        version_dir = Path(tempfile.mkdtemp(prefix=prefix, dir=package_dir))
+        try:
+            yield version_dir
+        except BaseException:
+            shutil.rmtree(version_dir, ignore_errors=True)
+            raise
+        if not keep:
+            shutil.rmtree(version_dir, ignore_errors=True)
+
 
-def install_docset(docset_build_dir: Path) -> None:
-    """Install the built docset at `built_docs_dir`"""
+@contextmanager
+def _package_lock(package_dir: Path, exclusive: bool) -> Iterator[None]:
+    """Hold the lock on the versions in the store directory of a package, `package_dir`
+
+    Builds hold it shared, across processes, and removing versions holds it exclusively, so a
+    version is never removed while any build for the package is in progress.
+
+    """
+    lock_path = package_dir.with_name(f".{package_dir.name}.lock")
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def install_docset(
+    docset_build_dir: Path,
+    package_name: str,
+    version: str,
+    fingerprint: Optional[BuildFingerprint] = None,
+) -> None:
+    """Install the built docset at `docset_build_dir`
+
+    The docset is installed by atomically pointing the symbolic link in the install directory at
+    `docset_build_dir`, which must be in the docset store. The other versions in the store and a
+    previous docset for the package, e.g. under another name, are then removed in the background.
+
+    """
     LOG.info("Install docset", docset_build_dir=docset_build_dir)
     name = docset_build_dir.name
     install_base_dir = cast(Path, config.install_base_dir)
     install_dir = install_base_dir / name
 
-    if install_dir.exists():
-        LOG.info("Removed existing installation")
-        shutil.rmtree(install_dir)
+    previous_docset = metadata_store.load_installed_docset_for_package(package_name)
+    if previous_docset and previous_docset.docset_name != name:
+        _uninstall(install_base_dir / previous_docset.docset_name)
+    if install_dir.exists() and not install_dir.is_symlink():
+        # Installed as a plain directory, by an older version
+        _uninstall(install_dir)
+
+    try:
+        _replace_symlink(install_dir, docset_build_dir)
+    except OSError:
+        # E.g. on file systems without symbolic links, where moving is the best there is
+        LOG.warning("Unable to link docset, move it instead", install_dir=install_dir)
+        _uninstall(install_dir)
+        shutil.move(docset_build_dir, install_dir)
+    LOG.info("Installed", install_dir=install_dir, target=docset_build_dir)
+
+    metadata_store.record_installed_docset(
+        name, package_name=package_name, version=version, fingerprint=fingerprint
+    )
+    _collect_garbage_in_background(docset_build_dir.parent)
+
+
+def _replace_symlink(link_path: Path, target: Path) -> None:
+    """Atomically make `link_path` a symbolic link to `target`, replacing any existing link"""
+    # Not ending in .docset, so docset browsers never pick it up
+    temporary_link_path = link_path.with_name(f".{link_path.name}.{os.getpid()}.tmp")
+    temporary_link_path.unlink(missing_ok=True)
+    temporary_link_path.symlink_to(target, target_is_directory=True)
+    os.replace(temporary_link_path, link_path)
+
+
+def _uninstall(install_dir: Path) -> None:
+    """Remove the docset installed at `install_dir`
+
+    A symbolic link into the store is simply removed. A plain directory is first renamed out of
+    the way, so it disappears at once, and then removed in the background.
+
+    """
+    LOG.info("Uninstall docset", install_dir=install_dir)
+    if install_dir.is_symlink():
+        install_dir.unlink()
+    elif install_dir.exists():
+        trash_dir = install_dir.with_name(f".{install_dir.name}.{os.getpid()}.old")
+        os.rename(install_dir, trash_dir)
+        _start_garbage_collector(shutil.rmtree, trash_dir, True)
+
+
+def _collect_garbage_in_background(current_version_dir: Path) -> None:
+    """Remove the versions of the package of `current_version_dir` other than it in the background
+
+    The removal waits for the builds for the package, in this and other processes, to finish.
+    Versions that are then linked to from the install directory are kept.
+
+    """
+    _start_garbage_collector(_collect_garbage, current_version_dir)
+
+
+def _collect_garbage(current_version_dir: Path) -> None:
+    """Remove the versions of the package of `current_version_dir`, other than it, not installed"""
+    install_base_dir = cast(Path, config.install_base_dir)
+    with _package_lock(current_version_dir.parent, exclusive=True):
+        linked_version_dirs = {
+            Path(os.readlink(path)).parent
+            for path in install_base_dir.iterdir()
+            if path.is_symlink()
+        }
+        old_version_dirs = [
+            version_dir
+            for version_dir in current_version_dir.parent.iterdir()
+            if version_dir != current_version_dir and version_dir not in linked_version_dirs
+        ]
+        if old_version_dirs:
+            LOG.debug("Remove old docset versions", version_dirs=old_version_dirs)
+        for version_dir in old_version_dirs:
+            shutil.rmtree(version_dir, ignore_errors=True)
+
+
+def _start_garbage_collector(function: Callable[..., object], *args: object) -> None:
+    """Run `function` with `args` in a background thread"""
+    thread = threading.Thread(target=function, args=args, name="docset-gc")
+    thread.start()
+    _GARBAGE_COLLECTORS.append(thread)
+
+
+def wait_for_garbage_collection() -> None:
+    """Wait for the background removal of old docset versions to finish"""
+    while _GARBAGE_COLLECTORS:
+        _GARBAGE_COLLECTORS.pop().join()
 
-    shutil.move(docset_build_dir, install_base_dir)
-    LOG.info("Installed")
 
+def uninstall_docset(package_name: str) -> None:
+    """Uninstall the docset for `package_name` and remove all its versions from the store
+
+    Files shared with other docsets through the content store stay, until no docset uses them.
+
+    """
+    installed_docset = metadata_store.load_installed_docset_for_package(package_name)
+    if installed_docset is None:
+        raise ClickException(f"No docset is installed for {package_name}")
+    _uninstall(cast(Path, config.install_base_dir) / installed_docset.docset_name)
+    package_dir = DOCSET_STORE_DIR / package_name
+    if package_dir.exists():
+        with _package_lock(package_dir, exclusive=True):
+            shutil.rmtree(package_dir, ignore_errors=True)
+    metadata_store.forget_installed_docset(package_name)
+    wait_for_garbage_collection()
+    _prune_content_store(DeduplicationReport())
+    LOG.info("Uninstalled docset", docset_name=installed_docset.docset_name)
+
+
+# Deduplication
+
+
+@define
+class DeduplicationReport:
+    """The outcome of deduplicating the static assets of the installed docsets
+
+    Attributes:
+        files (int): The number of static asset files in the docsets
+        linked (int): The number of files that were replaced by links to the content store
+        bytes_reclaimed (int): The number of bytes freed by replacing files with links
+        store_files (int): The number of files in the content store
+        store_bytes (int): The size of the content store in bytes
+
+    """
+
+    files: int = 0
+    linked: int = 0
+    bytes_reclaimed: int = 0
+    store_files: int = 0
+    store_bytes: int = 0
+
+
+def deduplicate_installed_docsets() -> DeduplicationReport:
+    """Hard link the identical static assets of the installed docsets to the content store"""
+    report = DeduplicationReport()
+    for docset_dir in _installed_docset_dirs():
+        LOG.debug("Deduplicate docset", docset_dir=docset_dir)
+        for path in _static_assets(docset_dir):
+            _deduplicate_file(path, report)
+    _prune_content_store(report)
+    LOG.info("Deduplicated docsets", report=report)
+    return report
+
+
+def undeduplicate_installed_docsets() -> DeduplicationReport:
+    """Give the installed docsets their own copy of every static asset again
+
+    Afterwards, the content store is empty.
+
+    """
+    report = DeduplicationReport()
+    for docset_dir in _installed_docset_dirs():
+        for path in _static_assets(docset_dir):
+            report.files += 1
+            if path.stat().st_nlink > 1:
+                temporary_path = path.with_name(f".{path.name}.undedup")
+                shutil.copy2(path, temporary_path)
+                os.replace(temporary_path, path)
+                report.linked += 1
+    _prune_content_store(report)
+    LOG.info("Undeduplicated docsets", report=report)
+    return report
+
+
+def _installed_docset_dirs() -> Iterator[Path]:
+    """Return the directories of the installed docsets, with links resolved"""
+    install_base_dir = cast(Path, config.install_base_dir)
+    for installed_docset in metadata_store.list_installed_docsets():
+        docset_dir = install_base_dir / installed_docset.docset_name
+        if docset_dir.exists():
+            yield docset_dir.resolve()
+
+
+def _static_assets(docset_dir: Path) -> Iterator[Path]:
+    """Return the static asset files in `docset_dir`"""
+    for directory, _, file_names in os.walk(docset_dir):
+        for file_name in file_names:
+            path = Path(directory) / file_name
+            if path.suffix.lower() in STATIC_ASSET_SUFFIXES and not path.is_symlink():
+                yield path
+
+
+def _deduplicate_file(path: Path, report: DeduplicationReport) -> None:
+    """Replace the file at `path` with a link to the file with the same content in the store
+
+    If the content is not in the store yet, the file is linked into the store instead.
+
+    """
+    report.files += 1
+    stat = path.stat()
+    digest = _file_digest(path)
+    store_path = CONTENT_STORE_DIR / digest[:2] / digest[2:]
     try:
-        with open(INSTALLED_DOCSETS_INDEX) as file_:
-            installed_docsets_index = json.load(file_)
-    except FileNotFoundError:
-        installed_docsets_index = {}
-
-    installed_docsets_index[name] = "version"
-    with open(INSTALLED_DOCSETS_INDEX, "w") as file_:
-        json.dump(installed_docsets_index, file_)
+        if not store_path.exists():
+            ensure_dir(store_path.parent)
+            os.link(path, store_path)
+            return
+
+        store_stat = store_path.stat()
+        if (store_stat.st_dev, store_stat.st_ino) == (stat.st_dev, stat.st_ino):
+            return
+        temporary_path = path.with_name(f".{path.name}.dedup")
+        os.link(store_path, temporary_path)
+        os.replace(temporary_path, path)
+    except OSError:
+        # E.g. a docset that was moved onto another file system than the content store
+        LOG.debug("Unable to deduplicate file", path=path)
+        return
+
+    report.linked += 1
+    if stat.st_nlink == 1:
+        report.bytes_reclaimed += stat.st_size
+
+
+def _file_digest(path: Path) -> str:
+    """Return the SHA-256 hex digest of the content of the file at `path`"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file_:
+        while chunk := file_.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _prune_content_store(report: DeduplicationReport) -> None:
+    """Remove the files that no docset links to from the content store
+
+    The size of what remains is added to `report`.
+
+    """
+    for path in CONTENT_STORE_DIR.glob("*/*"):
+        stat = path.stat()
+        if stat.st_nlink == 1:
+            path.unlink()
+        else:
+            report.store_files += 1
+            report.store_bytes += stat.st_size
+
+
+def print_deduplication_report(report: DeduplicationReport) -> None:
+    """Print out `report` in a rich table"""
+    table = Table(title=f"Docset deduplication: {CONTENT_STORE_DIR}")
+    table.add_column("Static assets", justify="right")
+    table.add_column("Linked", justify="right")
+    table.add_column("Reclaimed", justify="right")
+    table.add_column("Content store", justify="right")
+    table.add_row(
+        str(report.files),
+        str(report.linked),
+        f"{report.bytes_reclaimed / 1024**2:.1f} MiB",
+        f"{report.store_files} files, {report.store_bytes / 1024**2:.1f} MiB",
+    )
+    Console().print(table)
@@ -0,0 +1,137 @@
+"""This module implements finding and preparing the icons for docsets
+
+The icon candidates (favicon or logo images) are found in the repository index, without walking
+the repository again. Docsets have a 16x16 icon.png and a 32x32 icon@2x.png, which are made by
+downscaling the candidate with Pillow (an optional dependency), after rasterizing it with
+cairosvg (also optional) for SVG images. The prepared icons are cached, keyed by the hash of the
+source image and the converter used, so repeated builds do not redo the conversion, while
+installing Pillow or cairosvg later does.
+
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+import structlog
+
+from . import instrumentation
+from .compat import PILImage, cairosvg
+from .directories import ICON_CACHE_DIR, ensure_dir
+from .repository_index import RepositoryIndex
+
+LOG = structlog.get_logger(mod="icons")
+
+# In order of preference
+ICON_STEMS = ("favicon", "logo")
+ICON_SUFFIXES = (".png", ".ico", ".svg")
+# The docset icon file names and their sizes in pixels
+ICON_SIZES = {"icon.png": 16, "icon@2x.png": 32}
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+# Bump this whenever the conversion changes, to invalidate the cached icons
+CONVERSION_VERSION = 1
+
+
+def find_icon(repository_index: RepositoryIndex) -> Optional[Path]:
+    """Return the best icon candidate in `repository_index`, if there is any
+
+    Candidates in the doc or docs directory are preferred over ones elsewhere, then favicons over
+    logos and PNG over ICO over SVG images.
+
+    """
+    doc_dirs = [repository_index.root / name for name in ("doc", "docs")]
+    candidates = []
+    for walk_order, file_ in enumerate(repository_index.files):
+        stem, suffix = file_.stem.lower(), file_.suffix.lower()
+        if stem in ICON_STEMS and suffix in ICON_SUFFIXES:
+            in_doc_dir = any(doc_dir in file_.parents for doc_dir in doc_dirs)
+            rank = (not in_doc_dir, ICON_STEMS.index(stem), ICON_SUFFIXES.index(suffix), walk_order)
+            candidates.append((rank, file_))
+    if not candidates:
+        LOG.debug("No icon candidates found")
+        return None
+    return min(candidates)[1]
+
+
+def prepare_icons(icon_path: Path) -> Optional[Path]:
+    """Return the directory with the docset icons prepared from the image at `icon_path`
+
+    The directory contains icon.png and, if Pillow or cairosvg could make it, icon@2x.png.
+    Returns None if no icon could be made from the image.
+
+    """
+    source = icon_path.read_bytes()
+    converter = _converter(suffix=icon_path.suffix.lower())
+    if converter is None:
+        LOG.warning("Unable to make docset icon, built without icon", icon_path=icon_path)
+        return None
+    digest = hashlib.sha256(source)
+    digest.update(f"{converter}-{CONVERSION_VERSION}".encode("ascii"))
+    icon_dir = ICON_CACHE_DIR / digest.hexdigest()
+    if (icon_dir / "icon.png").exists():
+        LOG.debug("Icon cache hit", icon_path=icon_path, icon_dir=icon_dir)
+        instrumentation.count_hit("icon", hit=True)
+        return icon_dir
+    instrumentation.count_hit("icon", hit=False)
+
+    icons = _convert(source, converter=converter)
+    if not icons:
+        LOG.warning("Unable to make docset icon, built without icon", icon_path=icon_path)
+        return None
+
+    temporary_dir = Path(tempfile.mkdtemp(dir=ensure_dir(ICON_CACHE_DIR), prefix=".tmp-"))
+    for name, data in icons.items():
+        (temporary_dir / name).write_bytes(data)
+    try:
+        os.replace(temporary_dir, icon_dir)
+    except OSError:
+        # Prepared by a concurrent build in the meantime
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+    LOG.info("Prepared docset icons", icon_path=icon_path, icons=list(icons), icon_dir=icon_dir)
+    return icon_dir
+
+
+def _converter(suffix: str) -> Optional[str]:
+    """Return the name of the converter for images of type `suffix`, if one is available"""
+    if suffix == ".svg":
+        if cairosvg is None or PILImage is None:
+            LOG.info("Install cairosvg and Pillow to make docset icons from SVG images")
+            return None
+        return "cairosvg"
+    if PILImage is None:
+        # The best there is, is using a PNG image as is, which is what doc2dash does too
+        LOG.info("Install Pillow to downscale docset icons")
+        return "passthrough"
+    return "pillow"
+
+
+def _convert(source: bytes, converter: str) -> dict[str, bytes]:
+    """Return the docset icons, by name, made from the image `source` with `converter`"""
+    if converter == "passthrough":
+        return {"icon.png": source} if source.startswith(PNG_HEADER) else {}
+
+    try:
+        if converter == "cairosvg":
+            # Rasterized at the largest size, keeping the aspect ratio, and then letterboxed
+            source = cairosvg.svg2png(bytestring=source, output_width=max(ICON_SIZES.values()))
+        image = PILImage.open(BytesIO(source))
+        image.load()
+    except (OSError, SyntaxError, ValueError):
+        # E.g. a malformed image, which is not worth failing the build over
+        return {}
+    rgba_image = image.convert("RGBA")
+    return {name: _downscale(rgba_image, size) for name, size in ICON_SIZES.items()}
+
+
+def _downscale(image: "PILImage.Image", size: int) -> bytes:
+    """Return `image` downscaled to fit, centered, in a `size` by `size` PNG image"""
+    thumbnail = image.copy()
+    thumbnail.thumbnail((size, size), PILImage.Resampling.LANCZOS)
+    canvas = PILImage.new("RGBA", (size, size))
+    canvas.paste(thumbnail, ((size - thumbnail.width) // 2, (size - thumbnail.height) // 2))
+    output = BytesIO()
+    canvas.save(output, format="PNG", optimize=True)
+    return output.getvalue()
@@ -0,0 +1,70 @@
+"""This module implements skipping packages whose installed docset is already up to date
+
+A docset is up to date, if the fingerprint of what it would be built from (package version,
+commit, builder tool versions and the resolved docbuild information) matches the fingerprint
+recorded when the installed docset was built.
+
+"""
+from functools import lru_cache
+from importlib.metadata import PackageNotFoundError
+from importlib.metadata import version as package_version
+from pathlib import Path
+from typing import cast
+
+import structlog
+
+from . import __version__, config, metadata_store
+from .data_structures import BuildFingerprint, DocBuildInfo
+from .virtual_environments import base_python_version
+
+LOG = structlog.get_logger(mod="increment")
+
+
+@lru_cache(maxsize=1)
+def builder_tool_versions() -> dict[str, str]:
+    """Return the versions of the tools that are used to build docsets"""
+    tool_versions = {"docset-builder": __version__}
+    try:
+        tool_versions["doc2dash"] = package_version("doc2dash")
+    except PackageNotFoundError:
+        tool_versions["doc2dash"] = "not installed"
+    # The interpreter the doc build virtual environments are created from
+    tool_versions["python"] = base_python_version()
+    return tool_versions
+
+
+def make_build_fingerprint(
+    checked_out_tag: str, commit_hash: str, docbuild_info: DocBuildInfo
+) -> BuildFingerprint:
+    """Return the fingerprint of building the docset from `commit_hash` with `docbuild_info`"""
+    return BuildFingerprint(
+        package_version=checked_out_tag,
+        commit_hash=commit_hash,
+        tool_versions=builder_tool_versions(),
+        docbuild_info_hash=docbuild_info.content_hash(),
+    )
+
+
+def is_up_to_date(package_name: str, fingerprint: BuildFingerprint) -> bool:
+    """Return whether the installed docset for `package_name` was built with `fingerprint`"""
+    installed_docset = metadata_store.load_installed_docset_for_package(package_name)
+    if installed_docset is None:
+        LOG.debug("No docset installed", package_name=package_name)
+        return False
+
+    if installed_docset.fingerprint != fingerprint.digest():
+        LOG.debug(
+            "Installed docset has different fingerprint",
+            package_name=package_name,
+            installed_version=installed_docset.version,
+            version=fingerprint.package_version,
+        )
+        return False
+
+    # The docset may have been removed behind our back
+    install_base_dir = cast(Path, config.install_base_dir)
+    if not (install_base_dir / installed_docset.docset_name).exists():
+        LOG.debug("Installed docset is missing", docset_name=installed_docset.docset_name)
+        return False
+
+    return True
@@ -0,0 +1,203 @@
+"""This module implements instrumentation of install runs
+
+The time spent in each stage of each package pipeline is measured along with the CPU time of
+child processes (doc builds, installers, git) and the cache hits and misses are counted. At the
+end of a run, a summary table is printed and a JSON report can be written.
+
+Note, the CPU time and peak memory use of child processes is only available for the process as a
+whole, so when several pipelines run concurrently, the CPU time of a stage also includes that of
+child processes of other stages that finished in the meantime.
+
+"""
+import json
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional, Sequence
+
+import structlog
+from attrs import asdict, define, field
+from rich.console import Console
+from rich.table import Table
+
+from .data_structures import CacheStatistics, PackageResult
+
+LOG = structlog.get_logger(mod="instrument")
+
+# The stages in pipeline order, for presentation
+STAGE_NAMES = (
+    "pypi",
+    "repository",
+    "search",
+    "dependency_install",
+    "doc_build",
+    "post_build_search",
+    "doc2dash",
+    "archive",
+    "install",
+)
+
+
+@define
+class StageMeasurement:
+    """The measurement of one stage of the pipeline for one package
+
+    Attributes:
+        package_name (str): The name of the package, or None for stages that cover all packages
+        stage (str): The name of the stage
+        duration (float): The wall clock duration in seconds
+        children_cpu_time (float): The user and system CPU time of child processes that finished
+            during the stage in seconds
+        succeeded (bool): Whether the stage completed without raising an exception
+
+    """
+
+    package_name: Optional[str]
+    stage: str
+    duration: float
+    children_cpu_time: float
+    succeeded: bool
+
+
+@define
+class RunMetrics:
+    """The metrics collected during an install run
+
+    Attributes:
+        started_at (float): The time the run started, in seconds since the epoch
+        measurements (list[StageMeasurement]): The measurements of the stages
+        counters (dict[str, CacheStatistics]): Hits and misses of each cache
+
+    """
+
+    started_at: float = field(factory=time.time)
+    measurements: list[StageMeasurement] = field(factory=list)
+    counters: dict[str, CacheStatistics] = field(factory=lambda: defaultdict(CacheStatistics))
+    _lock: threading.Lock = field(factory=threading.Lock, alias="_lock")
+
+
+_RUN_METRICS = RunMetrics()
+
+
+def reset() -> None:
+    """Start collecting metrics for a new run"""
+    global _RUN_METRICS
+    _RUN_METRICS = RunMetrics()
+
+
+@contextmanager
+def measure(package_name: Optional[str], stage_name: str) -> Iterator[None]:
+    """Measure the stage `stage_name` for `package_name` within this context manager"""
+    start = time.perf_counter()
+    start_cpu_time = _children_cpu_time()
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        measurement = StageMeasurement(
+            package_name=package_name,
+            stage=stage_name,
+            duration=time.perf_counter() - start,
+            children_cpu_time=_children_cpu_time() - start_cpu_time,
+            succeeded=succeeded,
+        )
+        LOG.debug("Stage measured", **asdict(measurement))
+        with _RUN_METRICS._lock:
+            _RUN_METRICS.measurements.append(measurement)
+
+
+def count(counter_name: str, hits: int = 0, misses: int = 0) -> None:
+    """Count `hits` and `misses` for the cache `counter_name`"""
+    with _RUN_METRICS._lock:
+        _RUN_METRICS.counters[counter_name] += CacheStatistics(hits=hits, misses=misses)
+
+
+def count_hit(counter_name: str, hit: bool) -> None:
+    """Count a hit, if `hit` is True, otherwise a miss, for the cache `counter_name`"""
+    count(counter_name, hits=int(hit), misses=int(not hit))
+
+
+def _children_cpu_time() -> float:
+    """Return the user and system CPU time of all finished child processes"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def make_report(results: Sequence[PackageResult], jobs: int) -> dict[str, Any]:
+    """Return a JSON serializable report of the metrics of the run and its `results`"""
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    with _RUN_METRICS._lock:
+        return {
+            "started_at": _RUN_METRICS.started_at,
+            "duration": time.time() - _RUN_METRICS.started_at,
+            "jobs": jobs,
+            "packages": [asdict(result) for result in results],
+            "stages": [asdict(measurement) for measurement in _RUN_METRICS.measurements],
+            "counters": {
+                name: {**asdict(statistics), "hit_rate": statistics.hit_rate}
+                for name, statistics in sorted(_RUN_METRICS.counters.items())
+            },
+            "resources": {
+                "children_user_cpu_time": children_usage.ru_utime,
+                "children_system_cpu_time": children_usage.ru_stime,
+                # Kilobytes on Linux; the largest single child process, not the sum
+                "children_max_rss": children_usage.ru_maxrss,
+                "max_rss": self_usage.ru_maxrss,
+            },
+        }
+
+
+def write_report(path: Path, results: Sequence[PackageResult], jobs: int) -> None:
+    """Write the JSON report of the metrics of the run to `path`"""
+    with open(path, "w") as file_:
+        json.dump(make_report(results, jobs), file_, indent=4)
+    LOG.info("Wrote metrics report", path=path)
+
+
+def print_metrics_summary() -> None:
+    """Print out the time spent per stage and the cache hits and misses in rich tables"""
+    durations: dict[str, list[float]] = defaultdict(list)
+    cpu_times: dict[str, float] = defaultdict(float)
+    with _RUN_METRICS._lock:
+        for measurement in _RUN_METRICS.measurements:
+            durations[measurement.stage].append(measurement.duration)
+            cpu_times[measurement.stage] += measurement.children_cpu_time
+        counters = dict(_RUN_METRICS.counters)
+
+    stage_table = Table(title="Time Per Stage")
+    stage_table.add_column("Stage", style="cyan")
+    for column_name in ("Count", "Total", "Mean", "Max", "Child CPU"):
+        stage_table.add_column(column_name, justify="right")
+    known_stages = [name for name in STAGE_NAMES if name in durations]
+    for stage_name in known_stages + sorted(set(durations) - set(STAGE_NAMES)):
+        stage_durations = durations[stage_name]
+        stage_table.add_row(
+            stage_name,
+            str(len(stage_durations)),
+            f"{sum(stage_durations):.1f}s",
+            f"{sum(stage_durations) / len(stage_durations):.1f}s",
+            f"{max(stage_durations):.1f}s",
+            f"{cpu_times[stage_name]:.1f}s",
+        )
+
+    cache_table = Table(title="Caches")
+    cache_table.add_column("Cache", style="cyan")
+    for column_name in ("Hits", "Misses", "Hit rate"):
+        cache_table.add_column(column_name, justify="right")
+    for name, statistics in sorted(counters.items()):
+        hit_rate = statistics.hit_rate
+        cache_table.add_row(
+            name,
+            str(statistics.hits),
+            str(statistics.misses),
+            "-" if hit_rate is None else f"{hit_rate:.0%}",
+        )
+
+    console = Console()
+    console.print(stage_table)
+    console.print(cache_table)
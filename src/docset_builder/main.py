@@ -1,17 +1,17 @@
-"""This module implements the main cli interface"""
-import logging
+"""This module implements the main cli interface
+
+The cli is also used from shell completion and editor integrations, so it must start fast.
+Therefore, only click is imported here and the rest of the package, structlog included, is
+imported in the commands that need it.
+
+"""
+import os
 from pathlib import Path
-from typing import Optional, Sequence
+from typing import Any, Mapping, Optional, Sequence
 
 import click
-import structlog
-
-from .core import install as core_install
-from .directories import log_cache_dirs
-from .logging_configuration import configure
 
-configure()
-LOG = structlog.get_logger(mod="main")
+from . import config
 
 
 @click.group()  # This functions works as a grouping mechanism for the cli sub-commands
@@ -20,8 +20,33 @@ def cli() -> None:
     pass
 
 
+def configure_logging() -> None:
+    """Configure structlog to display the module of the log messages
+
+    This is called in the commands, not in the group callbacks, which also run for --help.
+
+    """
+    from .logging_configuration import configure
+
+    configure()
+
+
+def get_logger() -> Any:
+    """Return the logger for this module"""
+    import structlog
+
+    return structlog.get_logger(mod="main")
+
+
 def config_verbosity(verbose: bool, very_verbose: bool) -> None:
     """Configure loggers according to whether `verbose` is set"""
+    import logging
+
+    import structlog
+
+    from .directories import log_cache_dirs
+
+    configure_logging()
     if very_verbose:
         level = logging.DEBUG
     elif verbose:
@@ -29,12 +54,35 @@ def config_verbosity(verbose: bool, very_verbose: bool) -> None:
     else:
         level = logging.ERROR
     structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(level))
-    LOG.debug("Set log level", log_level=level)
+    get_logger().debug("Set log level", log_level=level)
     # This is the one logging that should have happened at module level, but that would
     # defeat the verbosity settings, so instead it is wrapped in a function at called here
     log_cache_dirs()
 
 
+def parse_stage_limits(
+    _context: click.Context, _parameter: click.Parameter, values: Sequence[str]
+) -> Mapping[str, int]:
+    """Parse a number of STAGE=LIMIT strings into a mapping of stage to concurrency limit"""
+    stage_limits = {}
+    for value in values:
+        stage_name, _, limit = value.partition("=")
+        try:
+            stage_limits[stage_name.strip()] = int(limit)
+        except ValueError:
+            raise click.BadParameter(f"Expected STAGE=LIMIT, got '{value}'")
+    return stage_limits
+
+
+def validate_build_jobs(
+    _context: click.Context, _parameter: click.Parameter, value: Optional[str]
+) -> Optional[str]:
+    """Validate that `value` is "auto" or a positive number of jobs"""
+    if value is None or value == "auto" or (value.isdigit() and int(value) > 0):
+        return value
+    raise click.BadParameter(f"Expected 'auto' or a positive number, got '{value}'")
+
+
 @click.command()
 @click.argument("packages", nargs=-1)
 @click.option(
@@ -67,6 +115,87 @@ def config_verbosity(verbose: bool, very_verbose: bool) -> None:
     default=False,
     is_flag=True,
 )
+@click.option(
+    "--pypi-cache-ttl",
+    default=None,
+    type=click.FloatRange(min=0),
+    help="Seconds to use cached PyPI information before revalidating it (default: 1 day)",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    type=click.IntRange(min=1),
+    help="The number of packages to process in parallel",
+)
+@click.option(
+    "-f",
+    "--force",
+    default=False,
+    is_flag=True,
+    help="Rebuild and reinstall docsets even if the installed ones are up to date",
+)
+@click.option(
+    "--installer",
+    default=None,
+    type=click.Choice(config.INSTALLER_NAMES),
+    help="The installer for doc build virtual environments (default: auto, uv if available)",
+)
+@click.option(
+    "--build-jobs",
+    default=None,
+    callback=validate_build_jobs,
+    help=(
+        "Parallel jobs for each doc build, where the build tool supports it (default: auto, the "
+        "CPUs divided between the concurrent builds)"
+    ),
+)
+@click.option(
+    "--stage-limit",
+    "stage_limits",
+    multiple=True,
+    callback=parse_stage_limits,
+    metavar="STAGE=LIMIT",
+    help="Override the concurrency limit for a pipeline stage, e.g. build=1",
+)
+@click.option(
+    "--metrics-out",
+    type=Path,
+    help="Write a JSON report of stage timings, resource use and cache hits to this file",
+)
+@click.option(
+    "--archive-dir",
+    type=Path,
+    help="Also write each docset as a .tgz archive for distribution to this directory",
+)
+@click.option(
+    "--compression-level",
+    type=click.IntRange(1, 9),
+    default=6,
+    show_default=True,
+    help="The gzip compression level of the archives",
+)
+@click.option(
+    "--compression-threads",
+    type=click.IntRange(min=1),
+    default=None,
+    show_default="the number of CPUs divided by --jobs",
+    help="The number of threads to compress each archive with; needs pigz without --archive-index",
+)
+@click.option(
+    "--archive-index",
+    is_flag=True,
+    help="Write an index of the members next to each archive, for random access into it",
+)
+@click.option(
+    "--feed-base-url",
+    help="The URL the archives are served from, to write a Dash/Zeal feed for each archive",
+)
+@click.option(
+    "--dedup",
+    is_flag=True,
+    help="Afterwards, hard link the static assets that are identical across installed docsets",
+)
 def install(
     packages: Sequence[str],
     build_only: bool,
@@ -74,25 +203,162 @@ def install(
     verbose: bool,
     very_verbose: bool,
     no_cache: bool,
+    pypi_cache_ttl: Optional[float],
+    jobs: int,
+    force: bool,
+    installer: Optional[str],
+    build_jobs: Optional[str],
+    stage_limits: Mapping[str, int],
+    metrics_out: Optional[Path],
+    archive_dir: Optional[Path],
+    compression_level: int,
+    compression_threads: Optional[int],
+    archive_index: bool,
+    feed_base_url: Optional[str],
+    dedup: bool,
 ) -> None:
     """Install docsets for one or more `packages`"""
+    from .core import install as core_install
+    from .docset_archive import ArchiveOptions
+
     config_verbosity(verbose, very_verbose)
-    LOG.info(
+    get_logger().info(
         "install",
         packages=packages,
         build_only=build_only,
         dump_test_files=dump_test_files_to,
         no_cache=no_cache,
+        pypi_cache_ttl=pypi_cache_ttl,
+        jobs=jobs,
+        force=force,
+        installer=installer,
+        build_jobs=build_jobs,
+        stage_limits=stage_limits,
+        metrics_out=metrics_out,
+        archive_dir=archive_dir,
+        dedup=dedup,
     )
+    if not archive_dir and (archive_index or feed_base_url):
+        raise click.UsageError("--archive-index and --feed-base-url require --archive-dir")
+    if compression_threads is None:
+        # Each of the pipelines may be compressing an archive at the same time
+        compression_threads = max(1, (os.cpu_count() or 1) // jobs)
+
+    archive_options = None
+    if archive_dir:
+        archive_options = ArchiveOptions(
+            archive_dir=archive_dir,
+            compression_level=compression_level,
+            threads=compression_threads,
+            write_index=archive_index,
+            feed_base_url=feed_base_url,
+        )
     core_install(
         packages,
         build_only=build_only,
         test_file_dump_path=dump_test_files_to,
         use_cache=not no_cache,
+        pypi_cache_ttl=pypi_cache_ttl,
+        jobs=jobs,
+        stage_limit_overrides=stage_limits,
+        force=force,
+        installer=installer,
+        build_jobs=build_jobs,
+        metrics_out=metrics_out,
+        archive_options=archive_options,
+        deduplicate=dedup,
     )
 
 
+@click.group()
+def cache() -> None:
+    """Manage the package cache shared by the doc build virtual environments"""
+    pass
+
+
+@cache.command()
+def report() -> None:
+    """Show the size and the hit/miss statistics of the package cache"""
+    from .package_cache import print_package_cache_report
+
+    configure_logging()
+    print_package_cache_report()
+
+
+@cache.command()
+@click.option(
+    "--max-size",
+    required=True,
+    help="The size to shrink the package cache to, e.g. 500M or 2G",
+)
+def prune(max_size: str) -> None:
+    """Evict the least recently used entries from the package cache"""
+    from .package_cache import parse_size, prune_package_cache
+
+    configure_logging()
+    evicted = prune_package_cache(parse_size(max_size))
+    click.echo(
+        f"Evicted {len(evicted)} entries, freeing "
+        f"{sum(entry.size for entry in evicted) / 1024**2:.1f} MiB"
+    )
+
+
+@cache.command(name="reset-stats")
+def reset_stats() -> None:
+    """Reset the hit/miss statistics of the package cache"""
+    from .metadata_store import reset_package_cache_statistics
+
+    configure_logging()
+    reset_package_cache_statistics()
+
+
+@cache.command()
+@click.argument("requirements", nargs=-1)
+def wheelhouse(requirements: Sequence[str]) -> None:
+    """Pre-build wheels for `requirements`, by default common doc toolchain packages"""
+    from .package_cache import COMMON_DOC_TOOLCHAIN_REQUIREMENTS, build_wheelhouse
+
+    configure_logging()
+    build_wheelhouse(requirements or COMMON_DOC_TOOLCHAIN_REQUIREMENTS)
+
+
+@click.group()
+def library() -> None:
+    """Manage the installed docsets"""
+    pass
+
+
+@library.command()
+def dedup() -> None:
+    """Hard link the static assets that are identical across the installed docsets"""
+    from .docset_library import deduplicate_installed_docsets, print_deduplication_report
+
+    configure_logging()
+    print_deduplication_report(deduplicate_installed_docsets())
+
+
+@library.command()
+def undedup() -> None:
+    """Give every installed docset its own copy of its static assets again"""
+    from .docset_library import print_deduplication_report, undeduplicate_installed_docsets
+
+    configure_logging()
+    print_deduplication_report(undeduplicate_installed_docsets())
+
+
+@library.command()
+@click.argument("package")
+def uninstall(package: str) -> None:
+    """Uninstall the docset for `package`"""
+    from .docset_library import uninstall_docset
+
+    configure_logging()
+    uninstall_docset(package)
+
+
 cli.add_command(install)
+cli.add_command(cache)
+cli.add_command(library)
 
 
 if __name__ == "__main__":
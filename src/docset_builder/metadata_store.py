@@ -0,0 +1,366 @@
+"""This module implements the single-file metadata store
+
+All metadata (PyPI information, checked out tags, docbuild information, builds and installed
+docsets) is kept in one SQLite database in WAL mode. Every thread gets its own connection and all
+updates are done in transactions, so several package pipelines can finish and write at the same
+time.
+
+The schema is versioned with `PRAGMA user_version`; to change it, append a migration to
+`MIGRATIONS`.
+
+"""
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, ContextManager, Iterator, Optional
+
+import structlog
+from attrs import asdict
+
+from .data_structures import (
+    BuildFingerprint,
+    CacheStatistics,
+    DocBuildInfo,
+    InstalledDocset,
+    PyPICacheEntry,
+    PyPIInfo,
+)
+from .directories import INSTALLED_DOCSETS_INDEX, METADATA_STORE_PATH, ensure_dir
+
+LOG = structlog.get_logger(mod="metastore")
+
+MIGRATIONS: tuple[tuple[str, ...], ...] = (
+    # 1: Initial schema
+    (
+        """CREATE TABLE pypi_info (
+            package_name TEXT PRIMARY KEY,
+            pypi_info TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL NOT NULL
+        )""",
+        """CREATE TABLE checkouts (
+            package_name TEXT PRIMARY KEY,
+            tag TEXT NOT NULL,
+            commit_hash TEXT NOT NULL,
+            checked_out_at REAL NOT NULL
+        )""",
+        """CREATE TABLE builds (
+            package_name TEXT PRIMARY KEY,
+            docbuild_info TEXT NOT NULL,
+            built_at REAL NOT NULL
+        )""",
+        """CREATE TABLE installed_docsets (
+            docset_name TEXT PRIMARY KEY,
+            package_name TEXT,
+            version TEXT,
+            installed_at REAL NOT NULL
+        )""",
+    ),
+    # 2: Cache of docbuild information
+    (
+        """CREATE TABLE docbuild_info_cache (
+            cache_key TEXT PRIMARY KEY,
+            package_name TEXT NOT NULL,
+            docbuild_info TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )""",
+        "CREATE INDEX docbuild_info_cache_package_name ON docbuild_info_cache (package_name)",
+    ),
+    # 3: Build fingerprints of installed docsets
+    (
+        "ALTER TABLE installed_docsets ADD COLUMN commit_hash TEXT",
+        "ALTER TABLE installed_docsets ADD COLUMN tool_versions TEXT",
+        "ALTER TABLE installed_docsets ADD COLUMN docbuild_info_hash TEXT",
+        "ALTER TABLE installed_docsets ADD COLUMN fingerprint TEXT",
+        "CREATE INDEX installed_docsets_package_name ON installed_docsets (package_name)",
+    ),
+    # 4: Statistics of the shared package cache
+    (
+        """CREATE TABLE package_cache_statistics (
+            installer TEXT PRIMARY KEY,
+            hits INTEGER NOT NULL,
+            misses INTEGER NOT NULL
+        )""",
+    ),
+    # 5: PyPI information keyed by the API it was fetched from, since the validators belong to
+    # the API URL. The cached information is dropped, as its API is not known.
+    (
+        "DROP TABLE pypi_info",
+        """CREATE TABLE pypi_info (
+            package_name TEXT NOT NULL,
+            api TEXT NOT NULL,
+            pypi_info TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (package_name, api)
+        )""",
+    ),
+)
+
+_THREAD_LOCAL = threading.local()
+_MIGRATION_LOCK = threading.Lock()
+
+
+def _connection() -> sqlite3.Connection:
+    """Return this thread's connection to the metadata store, create it if needed"""
+    path = METADATA_STORE_PATH
+    connections: dict[Path, sqlite3.Connection] = _THREAD_LOCAL.__dict__.setdefault(
+        "connections", {}
+    )
+    if path not in connections:
+        # isolation_level=None turns off the implicit transactions of the sqlite3 module, so
+        # that transactions can be explicitly started with BEGIN IMMEDIATE
+        ensure_dir(path.parent)
+        connection = sqlite3.connect(path, timeout=30.0, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with _MIGRATION_LOCK:
+            _migrate(connection)
+        connections[path] = connection
+    return connections[path]
+
+
+def _migrate(connection: sqlite3.Connection) -> None:
+    """Bring the schema of the database behind `connection` up to date"""
+    # The schema version is read inside the write transaction, so that concurrent processes
+    # cannot both apply the same migration
+    with _transaction(connection):
+        (schema_version,) = connection.execute("PRAGMA user_version").fetchone()
+        for new_version, migration in enumerate(
+            MIGRATIONS[schema_version:], start=schema_version + 1
+        ):
+            LOG.info("Migrate metadata store", schema_version=new_version)
+            for statement in migration:
+                connection.execute(statement)
+            connection.execute(f"PRAGMA user_version={new_version}")
+            if new_version == 1:
+                _import_installed_docsets_index(connection)
+
+
+def _import_installed_docsets_index(connection: sqlite3.Connection) -> None:
+    """Import the installed docsets from the JSON index used before the metadata store"""
+    if not INSTALLED_DOCSETS_INDEX.exists():
+        return
+
+    with open(INSTALLED_DOCSETS_INDEX) as file_:
+        installed_docsets_index = json.load(file_)
+    connection.executemany(
+        "INSERT OR IGNORE INTO installed_docsets (docset_name, installed_at) VALUES (?, ?)",
+        ((name, time.time()) for name in installed_docsets_index),
+    )
+    INSTALLED_DOCSETS_INDEX.rename(INSTALLED_DOCSETS_INDEX.with_suffix(".json.imported"))
+    LOG.info("Imported installed docsets index", docsets=list(installed_docsets_index))
+
+
+@contextmanager
+def _transaction(connection: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    """Run the statements on `connection` within this context manager in one write transaction"""
+    # IMMEDIATE takes the write lock up front, so read-modify-write sequences are atomic
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def transaction() -> ContextManager[sqlite3.Connection]:
+    """Return a context manager that runs the statements within it in one write transaction"""
+    return _transaction(_connection())
+
+
+def _query_one(sql: str, parameters: tuple[Any, ...]) -> Optional[sqlite3.Row]:
+    """Return the first row (or None) of the result of `sql` with `parameters`"""
+    row: Optional[sqlite3.Row] = _connection().execute(sql, parameters).fetchone()
+    return row
+
+
+# PyPI information
+
+
+def load_pypi_cache_entry(package_name: str, api: str) -> Optional[PyPICacheEntry]:
+    """Return the stored PyPI information, with its validators, for `package_name` and `api`"""
+    row = _query_one(
+        "SELECT * FROM pypi_info WHERE package_name = ? AND api = ?", (package_name, api)
+    )
+    if row is None:
+        return None
+    return PyPICacheEntry(
+        pypi_info=PyPIInfo.from_dict(json.loads(row["pypi_info"])),
+        etag=row["etag"],
+        last_modified=row["last_modified"],
+        fetched_at=row["fetched_at"],
+    )
+
+
+def store_pypi_cache_entry(package_name: str, api: str, cache_entry: PyPICacheEntry) -> None:
+    """Store the PyPI information `cache_entry` fetched from `api` for `package_name`"""
+    with transaction() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO pypi_info VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                package_name,
+                api,
+                json.dumps(asdict(cache_entry.pypi_info)),
+                cache_entry.etag,
+                cache_entry.last_modified,
+                cache_entry.fetched_at,
+            ),
+        )
+
+
+# Checkouts and builds
+
+
+def record_checkout(package_name: str, tag: str, commit_hash: str) -> None:
+    """Record that `tag` at `commit_hash` is now checked out for `package_name`"""
+    with transaction() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO checkouts VALUES (?, ?, ?, ?)",
+            (package_name, tag, commit_hash, time.time()),
+        )
+
+
+def load_checkout(package_name: str) -> Optional[tuple[str, str]]:
+    """Return the checked out tag and commit hash for `package_name`, if any"""
+    row = _query_one(
+        "SELECT tag, commit_hash FROM checkouts WHERE package_name = ?", (package_name,)
+    )
+    return (row["tag"], row["commit_hash"]) if row else None
+
+
+def load_cached_docbuild_info(cache_key: str) -> Optional[DocBuildInfo]:
+    """Return the cached docbuild information for `cache_key`, if any"""
+    row = _query_one(
+        "SELECT docbuild_info FROM docbuild_info_cache WHERE cache_key = ?", (cache_key,)
+    )
+    return DocBuildInfo.from_dict(json.loads(row["docbuild_info"])) if row else None
+
+
+def store_cached_docbuild_info(
+    cache_key: str, package_name: str, docbuild_info: DocBuildInfo
+) -> None:
+    """Cache `docbuild_info` under `cache_key`, replacing older entries for `package_name`"""
+    with transaction() as connection:
+        connection.execute(
+            "DELETE FROM docbuild_info_cache WHERE package_name = ?", (package_name,)
+        )
+        connection.execute(
+            "INSERT INTO docbuild_info_cache VALUES (?, ?, ?, ?)",
+            (cache_key, package_name, json.dumps(docbuild_info.to_dict()), time.time()),
+        )
+
+
+def record_build(package_name: str, docbuild_info: DocBuildInfo) -> None:
+    """Record that the docs for `package_name` were just built with `docbuild_info`"""
+    with transaction() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO builds VALUES (?, ?, ?)",
+            (package_name, json.dumps(docbuild_info.to_dict()), time.time()),
+        )
+
+
+def load_build_time(package_name: str) -> Optional[float]:
+    """Return the time the docs for `package_name` were last built, if ever"""
+    row = _query_one("SELECT built_at FROM builds WHERE package_name = ?", (package_name,))
+    return float(row["built_at"]) if row else None
+
+
+# Installed docsets
+
+
+def record_installed_docset(
+    docset_name: str,
+    package_name: str,
+    version: str,
+    fingerprint: Optional[BuildFingerprint] = None,
+) -> None:
+    """Record that version `version` of the docset `docset_name` is installed
+
+    If the `fingerprint` of the build is given, it is recorded as well.
+
+    """
+    with transaction() as connection:
+        # Docsets for a package may change name, so remove the older records for the package
+        connection.execute(
+            "DELETE FROM installed_docsets WHERE package_name = ? AND docset_name != ?",
+            (package_name, docset_name),
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO installed_docsets "
+            "(docset_name, package_name, version, installed_at, commit_hash, tool_versions, "
+            "docbuild_info_hash, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                docset_name,
+                package_name,
+                version,
+                time.time(),
+                fingerprint.commit_hash if fingerprint else None,
+                json.dumps(fingerprint.tool_versions) if fingerprint else None,
+                fingerprint.docbuild_info_hash if fingerprint else None,
+                fingerprint.digest() if fingerprint else None,
+            ),
+        )
+
+
+def forget_installed_docset(package_name: str) -> None:
+    """Remove the record of the installed docset for `package_name`"""
+    with transaction() as connection:
+        connection.execute("DELETE FROM installed_docsets WHERE package_name = ?", (package_name,))
+
+
+def load_installed_docset(docset_name: str) -> Optional[InstalledDocset]:
+    """Return the record for the installed docset `docset_name`, if it is installed"""
+    row = _query_one("SELECT * FROM installed_docsets WHERE docset_name = ?", (docset_name,))
+    return _installed_docset_from_row(row) if row else None
+
+
+def load_installed_docset_for_package(package_name: str) -> Optional[InstalledDocset]:
+    """Return the record for the installed docset for `package_name`, if there is one"""
+    row = _query_one("SELECT * FROM installed_docsets WHERE package_name = ?", (package_name,))
+    return _installed_docset_from_row(row) if row else None
+
+
+def list_installed_docsets() -> list[InstalledDocset]:
+    """Return the records of all installed docsets"""
+    rows = _connection().execute("SELECT * FROM installed_docsets ORDER BY docset_name")
+    return [_installed_docset_from_row(row) for row in rows]
+
+
+def _installed_docset_from_row(row: sqlite3.Row) -> InstalledDocset:
+    """Return an `InstalledDocset` from an installed_docsets `row`"""
+    return InstalledDocset(**{key: row[key] for key in row.keys()})
+
+
+# Package cache statistics
+
+
+def record_package_cache_statistics(installer: str, statistics: CacheStatistics) -> None:
+    """Add `statistics` to the package cache statistics recorded for `installer`"""
+    with transaction() as connection:
+        connection.execute(
+            "INSERT INTO package_cache_statistics VALUES (?, ?, ?) ON CONFLICT (installer) DO "
+            "UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses",
+            (installer, statistics.hits, statistics.misses),
+        )
+
+
+def load_package_cache_statistics() -> dict[str, CacheStatistics]:
+    """Return the package cache statistics for each installer"""
+    rows = _connection().execute("SELECT * FROM package_cache_statistics ORDER BY installer")
+    return {
+        row["installer"]: CacheStatistics(hits=row["hits"], misses=row["misses"]) for row in rows
+    }
+
+
+def reset_package_cache_statistics() -> None:
+    """Reset the package cache statistics"""
+    with transaction() as connection:
+        connection.execute("DELETE FROM package_cache_statistics")
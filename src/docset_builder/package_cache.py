@@ -0,0 +1,165 @@
+"""This module implements maintenance of the shared package cache
+
+The package cache holds the download and wheel caches of the installers, which are shared by all
+doc build virtual environments, as well as a wheelhouse of pre-built wheels. It is bounded in size
+by evicting the least recently used entries.
+
+"""
+import os
+import re
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from typing import Iterator, Sequence
+
+import structlog
+from attrs import define
+from click import ClickException
+from rich.console import Console
+from rich.table import Table
+
+from . import metadata_store
+from .directories import PACKAGE_CACHE_DIR, WHEELHOUSE_DIR
+
+LOG = structlog.get_logger(mod="pkgcache")
+
+# The packages of common doc toolchains, to pre-build wheels for
+COMMON_DOC_TOOLCHAIN_REQUIREMENTS = (
+    "sphinx",
+    "docutils",
+    "sphinx-rtd-theme",
+    "furo",
+    "pydata-sphinx-theme",
+    "sphinx-autodoc-typehints",
+    "sphinx-copybutton",
+    "myst-parser",
+    "numpydoc",
+)
+SIZE_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+@define
+class CacheEntry:
+    """An entry of the package cache that is evicted as a whole
+
+    Attributes:
+        path (Path): The path of the file or directory
+        size (int): The size in bytes
+        last_used (float): The time (seconds since the epoch) the entry was last used
+
+    """
+
+    path: Path
+    size: int
+    last_used: float
+
+
+def parse_size(size: str) -> int:
+    """Return the number of bytes in `size`, e.g. "500M" or "2GB" (powers of 1024)"""
+    if not (match := SIZE_RE.match(size)):
+        raise ClickException(f"Unable to parse size '{size}', expected e.g. 500M or 2G")
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.lower()])
+
+
+def iter_cache_entries(cache_dir: Path = PACKAGE_CACHE_DIR) -> Iterator[CacheEntry]:
+    """Return the entries of the package cache in `cache_dir`
+
+    Files are entries on their own, except for unpacked wheels in the uv cache, which are only
+    usable as a whole and are therefore entries as a whole.
+
+    """
+    for directory, dir_names, file_names in os.walk(cache_dir):
+        directory_path = Path(directory)
+        if directory_path.parent.name.startswith("archive-v"):
+            dir_names.clear()
+            yield _directory_entry(directory_path)
+            continue
+        for file_name in file_names:
+            path = directory_path / file_name
+            try:
+                stat = path.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            yield CacheEntry(
+                path=path, size=stat.st_size, last_used=max(stat.st_atime, stat.st_mtime)
+            )
+
+
+def _directory_entry(directory: Path) -> CacheEntry:
+    """Return a cache entry for all of `directory`"""
+    size = 0
+    last_used = 0.0
+    for sub_directory, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            try:
+                stat = os.stat(os.path.join(sub_directory, file_name), follow_symlinks=False)
+            except OSError:
+                continue
+            size += stat.st_size
+            last_used = max(last_used, stat.st_atime, stat.st_mtime)
+    return CacheEntry(path=directory, size=size, last_used=last_used)
+
+
+def prune_package_cache(max_size: int, cache_dir: Path = PACKAGE_CACHE_DIR) -> list[CacheEntry]:
+    """Evict the least recently used entries from the package cache until it fits in `max_size`
+
+    Returns the evicted entries.
+
+    """
+    entries = sorted(iter_cache_entries(cache_dir), key=lambda entry: entry.last_used)
+    total_size = sum(entry.size for entry in entries)
+    LOG.info("Prune package cache", size=total_size, max_size=max_size, entries=len(entries))
+
+    evicted = []
+    for entry in entries:
+        if total_size <= max_size:
+            break
+        if entry.path.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            entry.path.unlink(missing_ok=True)
+        total_size -= entry.size
+        evicted.append(entry)
+
+    LOG.info("Pruned package cache", size=total_size, evicted=len(evicted))
+    return evicted
+
+
+def build_wheelhouse(
+    requirements: Sequence[str] = COMMON_DOC_TOOLCHAIN_REQUIREMENTS,
+    wheelhouse_dir: Path = WHEELHOUSE_DIR,
+    cache_dir: Path = PACKAGE_CACHE_DIR,
+) -> None:
+    """Build wheels for `requirements` (and their dependencies) into `wheelhouse_dir`
+
+    The installers look for packages in the wheelhouse before the package index.
+
+    """
+    LOG.info("Build wheelhouse", requirements=requirements, wheelhouse_dir=wheelhouse_dir)
+    environment = dict(os.environ, PIP_CACHE_DIR=str(cache_dir / "pip"))
+    subprocess.check_call(
+        [sys.executable, "-m", "pip", "wheel", "--wheel-dir", str(wheelhouse_dir), *requirements],
+        env=environment,
+    )
+
+
+def print_package_cache_report(cache_dir: Path = PACKAGE_CACHE_DIR) -> None:
+    """Print the size of the package cache and the hit/miss statistics of each installer"""
+    total_size = sum(entry.size for entry in iter_cache_entries(cache_dir))
+    table = Table(title=f"Package cache: {cache_dir} ({total_size / 1024**2:.1f} MiB)")
+    table.add_column("Installer")
+    table.add_column("Hits", justify="right")
+    table.add_column("Misses", justify="right")
+    table.add_column("Hit rate", justify="right")
+    for installer, statistics in metadata_store.load_package_cache_statistics().items():
+        hit_rate = statistics.hit_rate
+        table.add_row(
+            installer,
+            str(statistics.hits),
+            str(statistics.misses),
+            "-" if hit_rate is None else f"{hit_rate:.0%}",
+        )
+    Console().print(table)
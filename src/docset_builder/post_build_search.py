@@ -1,17 +1,32 @@
 """This module implements the post-build search for built docs"""
 
 from pathlib import Path
-from typing import Generator
+from typing import Generator, Optional
 
 from click import ClickException
 
 from docset_builder.data_structures import DocBuildInfo
+from docset_builder.repository_index import RepositoryIndex, build_repository_index
 
 
-def _search_for_built_docs(docbuild_information: DocBuildInfo, local_repository: Path) -> Path:
+def _search_for_built_docs(
+    docbuild_information: DocBuildInfo,
+    local_repository: Path,
+    repository_index: Optional[RepositoryIndex] = None,
+    build_output_dir: Optional[Path] = None,
+) -> Path:
+    """Return the directory with the built docs
+
+    `build_output_dir`, the directory the build was directed to, if any, is used as is.
+
+    """
+    if build_output_dir is not None:
+        return build_output_dir
     subdir_patterns = (("_build", "html"),)
     for subdir_pattern in subdir_patterns:
-        for candidate in docs_potential_base_dirs(docbuild_information, local_repository):
+        for candidate in docs_potential_base_dirs(
+            docbuild_information, local_repository, repository_index
+        ):
             for dir_ in subdir_pattern:
                 candidate /= dir_
             if candidate.exists():
@@ -22,9 +37,17 @@ def _search_for_built_docs(docbuild_information: DocBuildInfo, local_repository:
 
 
 def docs_potential_base_dirs(
-    docbuild_information: DocBuildInfo, local_repository: Path
+    docbuild_information: DocBuildInfo,
+    local_repository: Path,
+    repository_index: Optional[RepositoryIndex] = None,
 ) -> Generator[Path, None, None]:
-    """Return a generator of potential docs build locations"""
+    """Return a generator of potential docs build locations
+
+    The fallback to all folders uses `repository_index`, which is only built, if not given, when
+    the fallback is reached. A pre-build index is fine, since the build output dirs are looked
+    for below the candidates.
+
+    """
     # First yield the basedir for building docs as a guess
     yield docbuild_information.basedir_for_building_docs
 
@@ -35,4 +58,6 @@ def docs_potential_base_dirs(
             yield guess
 
     # Then try all folders
-    yield from local_repository.rglob("")
+    if repository_index is None:
+        repository_index = build_repository_index(local_repository)
+    yield from repository_index.directories_under(local_repository)
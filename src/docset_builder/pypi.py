@@ -1,73 +1,276 @@
 """This module extracts information from PyPI"""
 
+import io
 import re
-from types import ModuleType
-from typing import Any, Dict, Protocol
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, Iterable, Iterator, Mapping, Optional, Protocol, Sequence
 
 import structlog
 import urllib3
+from attrs import evolve
 from click import ClickException
-from packaging import version
+from packaging import utils, version
 
-from docset_builder.cache import cache_pypi_info, load_pypi_info
-from docset_builder.data_structures import PyPIInfo
+from docset_builder import config, instrumentation
+from docset_builder.cache import cache_pypi_info, load_pypi_cache_entry
+from docset_builder.compat import ijson
+from docset_builder.data_structures import PyPICacheEntry, PyPIInfo
 from docset_builder.overrides import PYPI_OVERRIDES
 
 LOG = structlog.get_logger(mod="pypi")
-HTTP = urllib3.PoolManager()
 
+PYPI_BASE_URL = "https://pypi.org/pypi"
+PYPI_SIMPLE_BASE_URL = "https://pypi.org/simple"
+SIMPLE_API_JSON_CONTENT_TYPE = "application/vnd.pypi.simple.v1+json"
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_TIMEOUT = 30.0
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
 
 GITHUB_PROJECT_URL = r"^https:\/\/github\.com\/\w*?\/\w*?$"
 
 
-class LoadPyPIInfo(Protocol):
-    """Mypy function signature for load_pypi_info"""
+class LoadPyPICacheEntry(Protocol):
+    """Mypy function signature for load_pypi_cache_entry"""
 
-    def __call__(self, package_name: str) -> PyPIInfo:  # noqa
+    def __call__(self, package_name: str, api: str) -> Optional[PyPICacheEntry]:  # noqa
         ...
 
 
 class CachePyPIInfo(Protocol):
     """Mypy function signature for cache_pypi_info"""
 
-    def __call__(self, package_name: str, pypi_info: PyPIInfo) -> None:  # noqa
+    def __call__(  # noqa
+        self,
+        package_name: str,
+        pypi_info: PyPIInfo,
+        api: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
         ...
 
 
+def make_pool_manager(
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    retries: int = DEFAULT_RETRIES,
+    backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+    timeout: float = DEFAULT_TIMEOUT,
+) -> urllib3.PoolManager:
+    """Return a keep-alive connection pool for PyPI with retries, backoff and timeout
+
+    The pool holds (and blocks at) `max_concurrency` connections per host, so it can be shared
+    between that many threads without opening new connections for every request.
+
+    """
+    retry = urllib3.Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        # Return the last response instead of raising, so the status code can be reported
+        raise_on_status=False,
+    )
+    return urllib3.PoolManager(
+        maxsize=max_concurrency,
+        block=True,
+        retries=retry,
+        timeout=urllib3.Timeout(total=timeout),
+    )
+
+
+HTTP = make_pool_manager()
+
+
 def get_information_for_package(
     package_name: str,
     use_cache: bool = True,
-    _load_pypi_info: LoadPyPIInfo = load_pypi_info,
+    cache_ttl: Optional[float] = None,
+    use_simple_api: Optional[bool] = None,
+    _load_pypi_cache_entry: LoadPyPICacheEntry = load_pypi_cache_entry,
     _cache_pypi_info: CachePyPIInfo = cache_pypi_info,
-    _urllib3: ModuleType = urllib3,
+    _http: urllib3.PoolManager = HTTP,
+    _base_url: str = PYPI_BASE_URL,
+    _simple_base_url: str = PYPI_SIMPLE_BASE_URL,
 ) -> PyPIInfo:
-    """Return information extracted from PyPI"""
-    if use_cache and (pypi_info := _load_pypi_info(package_name=package_name)):
-        LOG.info("Return pypi info from cache", pypi_info=pypi_info)
-        return pypi_info
+    """Return information extracted from PyPI
 
-    pypi_info_url = f"https://pypi.org/pypi/{package_name}/json"
-    response = urllib3.request("GET", pypi_info_url)
-    if response.status != 200:
-        raise ClickException(
-            f"Unable to get information for '{package_name}' from PyPI. Attempted to get it at "
-            f"URL: {pypi_info_url}. Got error statue code {response.status}"
-        )
+    If `use_cache` is set, cached information younger than `cache_ttl` seconds (default from the
+    config) is returned as is. Older cached information is revalidated with a conditional request,
+    so an unchanged package costs a "304 Not Modified" instead of a full download.
 
-    pypi_info_json = response.json()
+    If only the latest release is needed, because the repository URL is already known from the
+    overrides, the much lighter Simple API (PEP 691) is used instead of the JSON API. Set
+    `use_simple_api` to force one or the other. The information is cached per API, as the
+    validators of one API do not apply to the other.
 
-    # Get possible overrides
-    pypi_info = PYPI_OVERRIDES.get(package_name, PyPIInfo())
-    pypi_info.package_name = package_name
+    """
+    # Get possible overrides. The overrides are shared, so work on a copy.
+    pypi_info = evolve(PYPI_OVERRIDES.get(package_name, PyPIInfo()), package_name=package_name)
     LOG.debug("PyPI overrides", pypi_info=pypi_info)
-    pypi_info = extract_information_from_pypi(pypi_info=pypi_info, pypi_info_json=pypi_info_json)
+    if use_simple_api is None:
+        use_simple_api = pypi_info.repository_url is not None
+    api = "simple" if use_simple_api else "json"
 
-    _cache_pypi_info(package_name=package_name, pypi_info=pypi_info)
+    cache_entry = _load_pypi_cache_entry(package_name=package_name, api=api) if use_cache else None
+    if cache_entry:
+        if cache_ttl is None:
+            cache_ttl = config.pypi_cache_ttl
+        if cache_entry.is_fresh(ttl=cache_ttl, now=time.time()):
+            LOG.info("Return pypi info from cache", pypi_info=cache_entry.pypi_info)
+            instrumentation.count_hit("pypi", hit=True)
+            return cache_entry.pypi_info
+
+    headers = cache_entry.conditional_request_headers() if cache_entry else {}
+    if use_simple_api:
+        url = f"{_simple_base_url}/{package_name}/"
+        headers["Accept"] = SIMPLE_API_JSON_CONTENT_TYPE
+    else:
+        url = f"{_base_url}/{package_name}/json"
+    response = _request_pypi_json(package_name, url=url, http=_http, headers=headers)
+    try:
+        if response.status == 304 and cache_entry:
+            LOG.info("PyPI info not modified, return from cache", pypi_info=cache_entry.pypi_info)
+            instrumentation.count_hit("pypi", hit=True)
+            _cache_pypi_info(
+                package_name=package_name,
+                pypi_info=cache_entry.pypi_info,
+                api=api,
+                etag=cache_entry.etag,
+                last_modified=cache_entry.last_modified,
+            )
+            return cache_entry.pypi_info
+
+        instrumentation.count_hit("pypi", hit=False)
+        if use_simple_api:
+            pypi_info = extract_information_from_simple_api(
+                pypi_info=pypi_info, simple_api_json=response.json()
+            )
+        elif ijson is not None:
+            pypi_info = extract_information_from_pypi_stream(pypi_info=pypi_info, stream=response)
+        else:
+            pypi_info = extract_information_from_pypi(
+                pypi_info=pypi_info, pypi_info_json=response.json()
+            )
+    finally:
+        _release_connection(response)
+
+    _cache_pypi_info(
+        package_name=package_name,
+        pypi_info=pypi_info,
+        api=api,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
     LOG.debug("PyPI info assembled and cached")
 
     return pypi_info
 
 
+def get_information_for_packages(
+    package_names: Sequence[str],
+    use_cache: bool = True,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    retries: int = DEFAULT_RETRIES,
+    backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+    timeout: float = DEFAULT_TIMEOUT,
+    cache_ttl: Optional[float] = None,
+    use_simple_api: Optional[bool] = None,
+    errors: Optional[dict[str, str]] = None,
+    _load_pypi_cache_entry: LoadPyPICacheEntry = load_pypi_cache_entry,
+    _cache_pypi_info: CachePyPIInfo = cache_pypi_info,
+    _http: Optional[urllib3.PoolManager] = None,
+    _base_url: str = PYPI_BASE_URL,
+    _simple_base_url: str = PYPI_SIMPLE_BASE_URL,
+) -> dict[str, PyPIInfo]:
+    """Return information extracted from PyPI for all of `package_names`
+
+    The information is fetched concurrently by `max_concurrency` workers sharing one keep-alive
+    connection pool. Packages for which the information could not be fetched, for whatever
+    reason, are logged and left out of the returned dict, so the caller can decide how to handle
+    them individually. If `errors` is given, the error message for each of them is put in it.
+
+    """
+    if _http is None:
+        _http = make_pool_manager(
+            max_concurrency=max_concurrency,
+            retries=retries,
+            backoff_factor=backoff_factor,
+            timeout=timeout,
+        )
+    get_information = partial(
+        get_information_for_package,
+        use_cache=use_cache,
+        cache_ttl=cache_ttl,
+        use_simple_api=use_simple_api,
+        _load_pypi_cache_entry=_load_pypi_cache_entry,
+        _cache_pypi_info=_cache_pypi_info,
+        _http=_http,
+        _base_url=_base_url,
+        _simple_base_url=_simple_base_url,
+    )
+
+    LOG.info("Get PyPI info for packages", package_names=package_names)
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="pypi") as executor:
+        futures = {
+            package_name: executor.submit(get_information, package_name)
+            for package_name in package_names
+        }
+
+    pypi_infos = {}
+    for package_name, future in futures.items():
+        try:
+            pypi_infos[package_name] = future.result()
+        except ClickException as exception:
+            error = exception.format_message()
+        except Exception as exception:
+            # E.g. a malformed document, which must not stop the other packages
+            error = f"{exception.__class__.__name__}: {exception}"
+        else:
+            continue
+        LOG.error("Unable to get PyPI info", package_name=package_name, error=error)
+        if errors is not None:
+            errors[package_name] = error
+    return pypi_infos
+
+
+def _request_pypi_json(
+    package_name: str, url: str, http: urllib3.PoolManager, headers: Mapping[str, str]
+) -> urllib3.BaseHTTPResponse:
+    """Return the (not yet read) response for the PyPI JSON document for `package_name` at `url`
+
+    The response is either a "200 OK" or, if `headers` makes it a conditional request, possibly a
+    "304 Not Modified". The caller must release the connection with `_release_connection` once
+    done with the response, also on errors, since the connection pool blocks when exhausted.
+
+    """
+    try:
+        response = http.request("GET", url, headers=headers, preload_content=False)
+    except urllib3.exceptions.HTTPError as exception:
+        raise ClickException(
+            f"Unable to get information for '{package_name}' from PyPI. Attempted to get it at "
+            f"URL: {url}. Got error: {exception}"
+        )
+
+    if response.status not in (200, 304):
+        _release_connection(response)
+        raise ClickException(
+            f"Unable to get information for '{package_name}' from PyPI. Attempted to get it at "
+            f"URL: {url}. Got error statue code {response.status}"
+        )
+
+    return response
+
+
+def _release_connection(response: urllib3.BaseHTTPResponse) -> None:
+    """Read what is left of `response` and give its connection back to the pool"""
+    # A connection with unread data in it cannot be reused
+    response.drain_conn()
+    response.release_conn()
+
+
 def is_repository_url(repository_url: str) -> bool:
     """Check whether a URL is a git cloneable link"""
     # As a quick hack, for now, just check if the URL has the structure of a GitHub project
@@ -76,11 +279,65 @@ def is_repository_url(repository_url: str) -> bool:
 
 def extract_information_from_pypi(pypi_info: PyPIInfo, pypi_info_json: Dict[str, Any]) -> PyPIInfo:
     """Return new `pypi_info` with information extract from PyPI `response`"""
+    project_urls = pypi_info_json.get("info", {}).get("project_urls") or {}
+    latest_release = None
+    if pypi_info.latest_release is None:
+        releases = pypi_info_json.get("releases", {})
+        latest_release = find_latest_release(
+            (release, _all_files_yanked(files)) for release, files in releases.items()
+        )
+    return _add_information(pypi_info, project_urls, latest_release)
+
+
+def extract_information_from_pypi_stream(pypi_info: PyPIInfo, stream: io.IOBase) -> PyPIInfo:
+    """Return new `pypi_info` with information extracted incrementally from PyPI JSON `stream`
+
+    Only the project URLs and, per release, whether all its files are yanked are pulled out of the
+    document, so the (potentially huge) releases map is never materialized.
+
+    """
+    project_urls: dict[str, str] = {}
+    latest_release = find_latest_release(_iter_releases(ijson.parse(stream), project_urls))
+    return _add_information(pypi_info, project_urls, latest_release)
+
+
+def extract_information_from_simple_api(
+    pypi_info: PyPIInfo, simple_api_json: Dict[str, Any]
+) -> PyPIInfo:
+    """Return new `pypi_info` with the latest release added from a PEP 691 Simple API document"""
+    if pypi_info.latest_release is not None:
+        return pypi_info
+
+    # Versions for which at least one file is not yanked
+    available_versions = set()
+    for file_ in simple_api_json.get("files", []):
+        if file_.get("yanked"):
+            continue
+        try:
+            if file_["filename"].endswith(".whl"):
+                available_versions.add(utils.parse_wheel_filename(file_["filename"])[1])
+            else:
+                available_versions.add(utils.parse_sdist_filename(file_["filename"])[1])
+        except (utils.InvalidWheelFilename, utils.InvalidSdistFilename):
+            continue
+
+    # The "versions" key (PEP 700) also lists versions for which no file names could be parsed
+    latest_release = find_latest_release(
+        (release, _parse_version(release) not in available_versions)
+        for release in simple_api_json.get("versions", [])
+    )
+    return _add_information(pypi_info, {}, latest_release)
+
+
+def _add_information(
+    pypi_info: PyPIInfo, project_urls: Mapping[str, str], latest_release: Optional[str]
+) -> PyPIInfo:
+    """Return `pypi_info` with the repository URL from `project_urls` and the `latest_release`"""
     # Extract repository url
     if pypi_info.repository_url is None:
         for key in ("Repository", "Source Code", "Source", "Homepage"):
             try:
-                repository_url = pypi_info_json["info"]["project_urls"][key]
+                repository_url = project_urls[key]
             except KeyError:
                 continue
 
@@ -91,20 +348,71 @@ def extract_information_from_pypi(pypi_info: PyPIInfo, pypi_info_json: Dict[str,
             LOG.debug("Added repository url", key=key, repository_url=repository_url)
             break
 
-    # Extract latest release
-    if pypi_info.latest_release is None:
-        try:
-            releases = tuple(pypi_info_json["releases"].keys())
-        except KeyError:
-            releases = ()
-        sorted_releases = sorted(releases, key=version.parse)
-
-        try:
-            latest_release = sorted_releases[-1]
-        except IndexError:
-            pass
-        else:
-            LOG.debug("Added latest release", latest_release=latest_release)
-            pypi_info.latest_release = latest_release
+    # Add latest release
+    if pypi_info.latest_release is None and latest_release is not None:
+        LOG.debug("Added latest release", latest_release=latest_release)
+        pypi_info.latest_release = latest_release
 
     return pypi_info
+
+
+def find_latest_release(releases: Iterable[tuple[str, bool]]) -> Optional[str]:
+    """Return the latest of `releases`, given as (release, yanked) pairs, in a single pass
+
+    Yanked releases and releases that are not valid versions are skipped. Pre- and development
+    releases are only considered if there are no final releases.
+
+    """
+    latest: Optional[tuple[version.Version, str]] = None
+    latest_prerelease: Optional[tuple[version.Version, str]] = None
+    for release, yanked in releases:
+        if yanked or (parsed := _parse_version(release)) is None:
+            continue
+        if parsed.is_prerelease:
+            if latest_prerelease is None or parsed > latest_prerelease[0]:
+                latest_prerelease = (parsed, release)
+        elif latest is None or parsed > latest[0]:
+            latest = (parsed, release)
+
+    if latest := latest or latest_prerelease:
+        return latest[1]
+    return None
+
+
+def _parse_version(release: str) -> Optional[version.Version]:
+    """Return `release` parsed as a version or None if it is not a valid version"""
+    try:
+        return version.Version(release)
+    except version.InvalidVersion:
+        return None
+
+
+def _all_files_yanked(files: Iterable[Mapping[str, Any]]) -> bool:
+    """Return whether all of the release `files` are yanked (and there is at least one)"""
+    yanked = None
+    for file_ in files:
+        yanked = bool(file_.get("yanked")) and yanked is not False
+    return bool(yanked)
+
+
+def _iter_releases(
+    events: Iterable[tuple[str, str, Any]], project_urls: dict[str, str]
+) -> Iterator[tuple[str, bool]]:
+    """Return an iterator of (release, yanked) pairs from the ijson parse `events`
+
+    As a side effect, the project URLs encountered along the way are added to `project_urls`.
+
+    """
+    release = None
+    yanked_prefix = None
+    all_yanked: Optional[bool] = None
+    for prefix, event, value in events:
+        if prefix == "releases":
+            if event in ("map_key", "end_map") and release is not None:
+                yield release, bool(all_yanked)
+            if event == "map_key":
+                release, yanked_prefix, all_yanked = value, f"releases.{value}.item.yanked", None
+        elif prefix == yanked_prefix:
+            all_yanked = bool(value) and all_yanked is not False
+        elif prefix.startswith("info.project_urls.") and event == "string":
+            project_urls[prefix.removeprefix("info.project_urls.")] = value
@@ -3,29 +3,59 @@ import re
 import subprocess
 from functools import partial
 from pathlib import Path
-from typing import Callable, cast
+from typing import Callable, Iterable, Optional, cast
 
 import structlog
+from packaging import version
 from structlog import BoundLogger
 
+from . import metadata_store
 from .data_structures import PyPIInfo
-from .directories import REPOSITORIES_DIR
+from .directories import REPOSITORIES_DIR, ensure_dir
 
 LOG = structlog.get_logger(mod="repos")
+# A package name or "release" prefix in tags like "attrs-23.1.0" or "release_1.0"
+TAG_PREFIX_RE = re.compile(r"^[A-Za-z][\w.]*?[-_/](?=v?\d)")
 
 
-def clone_or_update(name: str, pypi_info: PyPIInfo) -> tuple[Path, str]:
-    """Clone of update the package repository"""
+def clone_or_update(name: str, pypi_info: PyPIInfo, shallow: bool = True) -> tuple[Path, str]:
+    """Clone of update the package repository
+
+    If `shallow` is True, only the tag of the latest release is fetched, if it can be found. See
+    `update_repository`.
+
+    """
     logger = LOG.bind(name=name)
     logger.info("Clone and/or update")
 
     repository_dir = REPOSITORIES_DIR / name
     if not repository_dir.exists():
         _clone_repository(repository_dir, pypi_info, logger)
-    checked_out_tag = update_repository(repository_dir, logger)
+    checked_out_tag = update_repository(
+        repository_dir, logger, release=pypi_info.latest_release, shallow=shallow
+    )
+    metadata_store.record_checkout(
+        name, tag=checked_out_tag, commit_hash=current_commit_hash(repository_dir)
+    )
     return repository_dir, checked_out_tag
 
 
+def current_commit_hash(repository_dir: Path) -> str:
+    """Return the hash of the commit checked out in `repository_dir`"""
+    commit_hash = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repository_dir)
+    return commit_hash.decode("utf-8").strip()
+
+
+def current_tree_hash(repository_dir: Path) -> str:
+    """Return the hash of the tree of the commit checked out in `repository_dir`
+
+    Unlike the commit hash, this is the same for two commits with identical content.
+
+    """
+    tree_hash = subprocess.check_output(["git", "rev-parse", "HEAD^{tree}"], cwd=repository_dir)
+    return tree_hash.decode("utf-8").strip()
+
+
 def _clone_repository(repository_dir: Path, pypi_info: PyPIInfo, _logger: BoundLogger) -> None:
     """Clone the repository"""
     _logger.info("Clone", dir=repository_dir)
@@ -36,14 +66,30 @@ def _clone_repository(repository_dir: Path, pypi_info: PyPIInfo, _logger: BoundL
         # https://stackoverflow.com/questions/2144406/how-to-make-shallow-git-submodules/47374702#47374702
         # so for now, don't do them
         ["git", "clone", "--recurse-submodules", "--filter=blob:none", pypi_info.repository_url],
-        cwd=repository_dir.parent,
+        cwd=ensure_dir(repository_dir.parent),
     )
     result.check_returncode()
 
 
-def update_repository(repository_dir: Path, _logger: BoundLogger) -> str:
-    """Update the repository at `repository_dir`"""
-    _logger.info("Update", repoitory_dir=repository_dir)
+def update_repository(
+    repository_dir: Path,
+    _logger: BoundLogger,
+    release: Optional[str] = None,
+    shallow: bool = True,
+) -> str:
+    """Update the repository at `repository_dir` and check out the last release
+
+    If `shallow` is True, `release` is given and a tag for it exists upstream, only that tag is
+    fetched (without blobs, which keeps it small) and checked out. Otherwise, the primary branch
+    is updated in full and the tag selected by `select_release_tag` is checked out.
+
+    """
+    _logger.info("Update", repoitory_dir=repository_dir, release=release, shallow=shallow)
+    if shallow and release is not None:
+        if tag := _fetch_release_tag(repository_dir, release, _logger):
+            return tag
+        _logger.info("Unable to fetch tag for release; update in full", release=release)
+
     run = partial(subprocess.run, cwd=repository_dir)
     silent_run = partial(run, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     check_output = cast(
@@ -77,15 +123,12 @@ def update_repository(repository_dir: Path, _logger: BoundLogger) -> str:
     result.check_returncode()
 
     # Check out last release
-    tags_raw = check_output(["git", "tag"])
-    tags = reversed(tags_raw.decode("utf-8").strip().split())
-    for tag in tags:
-        if is_version_like(tag, _logger):
-            _logger.debug("Found last release tag, now check it out", tag=tag)
-            break
-    else:
+    tags_raw = check_output(["git", "for-each-ref", "--format=%(refname:strip=2)", "refs/tags"])
+    tag = select_release_tag(tags_raw.decode("utf-8").split(), release=release)
+    if tag is None:
         _logger.info("UNABLE TO FIND RELEASE TAG; PROCEED WITH HEAD")
         return "HEAD"
+    _logger.debug("Found last release tag, now check it out", tag=tag)
 
     result = silent_run(["git", "checkout", tag])
     result.check_returncode()
@@ -95,13 +138,121 @@ def update_repository(repository_dir: Path, _logger: BoundLogger) -> str:
     return tag
 
 
-def is_version_like(tag: str, _logger: BoundLogger) -> bool:
-    """Return whether `tag` looks like a version"""
-    for regular_expression in (r"^v\d.*$", r"^\d*?\.\d*.*?\d*?$"):
-        if re.match(regular_expression, tag):
-            _logger.info("Matched release tag", re=regular_expression, tag=tag)
-            return True
-    return False
+def _fetch_release_tag(repository_dir: Path, release: str, _logger: BoundLogger) -> Optional[str]:
+    """Fetch and check out the upstream tag for `release`, return the tag or None if not found"""
+    try:
+        remote_tags = _list_remote_tags(repository_dir)
+    except subprocess.CalledProcessError as exception:
+        _logger.warning("Unable to list upstream tags", error=str(exception))
+        return None
+    if (tag := _find_release_tag(list(remote_tags), release)) is None:
+        return None
+    _logger.debug("Found release tag upstream", tag=tag, commit_hash=remote_tags[tag])
+
+    # The tag may already have been fetched, e.g. if the release hasn't changed since last update
+    local_commit_hash = subprocess.run(
+        ["git", "rev-parse", "--quiet", "--verify", f"refs/tags/{tag}^{{commit}}"],
+        cwd=repository_dir,
+        stdout=subprocess.PIPE,
+    ).stdout.decode("utf-8")
+    if local_commit_hash.strip() != remote_tags[tag]:
+        _logger.info("Fetch release tag", tag=tag)
+        subprocess.run(
+            [
+                "git",
+                "fetch",
+                "--filter=blob:none",
+                "--no-tags",
+                "--force",
+                "origin",
+                f"refs/tags/{tag}:refs/tags/{tag}",
+            ],
+            cwd=repository_dir,
+        ).check_returncode()
+
+    silent_run = partial(
+        subprocess.run, cwd=repository_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    silent_run(["git", "checkout", "--force", tag]).check_returncode()
+    silent_run(["git", "submodule", "update"]).check_returncode()
+    return tag
+
+
+def _list_remote_tags(repository_dir: Path) -> dict[str, str]:
+    """Return the tags on origin, mapped to the hashes of the commits they point to"""
+    ls_remote_output = subprocess.check_output(
+        ["git", "ls-remote", "--tags", "origin"], cwd=repository_dir
+    )
+    remote_tags = {}
+    for line in ls_remote_output.decode("utf-8").splitlines():
+        commit_hash, _, ref = line.partition("\t")
+        tag = ref.removeprefix("refs/tags/")
+        # Annotated tags are listed twice, the second time peeled to the commit, e.g. v1.0^{}
+        if tag.endswith("^{}"):
+            remote_tags[tag.removesuffix("^{}")] = commit_hash
+        else:
+            remote_tags.setdefault(tag, commit_hash)
+    return remote_tags
+
+
+def select_release_tag(
+    tags: Iterable[str], release: Optional[str] = None, allow_prereleases: bool = False
+) -> Optional[str]:
+    """Return the tag among `tags` to build docs from or None if there is no release tag
+
+    The tag for `release` is preferred, if given and present. Otherwise the tag of the highest
+    version is returned, excluding pre- and development releases unless `allow_prereleases` is set.
+
+    """
+    tags = list(tags)
+    if release is not None and (tag := _find_release_tag(tags, release)):
+        return tag
+
+    selected_tag, selected_version = None, None
+    for tag in tags:
+        tag_version = _tag_version(tag)
+        if tag_version is None:
+            continue
+        if not allow_prereleases and (tag_version.is_prerelease or tag_version.is_devrelease):
+            continue
+        if selected_version is None or tag_version > selected_version:
+            selected_tag, selected_version = tag, tag_version
+    return selected_tag
+
+
+def _find_release_tag(tags: list[str], release: str) -> Optional[str]:
+    """Return the tag among `tags` for the release `release` or None if there is none
+
+    Tags are compared to the release both verbatim and as versions.
+
+    """
+    for candidate in (release, f"v{release}"):
+        if candidate in tags:
+            return candidate
+
+    try:
+        release_version = version.Version(release)
+    except version.InvalidVersion:
+        return None
+    for tag in tags:
+        if _tag_version(tag) == release_version:
+            return tag
+    return None
+
+
+def _tag_version(tag: str) -> Optional[version.Version]:
+    """Return the version in `tag` or None if it does not hold a version
+
+    A prefix of letters (and digits, dots or underscores) that ends in "-", "_" or "/" and is
+    followed by the version, like "attrs-", "release_" or "pkg/", is stripped as per
+    `TAG_PREFIX_RE`. A leading "v" on the version itself, like in "v1.0" or "attrs-v1.0", is
+    ignored by the version parsing.
+
+    """
+    try:
+        return version.Version(TAG_PREFIX_RE.sub("", tag, count=1))
+    except version.InvalidVersion:
+        return None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,137 @@
+"""This module implements an in-memory index of the files in a repository
+
+The index is built with a single walk of the checkout and is then shared by all the heuristics
+that search the repository, which saves walking large repositories over and over again.
+
+"""
+import os
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Iterator, Optional
+
+import structlog
+from attrs import define, field
+
+LOG = structlog.get_logger(mod="repoindex")
+
+# Directories that never contain anything of interest for building docs
+PRUNED_DIR_NAMES = frozenset(
+    (
+        ".git",
+        ".hg",
+        ".svn",
+        ".tox",
+        ".nox",
+        ".mypy_cache",
+        ".pytest_cache",
+        ".ruff_cache",
+        "__pycache__",
+        "node_modules",
+    )
+)
+
+
+@define(frozen=True)
+class RepositoryIndex:
+    """Index of the files and directories in a repository
+
+    Attributes:
+        root (Path): The root of the repository
+        files (tuple[Path]): All the files in the repository, in walk order (the files of a
+            directory, then each of its sub directories in turn, sorted by name)
+        directories (tuple[Path]): All the directories in the repository, including `root`, in
+            walk order
+
+    """
+
+    root: Path
+    files: tuple[Path, ...]
+    directories: tuple[Path, ...]
+    _files_by_name: dict[str, list[Path]] = field(init=False, eq=False, repr=False)
+
+    def __attrs_post_init__(self) -> None:
+        """Index the files by name"""
+        files_by_name: dict[str, list[Path]] = {}
+        for file_ in self.files:
+            files_by_name.setdefault(file_.name, []).append(file_)
+        object.__setattr__(self, "_files_by_name", files_by_name)
+
+    def with_name(self, name: str) -> list[Path]:
+        """Return all files named `name`"""
+        return self._files_by_name.get(name, [])
+
+    def with_suffix(self, suffix: str, start: Optional[Path] = None) -> Iterator[Path]:
+        """Return the files (under `start`, if given) with the file extension `suffix`"""
+        return (file_ for file_ in self._files_under(start) if file_.suffix == suffix)
+
+    def rglob(self, pattern: str, start: Optional[Path] = None) -> Iterator[Path]:
+        """Return the files (under `start`, if given) whose name matches the glob `pattern`
+
+        Like `Path.rglob` for a pattern without directory separators, except only files are
+        returned.
+
+        """
+        return (file_ for file_ in self._files_under(start) if fnmatchcase(file_.name, pattern))
+
+    def glob(self, pattern: str, directory: Path) -> Iterator[Path]:
+        """Return the files directly in `directory` whose name matches the glob `pattern`"""
+        return (
+            file_
+            for file_ in self.files
+            if file_.parent == directory and fnmatchcase(file_.name, pattern)
+        )
+
+    def directories_under(self, start: Optional[Path] = None) -> Iterator[Path]:
+        """Return the directories under (and including) `start`, if given"""
+        if start is None:
+            return iter(self.directories)
+        return (dir_ for dir_ in self.directories if dir_ == start or start in dir_.parents)
+
+    def _files_under(self, start: Optional[Path]) -> Iterator[Path]:
+        """Return the files under `start` or all files if `start` is None"""
+        if start is None:
+            return iter(self.files)
+        return (file_ for file_ in self.files if start in file_.parents)
+
+
+def build_repository_index(repository_path: Path) -> RepositoryIndex:
+    """Return an index of `repository_path` built with a single pruned walk
+
+    Directories in `PRUNED_DIR_NAMES` and virtual environments are not descended into and
+    symbolic links to directories are not followed.
+
+    """
+    files: list[Path] = []
+    directories: list[Path] = []
+    stack = [repository_path]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as iterator:
+                entries = sorted(iterator, key=lambda entry: entry.name)
+        except OSError:
+            LOG.warning("Unable to scan directory", directory=directory)
+            continue
+
+        # Virtual environments are recognized by their pyvenv.cfg file
+        if directory != repository_path and any(e.name == "pyvenv.cfg" for e in entries):
+            continue
+        directories.append(directory)
+
+        sub_directories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in PRUNED_DIR_NAMES:
+                    sub_directories.append(directory / entry.name)
+            else:
+                files.append(directory / entry.name)
+        # Reversed, so the sub directories are popped off the stack in sorted order
+        stack.extend(reversed(sub_directories))
+
+    LOG.debug(
+        "Built repository index",
+        repository_path=repository_path,
+        files=len(files),
+        directories=len(directories),
+    )
+    return RepositoryIndex(root=repository_path, files=tuple(files), directories=tuple(directories))
@@ -1,51 +1,102 @@
 """This module implements searching the repository for doc build information"""
 import configparser
+import hashlib
 import itertools
+import json
+import re
 from pathlib import Path
-from typing import Generator
+from typing import Generator, Optional
 
 import structlog
 import toml
+from attrs import evolve
 
-from .data_structures import DocBuildInfo
+from . import instrumentation, metadata_store
+from .data_structures import BUILD_JOBS_PLACEHOLDER, DocBuildInfo
+from .icons import find_icon
 from .overrides import DOC_BUILD_INFO_OVERRIDES
+from .repository_index import RepositoryIndex, build_repository_index
 from .utils import extract_sections_from_makefile
 
 LOG = structlog.get_logger(mod="reposearch")
-ICON_NAME_CANDIDATES = ("favicon.png",)
+# Bump this whenever the heuristics change, to invalidate the cached docbuild information
+HEURISTICS_VERSION = 3
+# A sphinx-build command in a tox env, which is passed the positional arguments
+TOX_SPHINX_POSARGS_RE = re.compile(r"sphinx-build[^\n]*\{posargs\}")
+# The Makefile targets whose commands (in this order) build the docs
+MAKEFILE_DOC_TARGETS = ("docs-init", "docs")
+
+
+def _add_icon_file(repository_index: RepositoryIndex, docbuild_info: DocBuildInfo) -> DocBuildInfo:
+    """Return a `docbuild_info` with the best icon candidate in the repository added, if any"""
+    if icon_path := find_icon(repository_index):
+        docbuild_info.icon_path = icon_path
+    return docbuild_info
 
 
-def _add_icon_file(repository_path: Path, docbuild_info: DocBuildInfo) -> DocBuildInfo:
-    start_paths = [
-        repository_path / p
-        for p in ("doc", "docs")
-        if (repository_path / p).exists() and (repository_path / p).is_dir()
-    ]
-    start_paths.append(repository_path)
+def get_docbuild_information(
+    name: str,
+    repository_path: Path,
+    repository_index: Optional[RepositoryIndex] = None,
+    tree_hash: Optional[str] = None,
+    use_cache: bool = True,
+) -> DocBuildInfo:
+    """Return docbuild information
 
-    # Break-else-continue-break-else is ugly ass Python for break out of two loops
-    for start_path in start_paths:
-        for file_ in start_path.rglob("*"):
-            if file_.name.lower() in ICON_NAME_CANDIDATES:
-                break
-        else:
-            continue
-        break
-    else:
-        return docbuild_info
-    docbuild_info.icon_path = file_
-    return docbuild_info
+    If the `tree_hash` of the checked out commit is given, the result is cached under a key made
+    from it, the overrides and the heuristics version, so an unchanged repository skips the search
+    entirely next time (unless `use_cache` is False).
 
+    All heuristics search the repository through `repository_index`, which is built here if it
+    is not given.
 
-def get_docbuild_information(name: str, repository_path: Path) -> DocBuildInfo:
-    """Return docbuild information"""
+    """
     LOG.info("Get docbuild information", name=name, repository_path=repository_path)
-    docbuild_info = DOC_BUILD_INFO_OVERRIDES.get(name, DocBuildInfo())
+    overrides = DOC_BUILD_INFO_OVERRIDES.get(name, DocBuildInfo())
+
+    cache_key = _docbuild_info_cache_key(name, overrides, tree_hash) if tree_hash else None
+    if cache_key and use_cache:
+        if docbuild_info := metadata_store.load_cached_docbuild_info(cache_key):
+            LOG.info("docbuild information cache hit", name=name, cache_key=cache_key)
+            instrumentation.count_hit("docbuild_info", hit=True)
+            return docbuild_info
+        LOG.info("docbuild information cache miss", name=name, cache_key=cache_key)
+        instrumentation.count_hit("docbuild_info", hit=False)
+
+    if repository_index is None:
+        repository_index = build_repository_index(repository_path)
+    docbuild_info = _search_for_docbuild_information(
+        name, repository_path, repository_index, overrides
+    )
+
+    if cache_key:
+        metadata_store.store_cached_docbuild_info(cache_key, name, docbuild_info)
+    return docbuild_info
+
+
+def _docbuild_info_cache_key(name: str, overrides: DocBuildInfo, tree_hash: str) -> str:
+    """Return the docbuild information cache key for `name` at `tree_hash` with `overrides`"""
+    key_data = {
+        "name": name,
+        "tree_hash": tree_hash,
+        "overrides": overrides.to_dict(),
+        "heuristics_version": HEURISTICS_VERSION,
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _search_for_docbuild_information(
+    name: str, repository_path: Path, repository_index: RepositoryIndex, overrides: DocBuildInfo
+) -> DocBuildInfo:
+    """Return docbuild information found by searching the repository"""
+    # The overrides are shared, so work on a copy
+    docbuild_info = evolve(overrides)
     with docbuild_info.set_source("CLI"):
         docbuild_info.package_name = name
     LOG.debug("Got overrides", docbuild_info=docbuild_info)
 
-    docbuild_info = _add_all_requirements(docbuild_info, repository_path)
+    with docbuild_info.set_source("Requirements files"):
+        docbuild_info = _add_all_requirements(docbuild_info, repository_index)
 
     tox_ini_path = repository_path / "tox.ini"
     if tox_ini_path.exists():
@@ -68,7 +119,9 @@ def get_docbuild_information(name: str, repository_path: Path) -> DocBuildInfo:
             repository_path=repository_path, docbuild_info=docbuild_info
         )
     with docbuild_info.set_source("Icon file"):
-        docbuild_info = _add_icon_file(repository_path=repository_path, docbuild_info=docbuild_info)
+        docbuild_info = _add_icon_file(
+            repository_index=repository_index, docbuild_info=docbuild_info
+        )
 
     # docbuild_info = _look_for_docs_dir(repository_path=repository_path,
     # docbuild_info=docbuild_info)
@@ -113,6 +166,9 @@ def _extract_from_tox_ini(docbuild_info: DocBuildInfo, tox_ini_path: Path) -> Do
         else:
             tox_env_name = section
         commands = [f"tox -e {tox_env_name}"]
+        # If the positional arguments are passed on to sphinx-build, use them for parallelism
+        if TOX_SPHINX_POSARGS_RE.search(doc_section.get("commands", "")):
+            commands = [f"tox -e {tox_env_name} -- -j {BUILD_JOBS_PLACEHOLDER}"]
         logger.debug("Add commands", commands=commands)
         docbuild_info.doc_build_commands = commands
 
@@ -153,9 +209,14 @@ def _extract_from_makefile(
     docbuild_info: DocBuildInfo, make_file_path: Path, repository_path: Path
 ) -> DocBuildInfo:
     logger = LOG.bind(source="Makefile")
-    sections = extract_sections_from_makefile(make_file_path)
+    try:
+        sections = extract_sections_from_makefile(make_file_path, targets=MAKEFILE_DOC_TARGETS)
+    except ValueError as exception:
+        # E.g. a conditional that calls a function, which cannot be evaluated without make
+        logger.warning("Unable to parse Makefile", error=str(exception))
+        return docbuild_info
     commands = []
-    for section_name in ("docs-init", "docs"):
+    for section_name in MAKEFILE_DOC_TARGETS:
         commands += sections.get(section_name, [])
 
     # Update doc build dependencies
@@ -174,15 +235,21 @@ def _extract_from_makefile(
     return docbuild_info
 
 
-def _add_all_requirements(doc_build_info: DocBuildInfo, repository_path: Path) -> DocBuildInfo:
+def _add_all_requirements(
+    doc_build_info: DocBuildInfo, repository_index: RepositoryIndex
+) -> DocBuildInfo:
     """Add all requirements from requirements files, is requirements are missing"""
     if doc_build_info.all_deps:
         return doc_build_info
 
+    repository_path = repository_index.root
     all_dependencies = []
-    all_requirements_files = itertools.chain(
-        repository_path.rglob("*requirements*.txt"),
-        (repository_path / "requirements").glob("*.txt"),
+    # dict.fromkeys removes the files matched by both patterns, while keeping the order
+    all_requirements_files = dict.fromkeys(
+        itertools.chain(
+            repository_index.rglob("*requirements*.txt"),
+            repository_index.glob("*.txt", directory=repository_path / "requirements"),
+        )
     )
     for file_path in all_requirements_files:
         for requirement in _requirements_from_file(file_path):
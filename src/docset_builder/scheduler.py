@@ -0,0 +1,165 @@
+"""This module implements running the per-package install pipelines on a bounded scheduler
+
+Each package is processed by an independent pipeline (PyPI, clone/update, search, build, docset,
+install), which is run as a task in a thread pool with `jobs` workers. On top of the number of
+workers, each stage of the pipeline has its own concurrency limit, so that e.g. many packages can
+be fetching from the network at the same time, while only a few are running CPU heavy doc builds.
+
+"""
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator, Mapping, Optional, Protocol, Sequence
+
+import structlog
+from click import ClickException
+from rich.console import Console
+from rich.table import Table
+
+from .compat import TypeAlias
+from .data_structures import PackageResult
+
+LOG = structlog.get_logger(mod="scheduler")
+
+# The default upper limit on how many packages may be in each of the stages at the same time.
+# Network bound stages get many slots, CPU heavy ones only a few, and the installation into the
+# docset library is serialized.
+DEFAULT_STAGE_LIMITS: Mapping[str, int] = {
+    "pypi": 16,
+    "repository": 8,
+    "search": 4,
+    "build": 2,
+    "docset": 2,
+    "install": 1,
+}
+
+StageLimits: TypeAlias = Mapping[str, threading.BoundedSemaphore]
+
+
+class Pipeline(Protocol):
+    """Mypy function signature for the per-package pipeline
+
+    The pipeline may return a note about the outcome, e.g. that the package was skipped.
+
+    """
+
+    def __call__(self, package_name: str, stage_limits: StageLimits) -> Optional[str]:  # noqa
+        ...
+
+
+def resolve_stage_limits(
+    jobs: int, stage_limit_overrides: Optional[Mapping[str, int]] = None
+) -> dict[str, int]:
+    """Return the concurrency limit of each stage when running with `jobs` workers
+
+    No stage limit exceeds the number of workers, so `jobs=1` means fully sequential.
+
+    """
+    limits = dict(DEFAULT_STAGE_LIMITS)
+    for stage_name, limit in (stage_limit_overrides or {}).items():
+        if stage_name not in limits:
+            raise ClickException(
+                f"Unknown pipeline stage '{stage_name}'. Known stages are: {tuple(limits)}"
+            )
+        limits[stage_name] = limit
+    return {stage_name: max(1, min(jobs, limit)) for stage_name, limit in limits.items()}
+
+
+def resolve_build_jobs(build_jobs: Optional[str], concurrent_builds: int) -> str:
+    """Return the number of parallel jobs for each doc build
+
+    If `build_jobs` is None or "auto", the CPUs are divided evenly between the
+    `concurrent_builds` builds that may be running at the same time.
+
+    """
+    if build_jobs is not None and build_jobs != "auto":
+        return build_jobs
+    cpu_count = os.cpu_count() or 1
+    return str(max(1, cpu_count // max(1, concurrent_builds)))
+
+
+def make_stage_limits(
+    jobs: int, stage_limit_overrides: Optional[Mapping[str, int]] = None
+) -> StageLimits:
+    """Return the semaphores enforcing the stage limits when running with `jobs` workers"""
+    return {
+        stage_name: threading.BoundedSemaphore(limit)
+        for stage_name, limit in resolve_stage_limits(jobs, stage_limit_overrides).items()
+    }
+
+
+@contextmanager
+def stage(stage_limits: StageLimits, stage_name: str) -> Iterator[None]:
+    """Hold a slot in the stage `stage_name` within this context manager"""
+    with stage_limits[stage_name]:
+        yield
+
+
+def run_pipelines(
+    package_names: Sequence[str], pipeline: Pipeline, jobs: int, stage_limits: StageLimits
+) -> list[PackageResult]:
+    """Run `pipeline` for all `package_names` with `jobs` workers and return the results
+
+    The results are returned in the same order as `package_names`, regardless of the order in
+    which the pipelines finished.
+
+    """
+    LOG.info("Run pipelines", package_names=package_names, jobs=jobs)
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="pipeline") as executor:
+        futures = [
+            executor.submit(_run_pipeline, package_name, pipeline, stage_limits)
+            for package_name in package_names
+        ]
+    return [future.result() for future in futures]
+
+
+def _run_pipeline(
+    package_name: str, pipeline: Pipeline, stage_limits: StageLimits
+) -> PackageResult:
+    """Run `pipeline` for `package_name` and turn the outcome into a `PackageResult`"""
+    logger = LOG.bind(package=package_name)
+    start = time.perf_counter()
+    try:
+        note = pipeline(package_name, stage_limits)
+    except ClickException as exception:
+        error = exception.format_message()
+    except subprocess.CalledProcessError as exception:
+        error = str(exception)
+    except Exception as exception:
+        # A bug for one package should not take down the pipelines for all the others
+        logger.exception("Unexpected error in pipeline")
+        error = f"{exception.__class__.__name__}: {exception}"
+    else:
+        duration = time.perf_counter() - start
+        logger.info("Pipeline succeeded", duration=duration, note=note)
+        return PackageResult(
+            package_name=package_name, succeeded=True, duration=duration, note=note
+        )
+
+    duration = time.perf_counter() - start
+    logger.error("Pipeline failed", error=error, duration=duration)
+    return PackageResult(package_name=package_name, succeeded=False, duration=duration, error=error)
+
+
+def print_summary(results: Sequence[PackageResult]) -> None:
+    """Print out a per-package summary of `results` in a rich table"""
+    table = Table(title="Install Summary")
+    table.add_column("Package", justify="right", style="cyan", no_wrap=True)
+    table.add_column("Result")
+    table.add_column("Duration", justify="right")
+    table.add_column("Details")
+
+    for result in results:
+        if result.succeeded:
+            outcome = "[bold green]OK[/bold green]"
+            details = result.note or ""
+        else:
+            outcome = "[bold red]FAILED[/bold red]"
+            details = f"[red]{result.error}[/red]"
+        table.add_row(result.package_name, outcome, f"{result.duration:.1f}s", details)
+
+    console = Console()
+    console.print(table)
@@ -1,11 +1,37 @@
-"""A utility for extracting sections from a makefile"""
+"""A utility for extracting sections from a makefile
+
+The makefile is parsed in a single pass over its lines, which handles line continuations,
+variables, includes, conditionals and `.PHONY`, and skips `define` blocks and pattern rules. The
+dependencies are then resolved only for the targets that are asked for, with a depth first search
+that visits each target once, so the whole thing is linear in the size of the makefile.
+
+"""
 
 import re
 from pathlib import Path
+from typing import Iterable, Iterator, Optional
 
+import structlog
 from attr import Factory, define
 
-MAKEFILE_SECTIONS = r"([\.\w -]*): *(.*)?((?:\n\t.*)*)?"
+LOG = structlog.get_logger(mod="utils")
+
+ASSIGNMENT_RE = re.compile(
+    r"^(?:override\s+|export\s+)*([\w.-]+)\s*(::=|:=|\?=|\+=|!=|=)\s*(.*)$", re.DOTALL
+)
+RULE_RE = re.compile(r"^([^:=]+?)\s*::?(?!=)\s*(.*)$", re.DOTALL)
+INCLUDE_RE = re.compile(r"^(?:-include|sinclude|include)\s+(.+)$")
+VARIABLE_REFERENCE_RE = re.compile(r"\$(?:\(([\w.-]+)\)|\{([\w.-]+)\}|([$@]))")
+CONDITIONAL_RE = re.compile(r"^(ifeq|ifneq|ifdef|ifndef)\b\s*(.*)$")
+ELSE_RE = re.compile(r"^else\b\s*(.*)$")
+QUOTED_COMPARISON_RE = re.compile(r"""^(["'])(.*?)\1\s+(["'])(.*?)\3$""")
+IGNORED_DIRECTIVES = frozenset(("unexport", "vpath", "undefine"))
+# Prefixes of recipe lines that are instructions to make, not part of the command
+RECIPE_PREFIXES = "@-+"
+# Appended to recipe lines with the - prefix, whose errors make ignores
+IGNORE_ERRORS_SUFFIX = " || true"
+# Expansions of a variable in a variable, before it is considered self-referencing
+MAX_EXPANSION_DEPTH = 20
 
 
 @define
@@ -15,39 +41,327 @@ class _Section:
     lines: list[str] = Factory(list)
 
 
-def extract_sections_from_makefile(makefile_path: Path) -> dict[str, list[str]]:  # noqa: C901
-    """Extract sections from makefile and resolve dependencies"""
+@define
+class _Makefile:
+    """The parsed content of a makefile and the makefiles it includes
+
+    Attributes:
+        sections (dict[str, _Section]): The sections (rules) by target name
+        variables (dict[str, str]): The values of the variables; those that were assigned with
+            `:=` are already expanded
+        phony (set[str]): The targets that are declared phony
+
+    """
+
+    sections: dict[str, _Section] = Factory(dict)
+    variables: dict[str, str] = Factory(dict)
+    phony: set[str] = Factory(set)
+
+
+@define
+class _Conditionals:
+    """The state of the conditionals (ifeq, ifdef, ...) around the current line of a makefile
+
+    Attributes:
+        branches (list[tuple[bool, bool]]): For each nested conditional, whether the current
+            branch is active and whether any of its branches has been taken
+
+    """
+
+    branches: list[tuple[bool, bool]] = Factory(list)
+
+    @property
+    def active(self) -> bool:
+        """Whether the lines at this point of the makefile are in effect"""
+        return all(active for active, _ in self.branches)
+
+    def update(self, line: str, variables: dict[str, str]) -> bool:
+        """Update the state with `line` and return whether it is a conditional directive
+
+        Raises:
+            ValueError: If the condition cannot be evaluated, e.g. because it calls a function
+
+        """
+        if match := CONDITIONAL_RE.match(line):
+            # Conditionals within inactive branches are not evaluated
+            condition = self.active and _evaluate_condition(match, variables)
+            self.branches.append((condition, condition))
+        elif (match := ELSE_RE.match(line)) and self.branches:
+            _, taken = self.branches.pop()
+            # A plain else or e.g. "else ifeq (...)"
+            else_match = CONDITIONAL_RE.match(match.group(1))
+            if taken or not self.active:
+                condition = False
+            elif else_match:
+                condition = _evaluate_condition(else_match, variables)
+            else:
+                condition = True
+            self.branches.append((condition, taken or condition))
+        elif line == "endif" and self.branches:
+            self.branches.pop()
+        else:
+            return False
+        return True
+
+
+def extract_sections_from_makefile(
+    makefile_path: Path, targets: Optional[Iterable[str]] = None
+) -> dict[str, list[str]]:
+    """Extract sections from makefile and resolve dependencies
+
+    Returns the recipe lines of each of `targets` (all targets, if not given) that is defined in
+    the makefile, preceded by the recipe lines of its dependencies, as make would run them.
+    Prerequisites that are not targets, e.g. files, are skipped.
+
+    """
+    makefile = _Makefile(variables={"MAKE": "make", "CURDIR": str(makefile_path.parent)})
+    _parse_makefile(makefile_path, makefile, seen_paths=set())
+
+    if targets is None:
+        targets = makefile.sections
+    return {
+        name: [
+            _expand(line, makefile.variables, target=dependency_name)
+            for dependency_name in _resolve(name, makefile.sections)
+            for line in makefile.sections[dependency_name].lines
+        ]
+        for name in targets
+        if name in makefile.sections
+    }
+
+
+def _parse_makefile(makefile_path: Path, makefile: _Makefile, seen_paths: set[Path]) -> None:
+    """Parse `makefile_path` into `makefile`"""
+    seen_paths.add(makefile_path.resolve())
     with open(makefile_path) as file_:
-        makefile_content = file_.read()
-
-    sections = {}
-    for match in re.findall(MAKEFILE_SECTIONS, makefile_content):
-        name_group, deps_str, lines = match
-        if lines == "":
-            deps_str, lines = lines, deps_str
-        lines = [line.strip() for line in lines.strip().split("\n")]
-        deps = deps_str.split(" ") if deps_str else []
-
-        for name in re.findall(r"[\.\w-]+", name_group.strip()):
-            sections[name] = _Section(name, deps, lines)
-
-    # Resolve dependencies
-    while True:
-        some_left_to_resolve = False
-        for name, section in sections.items():
-            some_left_to_resolve = some_left_to_resolve or bool(section.deps)
-            while section.deps:
-                dep_to_resolve = section.deps[-1]
-                dependency_section = sections[dep_to_resolve]
-                # Before adding dependencies, make sure they are resolved
-                if dependency_section.deps:
-                    break
-                section.lines = dependency_section.lines + section.lines
-                section.deps = section.deps[:-1]
-
-        if not some_left_to_resolve:
-            break
+        content = file_.read()
+
+    current_sections: list[_Section] = []
+    recipe_started = False
+    in_define = False
+    conditionals = _Conditionals()
+    for line in _logical_lines(content):
+        if in_define:
+            in_define = _strip_comment(line).strip() != "endef"
+            continue
+        # Like make, lines starting with a tab are recipe lines, even if they look like directives
+        stripped = "" if line.startswith("\t") else _strip_comment(line).strip()
+        if conditionals.update(stripped, makefile.variables) or not conditionals.active:
+            continue
+        if line.startswith("\t"):
+            _add_recipe_line(current_sections, line, recipe_started)
+            recipe_started = True
+            continue
+
+        first_word = stripped.split(maxsplit=1)[0] if stripped else ""
+        if not first_word or first_word in IGNORED_DIRECTIVES:
+            continue
+        current_sections = []
+
+        if first_word == "define":
+            in_define = True
+        elif match := INCLUDE_RE.match(stripped):
+            _parse_includes(makefile_path, match.group(1), makefile, seen_paths)
+        elif match := ASSIGNMENT_RE.match(stripped):
+            _assign(makefile.variables, *match.groups())
+        elif match := RULE_RE.match(stripped):
+            current_sections, recipe_started = _add_rule(makefile, *match.groups())
+
+
+def _parse_includes(
+    makefile_path: Path, include_names: str, makefile: _Makefile, seen_paths: set[Path]
+) -> None:
+    """Parse the makefiles in `include_names` (relative to `makefile_path`) into `makefile`
+
+    Missing makefiles, e.g. generated ones, and makefiles that are already parsed are skipped.
+
+    """
+    for include_name in _expand(include_names, makefile.variables).split():
+        include_path = makefile_path.parent / include_name
+        if include_path.resolve() in seen_paths or not include_path.is_file():
+            LOG.debug("Skip include", include_path=include_path)
+            continue
+        _parse_makefile(include_path, makefile, seen_paths)
 
-    sections_just_lines = {name: section.lines for name, section in sections.items()}
 
-    return sections_just_lines
+def _logical_lines(content: str) -> Iterator[str]:
+    """Return the lines of `content` with continued lines joined"""
+    continued = ""
+    for line in content.splitlines():
+        if line.endswith("\\") and not line.endswith("\\\\"):
+            continued += (line[:-1].strip() if continued else line[:-1].rstrip()) + " "
+            continue
+        yield continued + (line.lstrip() if continued else line)
+        continued = ""
+    if continued:
+        yield continued
+
+
+def _strip_comment(line: str) -> str:
+    """Return `line` without a trailing comment"""
+    position = line.find("#")
+    while position > 0 and line[position - 1] == "\\":
+        position = line.find("#", position + 1)
+    return line if position == -1 else line[:position]
+
+
+def _evaluate_condition(match: re.Match[str], variables: dict[str, str]) -> bool:
+    """Return whether the condition of the conditional directive `match` holds"""
+    directive, arguments = match.group(1), match.group(2)
+    if directive in ("ifdef", "ifndef"):
+        condition = bool(variables.get(_expand(arguments, variables).strip()))
+    else:
+        left, right = (_expand(text, variables) for text in _split_comparison(arguments))
+        if "$" in left + right:
+            raise ValueError(f"Unable to evaluate makefile conditional: {match.group(0)}")
+        condition = left == right
+    return condition if directive in ("ifdef", "ifeq") else not condition
+
+
+def _split_comparison(arguments: str) -> tuple[str, str]:
+    """Return the two sides of the comparison `arguments` of ifeq or ifneq
+
+    The comparison is either "(left,right)" or two quoted strings, e.g. "left" 'right'.
+
+    """
+    if arguments.startswith("(") and arguments.endswith(")"):
+        depth = 0
+        for index, character in enumerate(arguments[1:-1], start=1):
+            if character in "({":
+                depth += 1
+            elif character in ")}":
+                depth -= 1
+            elif character == "," and depth == 0:
+                return arguments[1:index].strip(), arguments[index + 1 : -1].strip()
+    elif match := QUOTED_COMPARISON_RE.match(arguments):
+        return match.group(2), match.group(4)
+    raise ValueError(f"Invalid makefile comparison: {arguments}")
+
+
+def _assign(variables: dict[str, str], name: str, operator: str, value: str) -> None:
+    """Assign `value` to the variable `name` in `variables` with the assignment `operator`"""
+    if operator in (":=", "::="):
+        variables[name] = _expand(value, variables)
+    elif operator == "?=":
+        variables.setdefault(name, value)
+    elif operator == "+=":
+        variables[name] = f"{variables[name]} {value}" if variables.get(name) else value
+    elif operator == "=":
+        variables[name] = value
+    else:
+        # Shell assignments (!=) are not run, so the variable is left undefined
+        LOG.debug("Skip shell assignment", name=name)
+
+
+def _add_rule(makefile: _Makefile, targets_str: str, rest: str) -> tuple[list[_Section], bool]:
+    """Add the rule for `targets_str` with the prerequisites (and inline recipe) in `rest`
+
+    Returns the sections that the recipe lines of the rule belong to and whether the recipe was
+    started by an inline recipe.
+
+    """
+    prerequisites_str, has_inline_recipe, inline_recipe = rest.partition(";")
+    if ASSIGNMENT_RE.match(prerequisites_str):
+        # A target specific variable
+        return [], False
+
+    # Prerequisites after | are order only, they are still run first
+    prerequisites = _expand(prerequisites_str, makefile.variables).replace("|", " ").split()
+    target_names = _expand(targets_str, makefile.variables).split()
+    if ".PHONY" in target_names:
+        makefile.phony.update(prerequisites)
+        return [], False
+
+    sections = []
+    for name in target_names:
+        if "%" in name or (name.startswith(".") and name[1:].isupper()):
+            # Pattern rules and special targets never build docs
+            continue
+        if section := makefile.sections.get(name):
+            # Like make, prerequisites accumulate over the rules for a target
+            section.deps += prerequisites
+        else:
+            section = makefile.sections[name] = _Section(name, list(prerequisites))
+        sections.append(section)
+
+    if has_inline_recipe:
+        _add_recipe_line(sections, inline_recipe, recipe_started=False)
+    return sections, bool(has_inline_recipe)
+
+
+def _add_recipe_line(sections: list[_Section], line: str, recipe_started: bool) -> None:
+    """Add the recipe `line` to `sections`
+
+    The prefixes that are instructions to make are stripped from the line, where the - prefix
+    (ignore errors) is kept as `IGNORE_ERRORS_SUFFIX`. Like make, a later recipe for a target
+    replaces the earlier one, so the first line of a recipe (`recipe_started` is False) clears
+    the lines from before.
+
+    """
+    recipe_line = line.strip()
+    prefixes = recipe_line[: len(recipe_line) - len(recipe_line.lstrip(RECIPE_PREFIXES))]
+    recipe_line = recipe_line.lstrip(RECIPE_PREFIXES).strip()
+    if "-" in prefixes and recipe_line:
+        recipe_line += IGNORE_ERRORS_SUFFIX
+    for section in sections:
+        if not recipe_started:
+            section.lines = []
+        if recipe_line:
+            section.lines.append(recipe_line)
+
+
+def _expand(
+    text: str, variables: dict[str, str], target: Optional[str] = None, depth: int = 0
+) -> str:
+    """Return `text` with references to `variables` expanded
+
+    Like in make, undefined variables expand to nothing. Functions are left as they are, as are
+    references when expanding `depth` levels deep, which only happens for self-referencing
+    variables.
+
+    """
+    if "$" not in text or depth > MAX_EXPANSION_DEPTH:
+        return text
+
+    def replace(match: re.Match[str]) -> str:
+        name, braced_name, special = match.groups()
+        if special == "$":
+            return "$"
+        if special == "@":
+            return match.group(0) if target is None else target
+        name = name or braced_name
+        if name not in variables:
+            return ""
+        return _expand(variables[name], variables, target=target, depth=depth + 1)
+
+    return VARIABLE_REFERENCE_RE.sub(replace, text)
+
+
+def _resolve(name: str, sections: dict[str, _Section]) -> list[str]:
+    """Return the names of the sections to run for `name` in order, dependencies first
+
+    Each section is visited once, so a dependency shared by several prerequisites is only run
+    once, like make does. Circular dependencies are dropped, also like make does.
+
+    """
+    order = []
+    done: set[str] = set()
+    visiting = {name}
+    stack = [(name, iter(sections[name].deps))]
+    while stack:
+        section_name, dependencies = stack[-1]
+        for dependency in dependencies:
+            if dependency in done or dependency not in sections:
+                continue
+            if dependency in visiting:
+                LOG.warning("Dropped circular dependency", target=section_name, dep=dependency)
+                continue
+            visiting.add(dependency)
+            stack.append((dependency, iter(sections[dependency].deps)))
+            break
+        else:
+            stack.pop()
+            visiting.discard(section_name)
+            done.add(section_name)
+            order.append(section_name)
+    return order
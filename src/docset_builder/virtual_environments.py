@@ -1,60 +1,795 @@
-"""This module contains functions for build the docs within a virtual environment"""
+"""This module contains functions for build the docs within a virtual environment
+
+Virtual environments are created, and requirements installed into them, by an installer backend.
+Two backends are available: pip (with the venv module) and the much faster uv, which is used
+when it is installed, unless configured otherwise.
+
+All backends use a download and wheel cache under `PACKAGE_CACHE_DIR`, shared by all virtual
+environments, and look for pre-built wheels in `WHEELHOUSE_DIR`.
+
+The doc toolchain (Sphinx, themes, extensions etc.) of a package is installed into a base
+environment, that is shared by all packages with the same toolchain, and layered into the
+virtual environment of the package with a .pth file. Only the rest of the requirements are
+installed into the package virtual environment.
+
+Sphinx build output and doctrees are directed to a stable per-package directory under
+`BUILD_OUTPUT_DIR`, where Sphinx can rebuild incrementally between releases. The directory is
+cleared when the Sphinx version or conf.py changes.
+
+"""
+import fcntl
+import hashlib
+import json
 import os
+import re
+import shlex
+import shutil
 import subprocess
+from collections import deque
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Optional, Protocol, Sequence
 
 import structlog
+from attrs import define
+from click import ClickException
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
 
-from .data_structures import DocBuildInfo
-from .directories import VENV_DIR
+from . import config, instrumentation, metadata_store
+from .data_structures import BUILD_JOBS_PLACEHOLDER, CacheStatistics, DocBuildInfo
+from .directories import (
+    BASE_VENV_DIR,
+    BUILD_OUTPUT_DIR,
+    PACKAGE_CACHE_DIR,
+    VENV_DIR,
+    WHEELHOUSE_DIR,
+    ensure_dir,
+)
+from .repositories import current_tree_hash
 
 LOG = structlog.get_logger(mod="venvs")
+# Important, for maximum compatibility, this has to point to a cPython, not merely
+# /usr/bin/env python3 which will point to pypy3 if installed
+BASE_PYTHON = "/usr/bin/python3"
+# Holds the hash of the requirements last installed into a virtual environment
+REQUIREMENTS_HASH_FILENAME = "docset-builder-requirements.sha256"
+# Packages of doc toolchains, which are installed into shared base environments
+TOOLCHAIN_PACKAGE_NAMES = frozenset(
+    (
+        "alabaster",
+        "docutils",
+        "furo",
+        "jinja2",
+        "mkdocs",
+        "mkdocs-material",
+        "mkdocstrings",
+        "myst-nb",
+        "myst-parser",
+        "nbsphinx",
+        "numpydoc",
+        "pydata-sphinx-theme",
+        "pygments",
+        "sphinx",
+    )
+)
+TOOLCHAIN_PACKAGE_PREFIXES = ("sphinx-", "sphinxcontrib-", "sphinxext-", "mkdocs-")
+# The .pth file that layers a base environment into a virtual environment
+BASE_ENVIRONMENT_PTH_FILENAME = "docset-builder-base-environment.pth"
+# Marks the scripts that are copied from the base environment into a virtual environment
+BASE_ENVIRONMENT_SCRIPT_MARKER = "# docset-builder base environment script"
+# Shell syntax (operators, redirections, substitutions, globs, variable assignments), commands
+# containing any of it are run with a shell
+SHELL_SYNTAX_RE = re.compile(r"[|&;<>()$`*?\[\]{}~\n\\]|^\s*\w+=")
+# Holds the Sphinx version and conf.py hash the build output directory was built with
+BUILD_OUTPUT_STATE_FILENAME = "build-state.json"
+# Options of sphinx-build that take a value
+SPHINX_BUILD_VALUE_OPTIONS = frozenset(
+    ("-M", "-b", "-d", "-c", "-D", "-t", "-A", "-j", "-w", "--builder", "--doctree-dir", "--jobs")
+)
+# Options of pip install that take a requirements file or a path, by long form, with short form
+PIP_PATH_OPTIONS = {"--requirement": "-r", "--constraint": "-c", "--editable": "-e"}
+# The number of lines of output of a failed doc build command to show
+COMMAND_OUTPUT_TAIL_LINES = 50
+# Lines in pip install output about getting a package, e.g. "Using cached six-1.16.0-py2.py3-..."
+PIP_PACKAGE_LINE_RE = re.compile(r"^\s*(Using cached|Downloading|Processing) (\S+)", re.MULTILINE)
+# Summary lines in uv pip install output, e.g. "Prepared 3 packages in 1.2s"
+UV_SUMMARY_LINE_RE = re.compile(r"^(Prepared|Installed) (\d+) packages?", re.MULTILINE)
+
+
+class InstallerBackend(Protocol):
+    """Mypy type for backends that create virtual environments and install into them"""
+
+    @property
+    def name(self) -> str:
+        """The name of the backend"""
+        ...
+
+    def create_venv(self, venv_dir: Path) -> None:
+        """Create a virtual environment in `venv_dir`"""
+        ...
+
+    def install(
+        self, venv_dir: Path, arguments: Sequence[str], working_dir: Path
+    ) -> CacheStatistics:
+        """Install the pip install `arguments` into the virtual environment in `venv_dir`
+
+        Returns the package cache statistics of the installation.
+
+        """
+        ...
+
+
+@define(frozen=True)
+class PipBackend:
+    """Installer backend that uses the venv module and pip
+
+    Attributes:
+        find_links (tuple[Path]): Directories of wheels and sdists to look for packages in, in
+            addition to the package index
+        cache_dir (Path): The pip cache directory, or None for pip's default
+
+    """
+
+    find_links: tuple[Path, ...] = ()
+    cache_dir: Optional[Path] = None
+    name: str = "pip"
+
+    def create_venv(self, venv_dir: Path) -> None:
+        """Create a virtual environment in `venv_dir`"""
+        _create_venv(venv_dir)
+
+    def install(
+        self, venv_dir: Path, arguments: Sequence[str], working_dir: Path
+    ) -> CacheStatistics:
+        """Install the pip install `arguments` into the virtual environment in `venv_dir`"""
+        output = _run_installer(
+            [str(venv_dir / "bin" / "python"), "-m", "pip", "install", "--upgrade"]
+            + _find_links_arguments(self.find_links)
+            + list(arguments),
+            environment_variables={"PIP_CACHE_DIR": self.cache_dir},
+            working_dir=working_dir,
+        )
+        statistics = CacheStatistics()
+        for action, package in PIP_PACKAGE_LINE_RE.findall(output):
+            if action == "Using cached":
+                statistics.hits += 1
+            elif action == "Downloading":
+                statistics.misses += 1
+            # Processing is also used for local requirements, only count those from find-links
+            elif any((path / Path(package).name).exists() for path in self.find_links):
+                statistics.hits += 1
+        return statistics
+
+
+@define(frozen=True)
+class UvBackend:
+    """Installer backend that uses uv
+
+    Attributes:
+        executable (str): The uv executable
+        find_links (tuple[Path]): Directories of wheels and sdists to look for packages in, in
+            addition to the package index
+        cache_dir (Path): The uv cache directory, or None for uv's default
+
+    """
+
+    executable: str = "uv"
+    find_links: tuple[Path, ...] = ()
+    cache_dir: Optional[Path] = None
+    name: str = "uv"
+
+    def create_venv(self, venv_dir: Path) -> None:
+        """Create a virtual environment in `venv_dir`"""
+        # Seed the environment with pip, as doc build commands may rely on it being there
+        _run_installer(
+            [self.executable, "venv", "--seed", "--python", BASE_PYTHON, str(venv_dir)],
+            environment_variables={"UV_CACHE_DIR": self.cache_dir},
+        )
+
+    def install(
+        self, venv_dir: Path, arguments: Sequence[str], working_dir: Path
+    ) -> CacheStatistics:
+        """Install the pip install `arguments` into the virtual environment in `venv_dir`"""
+        python = str(venv_dir / "bin" / "python")
+        output = _run_installer(
+            [self.executable, "pip", "install", "--upgrade", "--python", python]
+            + _find_links_arguments(self.find_links)
+            + list(arguments),
+            environment_variables={"UV_CACHE_DIR": self.cache_dir},
+            working_dir=working_dir,
+        )
+        # uv only reports how many packages it had to download or build ("prepare")
+        counts = {action: int(count) for action, count in UV_SUMMARY_LINE_RE.findall(output)}
+        misses = counts.get("Prepared", 0)
+        return CacheStatistics(hits=max(counts.get("Installed", 0) - misses, 0), misses=misses)
+
+
+def get_installer_backend(
+    name: Optional[str] = None,
+    find_links: Sequence[Path] = (WHEELHOUSE_DIR,),
+    cache_dir: Optional[Path] = PACKAGE_CACHE_DIR,
+) -> InstallerBackend:
+    """Return the installer backend called `name` ("auto", "pip" or "uv")
+
+    If `name` is None, it is read from the configuration. "auto" selects uv, if it is available,
+    and otherwise pip. The backend uses its own sub directory of `cache_dir` as cache.
+
+    """
+    name = name or config.installer
+    uv_executable = shutil.which("uv")
+    if name == "auto":
+        name = "uv" if uv_executable else "pip"
+        LOG.debug("Auto-detected installer backend", installer=name)
+
+    if name == "pip":
+        return PipBackend(find_links=tuple(find_links), cache_dir=cache_dir and cache_dir / "pip")
+    elif name == "uv":
+        if uv_executable is None:
+            raise ClickException("The uv installer backend was selected, but uv is not installed")
+        return UvBackend(
+            executable=uv_executable,
+            find_links=tuple(find_links),
+            cache_dir=cache_dir and cache_dir / "uv",
+        )
+    raise ClickException(
+        f"Unknown installer backend '{name}', expected one of {config.INSTALLER_NAMES}"
+    )
+
+
+def _run_installer(
+    command: list[str],
+    environment_variables: dict[str, Optional[Path]],
+    working_dir: Optional[Path] = None,
+) -> str:
+    """Run the installer `command` and return its output (stdout and stderr)
+
+    The `environment_variables` that are not None are added to the environment.
+
+    """
+    environment = os.environ.copy()
+    environment.update({key: str(value) for key, value in environment_variables.items() if value})
+    result = subprocess.run(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        env=environment,
+        cwd=working_dir,
+    )
+    if result.returncode != 0:
+        LOG.error("Installer failed", command=command, output=result.stdout)
+    else:
+        LOG.debug("Installer output", command=command, output=result.stdout)
+    result.check_returncode()
+    return result.stdout
+
+
+def _find_links_arguments(find_links: Iterable[Path]) -> list[str]:
+    """Return the install arguments to look for packages in the `find_links` directories
+
+    Directories that do not exist (yet), e.g. an empty wheelhouse, are left out.
+
+    """
+    return [
+        argument for path in find_links if path.is_dir() for argument in ("--find-links", str(path))
+    ]
 
 
 def build_docs(
-    package_name: str, local_repository: Path, docbuild_information: DocBuildInfo
-) -> None:
-    """Build the docs"""
+    package_name: str,
+    local_repository: Path,
+    docbuild_information: DocBuildInfo,
+    installer: Optional[InstallerBackend] = None,
+) -> Optional[Path]:
+    """Build the docs
+
+    The virtual environment is created and the requirements installed with `installer`, which
+    defaults to the configured installer backend. Unless disabled in the configuration, the doc
+    toolchain is installed into a shared base environment.
+
+    Returns the directory with the built HTML docs, if the build output could be directed to the
+    stable build output directory, otherwise None.
+
+    """
+    installer = installer or get_installer_backend()
     venv_dir = VENV_DIR / package_name
-    logger = LOG.bind(venv_dir=venv_dir)
+    logger = LOG.bind(venv_dir=venv_dir, installer=installer.name)
     if not venv_dir.exists():
         logger.info("Create virtual env")
-        _create_venv(venv_dir)
+        installer.create_venv(venv_dir)
+
+    with instrumentation.measure(package_name, "dependency_install"):
+        requirements = docbuild_information.doc_build_command_deps or []
+        toolchain_requirements, other_requirements = split_toolchain_requirements(requirements)
+        if config.use_base_environments and toolchain_requirements:
+            base_venv_dir = ensure_base_environment(installer, toolchain_requirements)
+            _layer_base_environment(venv_dir, base_venv_dir)
+            requirements = other_requirements
+        _install_requirements(installer, venv_dir, requirements, local_repository)
+
+    output_dir = BUILD_OUTPUT_DIR / package_name
+    _prepare_build_output_dir(output_dir, venv_dir, docbuild_information)
+
+    with instrumentation.measure(package_name, "doc_build"):
+        redirected = False
+        environment = _venv_environment(venv_dir)
+        for command in docbuild_information.doc_build_commands:
+            command = add_build_parallelism(command, docbuild_information.build_jobs)
+            redirected_command = redirect_build_output(command, output_dir)
+            redirected = redirected or redirected_command != command
+            command = redirected_command
+            logger.info("Execute doc build command", cmd=command)
+            _cmd_in_venv(
+                venv_dir,
+                command,
+                working_dir=docbuild_information.basedir_for_building_docs,
+                environment=environment,
+            )
+
+    # A Makefile may not use the BUILDDIR variable, so check that the output is there
+    if redirected and (output_dir / "html" / "index.html").exists():
+        return output_dir / "html"
+    logger.info("Build output was not written to the build output directory")
+    return None
+
+
+def add_build_parallelism(command: str, build_jobs: Optional[str]) -> str:
+    """Return `command` changed to build with `build_jobs` parallel jobs, where supported
+
+    Sphinx builds through make get the O variable, which the stock Sphinx Makefile adds to the
+    options of the project (in SPHINXOPTS), sphinx-build gets -j and spin docs gets --jobs,
+    unless the command already sets them. `BUILD_JOBS_PLACEHOLDER` is replaced in any command.
+
+    """
+    command = command.replace(BUILD_JOBS_PLACEHOLDER, build_jobs or "1")
+    if build_jobs is None or build_jobs == "1" or SHELL_SYNTAX_RE.search(command):
+        return command
+
+    arguments = shlex.split(command)
+    if any(argument in ("-j", "--jobs") or argument.startswith("-j") for argument in arguments):
+        return command
+    if arguments[:1] == ["make"]:
+        if not any(argument.startswith("O=") for argument in arguments):
+            arguments.append(f"O=-j {build_jobs}")
+    elif arguments[:1] == ["sphinx-build"] or arguments[1:3] == ["-m", "sphinx"]:
+        program_length = 1 if arguments[0] == "sphinx-build" else 3
+        options_index = _sphinx_options_index(arguments, program_length)
+        arguments[options_index:options_index] = ["-j", build_jobs]
+    elif arguments[:2] == ["spin", "docs"]:
+        arguments[2:2] = ["--jobs", build_jobs]
+    else:
+        return command
+    return shlex.join(arguments)
+
+
+def _sphinx_options_index(arguments: list[str], program_length: int) -> int:
+    """Return the index to insert options at in the sphinx-build command `arguments`
+
+    In make-mode, -M and its builder, source and build directory must come first.
+
+    """
+    if arguments[program_length : program_length + 1] == ["-M"]:
+        return program_length + 4
+    return program_length
+
+
+def redirect_build_output(command: str, output_dir: Path) -> str:
+    """Return `command` changed to write its HTML output and doctrees to `output_dir`
+
+    Sphinx builds through make get BUILDDIR and sphinx-build HTML builds get a new output (or, in
+    make-mode, build) directory and -d, unless the command already sets them. Other commands are
+    returned as is.
+
+    """
+    if SHELL_SYNTAX_RE.search(command):
+        return command
+
+    arguments = shlex.split(command)
+    if arguments[:1] == ["make"]:
+        if any(argument.startswith("BUILDDIR=") for argument in arguments):
+            return command
+        arguments.append(f"BUILDDIR={output_dir}")
+        return shlex.join(arguments)
+
+    if arguments[:1] == ["sphinx-build"]:
+        program_length = 1
+    elif arguments[1:3] == ["-m", "sphinx"]:
+        program_length = 3
+    else:
+        return command
+
+    if not _redirect_sphinx_build_arguments(arguments, program_length, output_dir):
+        return command
+    return shlex.join(arguments)
+
+
+def _redirect_sphinx_build_arguments(
+    arguments: list[str], program_length: int, output_dir: Path
+) -> bool:
+    """Change the sphinx-build command `arguments` in place to build HTML into `output_dir`
+
+    Returns whether the arguments were changed, which they are not for other builders or if the
+    output directory could not be found. The program takes up the first `program_length`
+    arguments.
+
+    """
+    if arguments[program_length : program_length + 1] == ["-M"]:
+        # Make-mode: sphinx-build -M <builder> <sourcedir> <builddir> [options], which writes the
+        # output to <builddir>/<builder> and the doctrees to <builddir>/doctrees
+        if arguments[program_length + 1 : program_length + 2] != ["html"] or (
+            len(arguments) < program_length + 4
+        ):
+            return False
+        arguments[program_length + 3] = str(output_dir)
+        return True
+
+    if _sphinx_builder(arguments, program_length) != "html":
+        return False
+    if (output_dir_index := _sphinx_build_output_dir_index(arguments, program_length)) is None:
+        return False
+
+    arguments[output_dir_index] = str(output_dir / "html")
+    if not any(argument in ("-d", "--doctree-dir") for argument in arguments):
+        arguments[program_length:program_length] = ["-d", str(output_dir / "doctrees")]
+    return True
 
-    for requirement in docbuild_information.doc_build_command_deps:
-        if not (requirement.startswith("-r") and requirement.endswith(".txt")):
-            requirement = f'"{requirement}"'
-        logger.info("Install requirement", req=requirement)
-        _cmd_in_venv(venv_dir, f"pip install --upgrade {requirement}", working_dir=local_repository)
 
-    for command in docbuild_information.doc_build_commands:
-        logger.info("Execute doc build command", cmd=command)
-        _cmd_in_venv(venv_dir, command, working_dir=docbuild_information.basedir_for_building_docs)
+def _sphinx_builder(arguments: list[str], program_length: int) -> str:
+    """Return the builder of the sphinx-build command `arguments`, which defaults to html"""
+    builder = "html"
+    for index, argument in enumerate(arguments[program_length:], start=program_length):
+        if argument in ("-b", "--builder") and index + 1 < len(arguments):
+            builder = arguments[index + 1]
+        elif argument.startswith("--builder="):
+            builder = argument.partition("=")[2]
+    return builder
+
+
+def _sphinx_build_output_dir_index(arguments: list[str], program_length: int) -> Optional[int]:
+    """Return the index of the output directory in the sphinx-build command `arguments`
+
+    The command is: sphinx-build [options] <sourcedir> <outputdir> [filenames...], where the
+    program takes up the first `program_length` arguments.
+
+    """
+    positional_indexes = []
+    takes_value = False
+    for index, argument in enumerate(arguments[program_length:], start=program_length):
+        if takes_value:
+            takes_value = False
+        elif argument in SPHINX_BUILD_VALUE_OPTIONS:
+            takes_value = True
+        elif not argument.startswith("-"):
+            positional_indexes.append(index)
+    return positional_indexes[1] if len(positional_indexes) >= 2 else None
+
+
+def _prepare_build_output_dir(
+    output_dir: Path, venv_dir: Path, docbuild_information: DocBuildInfo
+) -> None:
+    """Make sure `output_dir` exists and clear it if the Sphinx version or conf.py has changed
+
+    Sphinx itself only checks whether its configuration values changed, not e.g. code in conf.py
+    or the version of its extensions, so the incremental build state is not kept across those.
+
+    """
+    state = {
+        "sphinx_version": _sphinx_version(venv_dir),
+        "conf_py_hash": _conf_py_hash(docbuild_information.basedir_for_building_docs),
+    }
+    state_path = output_dir / BUILD_OUTPUT_STATE_FILENAME
+    try:
+        previous_state = json.loads(state_path.read_text())
+    except (OSError, ValueError):
+        previous_state = None
+
+    instrumentation.count_hit("build_output", hit=previous_state == state)
+    if previous_state != state:
+        LOG.info("Clear build output dir", output_dir=output_dir, state=state)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        output_dir.mkdir(parents=True)
+        state_path.write_text(json.dumps(state))
+
+
+def _sphinx_version(venv_dir: Path) -> Optional[str]:
+    """Return the version of Sphinx in the venv at `venv_dir`, or None if it is not installed"""
+    result = subprocess.run(
+        [str(venv_dir / "bin" / "python"), "-c", "import sphinx; print(sphinx.__version__)"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def _conf_py_hash(basedir_for_building_docs: Optional[Path]) -> Optional[str]:
+    """Return a hash of the Sphinx conf.py for the docs in `basedir_for_building_docs`, if any"""
+    if basedir_for_building_docs is None:
+        return None
+    for candidate in ("conf.py", "source/conf.py", "docs/conf.py", "doc/conf.py"):
+        conf_py_path = basedir_for_building_docs / candidate
+        if conf_py_path.exists():
+            return hashlib.sha256(conf_py_path.read_bytes()).hexdigest()
+    return None
+
+
+def split_toolchain_requirements(requirements: Iterable[str]) -> tuple[list[str], list[str]]:
+    """Split `requirements` into doc toolchain requirements and other requirements
+
+    Options (like "-r requirements.txt") and URL requirements are never toolchain requirements.
+
+    """
+    toolchain_requirements, other_requirements = [], []
+    for requirement in requirements:
+        try:
+            parsed = Requirement(requirement)
+        except InvalidRequirement:
+            other_requirements.append(requirement)
+            continue
+        name = canonicalize_name(parsed.name)
+        if parsed.url is None and (
+            name in TOOLCHAIN_PACKAGE_NAMES or name.startswith(TOOLCHAIN_PACKAGE_PREFIXES)
+        ):
+            toolchain_requirements.append(requirement)
+        else:
+            other_requirements.append(requirement)
+    return toolchain_requirements, other_requirements
+
+
+@lru_cache(maxsize=1)
+def base_python_version() -> str:
+    """Return the version string of `BASE_PYTHON`, like: Python 3.11.2"""
+    version = subprocess.check_output([BASE_PYTHON, "--version"])
+    return version.decode("utf-8").strip()
+
+
+def ensure_base_environment(installer: InstallerBackend, toolchain_requirements: list[str]) -> Path:
+    """Return the base environment for `toolchain_requirements`, create it if needed
+
+    Base environments are keyed by the normalized toolchain requirements, the installer and the
+    version of the base Python.
+
+    """
+    key_data = [installer.name, base_python_version()]
+    key_data += sorted(
+        _normalize_requirement(requirement) for requirement in toolchain_requirements
+    )
+    key = hashlib.sha256(json.dumps(key_data).encode("utf-8")).hexdigest()[:16]
+    base_venv_dir = BASE_VENV_DIR / key
+    logger = LOG.bind(base_venv_dir=base_venv_dir)
+
+    # Packages with the same toolchain may be built concurrently, by this or other processes
+    with open(ensure_dir(BASE_VENV_DIR) / f"{key}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if not base_venv_dir.exists():
+            logger.info("Create base environment", requirements=toolchain_requirements)
+            installer.create_venv(base_venv_dir)
+        _install_requirements(installer, base_venv_dir, toolchain_requirements, base_venv_dir)
+    return base_venv_dir
+
+
+def _normalize_requirement(requirement: str) -> str:
+    """Return `requirement` normalized, if it is a valid requirement, otherwise as is"""
+    try:
+        return str(Requirement(requirement))
+    except InvalidRequirement:
+        return requirement
+
+
+def _layer_base_environment(venv_dir: Path, base_venv_dir: Path) -> None:
+    """Make the packages and scripts in `base_venv_dir` available in `venv_dir`
+
+    The site-packages of the base environment are added to the path with a .pth file and the
+    scripts of the base environment are copied, with the interpreter changed to the one in
+    `venv_dir`.
+
+    """
+    (site_packages,) = venv_dir.glob("lib/python*/site-packages")
+    (base_site_packages,) = base_venv_dir.glob("lib/python*/site-packages")
+    (site_packages / BASE_ENVIRONMENT_PTH_FILENAME).write_text(f"{base_site_packages}\n")
+
+    bin_dir = venv_dir / "bin"
+    for script in bin_dir.iterdir():
+        if script.is_file() and BASE_ENVIRONMENT_SCRIPT_MARKER in _read_script_head(script):
+            script.unlink()
+    base_interpreter_line = f"#!{base_venv_dir}/bin/"
+    for base_script in (base_venv_dir / "bin").iterdir():
+        script = bin_dir / base_script.name
+        if script.exists() or not _read_script_head(base_script).startswith(base_interpreter_line):
+            continue
+        _, _, body = base_script.read_text().partition("\n")
+        script.write_text(f"#!{bin_dir / 'python'}\n{BASE_ENVIRONMENT_SCRIPT_MARKER}\n{body}")
+        script.chmod(0o755)
+    LOG.debug("Layered base environment", venv_dir=venv_dir, base_venv_dir=base_venv_dir)
+
+
+def _read_script_head(script: Path) -> str:
+    """Return the first few hundred characters of `script`, or "" if it is not a text file"""
+    try:
+        with open(script, encoding="utf-8") as file_:
+            return file_.read(512)
+    except (OSError, UnicodeDecodeError):
+        return ""
+
+
+def _install_requirements(
+    installer: InstallerBackend, venv_dir: Path, requirements: list[str], local_repository: Path
+) -> None:
+    """Install `requirements` into the virtual environment at `venv_dir` in one installer call
+
+    The installation is skipped if the same requirements were last installed into it.
+
+    """
+    logger = LOG.bind(venv_dir=venv_dir)
+    if not requirements:
+        logger.info("No requirements to install")
+        return
+
+    arguments = list(_pip_install_arguments(requirements))
+    requirements_hash = _requirements_hash(arguments, local_repository)
+    hash_path = venv_dir / REQUIREMENTS_HASH_FILENAME
+    if hash_path.exists() and hash_path.read_text() == requirements_hash:
+        logger.info("Requirements already installed", requirements_hash=requirements_hash)
+        instrumentation.count_hit("venv_requirements", hit=True)
+        return
+
+    logger.info("Install requirements", requirements=arguments)
+    # Any previous hash is invalid once the installation starts, in case it fails half way
+    hash_path.unlink(missing_ok=True)
+    statistics = installer.install(venv_dir, arguments, working_dir=local_repository)
+    hash_path.write_text(requirements_hash)
+    logger.info(
+        "Requirements installed", cache_hits=statistics.hits, cache_misses=statistics.misses
+    )
+    metadata_store.record_package_cache_statistics(installer.name, statistics)
+    instrumentation.count_hit("venv_requirements", hit=False)
+    instrumentation.count("package_cache", hits=statistics.hits, misses=statistics.misses)
+
+
+def _pip_install_arguments(requirements: Iterable[str]) -> Iterable[str]:
+    """Return the pip install arguments for `requirements`
+
+    Each requirement is split into arguments like the shell would, which is how they used to be
+    passed to pip, so e.g. "--index-url URL" becomes two arguments. The options for files and
+    paths, like "-rrequirements.txt" or "--editable=.", are normalized to the short option
+    followed by the value.
+
+    """
+    for requirement in requirements:
+        try:
+            arguments = shlex.split(requirement)
+        except ValueError:
+            # Unbalanced quotes, let pip report it
+            arguments = [requirement]
+        for argument in arguments:
+            yield from _split_path_option(argument)
+
+
+def _split_path_option(argument: str) -> list[str]:
+    """Return `argument`, split in the short form of a pip path option and its value if it is one
+
+    E.g. "--requirement=docs.txt" and "-rdocs.txt" both become ["-r", "docs.txt"], and
+    "--editable" becomes ["-e"].
+
+    """
+    option, separator, value = argument.partition("=")
+    if option in PIP_PATH_OPTIONS:
+        short_option = PIP_PATH_OPTIONS[option]
+        return [short_option, value] if separator else [short_option]
+    if argument[:2] in PIP_PATH_OPTIONS.values() and len(argument) > 2:
+        return [argument[:2], argument[2:].lstrip("= ")]
+    return [argument]
+
+
+def _requirements_hash(arguments: list[str], local_repository: Path) -> str:
+    """Return a hash of the requirements in the pip install `arguments`
+
+    The hash covers the content of requirements files, as well as the content of the repository
+    if anything is installed from a local path.
+
+    """
+    hash_ = hashlib.sha256()
+    for argument in arguments:
+        hash_.update(argument.encode("utf-8") + b"\0")
+
+    installs_local_path = False
+    for previous, argument in zip([""] + arguments, arguments):
+        if previous in ("-r", "-c"):
+            _update_with_requirements_file(hash_, local_repository / argument, visited=set())
+        elif argument.startswith((".", "/")):
+            installs_local_path = True
+    if installs_local_path:
+        hash_.update(current_tree_hash(local_repository).encode("utf-8"))
+
+    return hash_.hexdigest()
+
+
+def _update_with_requirements_file(
+    hash_: "hashlib._Hash", requirements_path: Path, visited: set[Path]
+) -> None:
+    """Update `hash_` with the content of `requirements_path` and the files it includes
+
+    Files already in `visited` are skipped, so cyclic includes end.
+
+    """
+    resolved_path = requirements_path.resolve()
+    if resolved_path in visited:
+        return
+    visited.add(resolved_path)
+    try:
+        content = requirements_path.read_bytes()
+    except OSError:
+        # Let pip report the error
+        return
+    hash_.update(content)
+    for line in content.decode("utf-8", errors="replace").splitlines():
+        arguments = list(_pip_install_arguments([line.partition(" #")[0]]))
+        for previous, argument in zip([""] + arguments, arguments):
+            if previous in ("-r", "-c"):
+                _update_with_requirements_file(
+                    hash_, requirements_path.parent / argument, visited=visited
+                )
 
 
 def _create_venv(venv_dir: Path) -> None:
     """Create virtual environments in `venv_dir`"""
     subprocess.check_call(
-        # Important, for maximum compatibility, this has to point to a cPython, not merely
-        # /usr/bin/env python3 which will point to pypy3 if installed
-        f"/usr/bin/python3 -m venv {venv_dir}",
+        [BASE_PYTHON, "-m", "venv", str(venv_dir)],
         stderr=subprocess.PIPE,
         universal_newlines=True,
-        shell=True,
-        executable="/bin/bash",
-        env=os.environ.copy(),
     )
 
 
-def _cmd_in_venv(venv_dir: Path, command: str, working_dir: Optional[Path] = None) -> None:
-    activate = venv_dir / "bin" / "activate"
-    subprocess.check_call(
-        f"source {activate} && {command}",
+def _venv_environment(venv_dir: Path) -> dict[str, str]:
+    """Return the environment variables for running commands in the venv at `venv_dir`
+
+    This is what activating the venv does: prepend its bin dir to PATH and set VIRTUAL_ENV.
+
+    """
+    environment = os.environ.copy()
+    environment.pop("PYTHONHOME", None)
+    environment["VIRTUAL_ENV"] = str(venv_dir)
+    environment["PATH"] = os.pathsep.join((str(venv_dir / "bin"), environment.get("PATH", "")))
+    return environment
+
+
+def _cmd_in_venv(
+    venv_dir: Path,
+    command: str,
+    working_dir: Optional[Path] = None,
+    environment: Optional[dict[str, str]] = None,
+) -> None:
+    """Run `command` in the venv at `venv_dir` and stream its output to the log
+
+    The command is run directly, unless it needs shell syntax, in which case it is run with bash.
+
+    Raises:
+        subprocess.CalledProcessError: If the command fails, with the last lines of the output
+
+    """
+    logger = LOG.bind(cmd=command)
+    environment = environment or _venv_environment(venv_dir)
+    arguments = ["/bin/bash", "-c", command] if SHELL_SYNTAX_RE.search(command) else None
+    arguments = arguments or shlex.split(command)
+
+    output_tail: deque[str] = deque(maxlen=COMMAND_OUTPUT_TAIL_LINES)
+    with subprocess.Popen(
+        arguments,
         stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
         universal_newlines=True,
-        shell=True,
-        executable="/bin/bash",
-        env=os.environ.copy(),
+        errors="replace",
+        env=environment,
         cwd=working_dir,
-    )
+    ) as process:
+        for line in process.stdout:
+            line = line.rstrip()
+            logger.debug("Command output", line=line)
+            output_tail.append(line)
+
+    if process.returncode != 0:
+        logger.error("Command failed", returncode=process.returncode, output="\n".join(output_tail))
+        raise subprocess.CalledProcessError(
+            process.returncode, command, output="\n".join(output_tail)
+        )
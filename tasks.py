@@ -29,6 +29,7 @@ THIS_DIR = Path(__file__).parent.resolve()
 SOURCE_DIR = THIS_DIR / "src"
 ZILIEN_QT_DIR = SOURCE_DIR / "docset_builder"
 TEST_DIR = THIS_DIR / "tests"
+BENCHMARK_DIR = TEST_DIR / "benchmarks"
 
 
 # Checking tasks
@@ -119,6 +120,32 @@ def tests(
     return result.return_code
 
 
+@task(
+    aliases=["benchmark"],
+    help={
+        "size": "The size of the synthetic repositories, 'small' (10k files) or 'large' (200k)",
+        "repeats": "The number of times to run each benchmark",
+        "results": "The JSON lines file to append the results to and compare with",
+        "max_slowdown": (
+            "Fail if a benchmark is this fraction slower than the previous run, e.g. 0.25"
+        ),
+    },
+)
+def bench(context, size="small", repeats=5, results=None, max_slowdown=None):
+    """Run the offline benchmarks of the metadata and search hot paths"""
+    args = [f"--size {size}", f"--repeats {repeats}"]
+    if results:
+        args.append(f"--results {results}")
+    if max_slowdown:
+        args.append(f"--max-slowdown {max_slowdown}")
+    rprint("\n[bold]Benchmarking...")
+    with context.cd(THIS_DIR):
+        result = context.run(
+            f"python {BENCHMARK_DIR / 'search_benchmarks.py'} {' '.join(args)}", warn=True
+        )
+    return result.return_code
+
+
 @task(aliases=["check", "c"])
 def checks(context):
     """Check code with black, flake8, mypy and run tests"""
@@ -0,0 +1,231 @@
+"""This module benchmarks the PyPI metadata extraction and the repository search hot paths
+
+The benchmarks run offline, against the recorded PyPI documents in the functional test data and
+against synthetic repositories generated in a temporary directory: a large tree of files,
+a deep chain of requirements files that include each other, and a huge Makefile with long target
+dependency chains.
+
+Each run is appended as a JSON line to the results file, and compared to the previous run of the
+same size, so regressions show up as a change in the table. Run it with `invoke bench`, or
+directly with `python tests/benchmarks/search_benchmarks.py --help`.
+
+The module is deliberately not named like a test module, so pytest does not collect it.
+
+"""
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import click
+import structlog
+from rich.console import Console
+from rich.table import Table
+
+from docset_builder.data_structures import DocBuildInfo, PyPIInfo
+from docset_builder.pypi import extract_information_from_pypi
+from docset_builder.repository_index import build_repository_index
+from docset_builder.repository_search import (
+    MAKEFILE_DOC_TARGETS,
+    _add_icon_file,
+    _requirements_from_file,
+    get_docbuild_information,
+)
+from docset_builder.utils import extract_sections_from_makefile
+
+THIS_DIR = Path(__file__).parent.resolve()
+REPOSITORY_ROOT = THIS_DIR.parent.parent
+DATA_DIR = THIS_DIR.parent / "functional_tests" / "data"
+DEFAULT_RESULTS_PATH = THIS_DIR / "results.jsonl"
+
+# Size presets: (number of files, requirements include depth, Makefile targets)
+SIZES = {
+    "small": (10_000, 100, 1_000),
+    "large": (200_000, 400, 5_000),
+}
+FILES_PER_DIRECTORY = 50
+DIRECTORIES_PER_LEVEL = 20
+
+
+def make_synthetic_repository(path: Path, files: int, include_depth: int, targets: int) -> None:
+    """Write a synthetic repository to `path`
+
+    The repository has `files` source files, spread over a tree of package directories, a chain
+    of `include_depth` requirements files that each include the next one and a Makefile with
+    `targets` targets, in chains of dependencies that end in the "docs" target.
+
+    """
+    for number in range(files):
+        directory_number = number // FILES_PER_DIRECTORY
+        directory = (
+            path
+            / "src"
+            / f"package_{directory_number // DIRECTORIES_PER_LEVEL}"
+            / f"module_{directory_number % DIRECTORIES_PER_LEVEL}"
+        )
+        if number % FILES_PER_DIRECTORY == 0:
+            directory.mkdir(parents=True, exist_ok=True)
+        (directory / f"file_{number}.py").touch()
+
+    docs_dir = path / "docs"
+    docs_dir.mkdir()
+    (docs_dir / "conf.py").write_text("project = 'synthetic'\n")
+
+    requirements_dir = path / "requirements"
+    requirements_dir.mkdir()
+    for depth in range(include_depth):
+        lines = [f"package-{depth}>={depth}.0", "# A comment", ""]
+        if depth + 1 < include_depth:
+            lines.append(f"-r chain_{depth + 1}.txt")
+        (requirements_dir / f"chain_{depth}.txt").write_text("\n".join(lines) + "\n")
+    (path / "requirements.txt").write_text("sphinx\n-r requirements/chain_0.txt\n")
+
+    makefile_lines = []
+    chain_length = 50
+    for number in range(targets):
+        dependency = f" target_{number - 1}" if number % chain_length else ""
+        makefile_lines += [f"target_{number}:{dependency}", f"\techo {number}", ""]
+    last_targets = " ".join(
+        f"target_{number}" for number in range(chain_length - 1, targets, chain_length)
+    )
+    makefile_lines += [f"docs: {last_targets}", "\tsphinx-build docs docs/_build/html", ""]
+    (path / "Makefile").write_text("\n".join(makefile_lines))
+
+
+def time_function(function: Callable[[], object], repeats: int) -> dict[str, float]:
+    """Return the minimum and median wall clock time of calling `function` `repeats` times"""
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {"min": min(durations), "median": statistics.median(durations)}
+
+
+def make_benchmarks(repository_path: Path) -> dict[str, Callable[[], object]]:
+    """Return the benchmarks, by name, to run against the synthetic repository"""
+    pypi_documents = [
+        json.loads((package_dir / "pypi_raw.json").read_text())
+        for package_dir in sorted(DATA_DIR.iterdir())
+    ]
+    repository_index = build_repository_index(repository_path)
+
+    def extract_pypi() -> None:
+        for document in pypi_documents:
+            extract_information_from_pypi(PyPIInfo(), document)
+
+    return {
+        "extract_information_from_pypi": extract_pypi,
+        "build_repository_index": lambda: build_repository_index(repository_path),
+        "get_docbuild_information": lambda: get_docbuild_information(
+            "synthetic", repository_path, use_cache=False
+        ),
+        "_add_icon_file": lambda: _add_icon_file(repository_index, DocBuildInfo()),
+        "_requirements_from_file": lambda: list(
+            _requirements_from_file(repository_path / "requirements.txt")
+        ),
+        "extract_sections_from_makefile": lambda: extract_sections_from_makefile(
+            repository_path / "Makefile", targets=MAKEFILE_DOC_TARGETS
+        ),
+    }
+
+
+def load_previous_run(results_path: Path, size: str) -> Optional[dict[str, dict[str, float]]]:
+    """Return the results of the last run of `size` in `results_path`, if any"""
+    if not results_path.exists():
+        return None
+    previous = None
+    with open(results_path) as file_:
+        for line in file_:
+            if line.strip() and (record := json.loads(line))["size"] == size:
+                previous = record["results"]
+    return previous
+
+
+def current_commit() -> str:
+    """Return the commit hash of the checked out docset-builder source, if available"""
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPOSITORY_ROOT, stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return output.decode("utf-8").strip()
+
+
+@click.command()
+@click.option("--size", type=click.Choice(list(SIZES)), default="small", show_default=True)
+@click.option("--repeats", type=click.IntRange(min=1), default=5, show_default=True)
+@click.option(
+    "--results",
+    "results_path",
+    type=Path,
+    default=DEFAULT_RESULTS_PATH,
+    show_default=True,
+    help="The JSON lines file the results are appended to and compared with",
+)
+@click.option(
+    "--max-slowdown",
+    type=float,
+    default=None,
+    help="Exit with an error, if a benchmark is this fraction slower than last run, e.g. 0.25",
+)
+def main(size: str, repeats: int, results_path: Path, max_slowdown: Optional[float]) -> None:
+    """Run the search benchmarks and compare the results to the previous run"""
+    # The search logs at info level for every file and requirement, which would be measured too
+    structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR))
+    files, include_depth, targets = SIZES[size]
+    console = Console()
+    previous = load_previous_run(results_path, size)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir_name:
+        repository_path = Path(tmp_dir_name)
+        with console.status(f"Generating synthetic repository with {files} files"):
+            make_synthetic_repository(repository_path, files, include_depth, targets)
+        for name, function in make_benchmarks(repository_path).items():
+            with console.status(f"Running {name}"):
+                results[name] = time_function(function, repeats)
+
+    record = {
+        "timestamp": time.time(),
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "size": size,
+        "repeats": repeats,
+        "results": results,
+    }
+    with open(results_path, "a") as file_:
+        file_.write(json.dumps(record) + "\n")
+
+    table = Table(title=f"Search benchmarks ({size}, best of {repeats})")
+    table.add_column("Benchmark", style="cyan")
+    for column_name in ("Min", "Median", "Previous min", "Change"):
+        table.add_column(column_name, justify="right")
+    regressions = []
+    for name, timings in results.items():
+        previous_min = previous.get(name, {}).get("min") if previous else None
+        change = timings["min"] / previous_min - 1 if previous_min else None
+        if max_slowdown is not None and change is not None and change > max_slowdown:
+            regressions.append(name)
+        table.add_row(
+            name,
+            f"{timings['min'] * 1000:.1f} ms",
+            f"{timings['median'] * 1000:.1f} ms",
+            "-" if previous_min is None else f"{previous_min * 1000:.1f} ms",
+            "-" if change is None else f"{change:+.0%}",
+        )
+    console.print(table)
+    console.print(f"Results appended to {results_path}")
+
+    if regressions:
+        raise click.ClickException(f"Benchmarks slower than the previous run: {regressions}")
+
+
+if __name__ == "__main__":
+    main()
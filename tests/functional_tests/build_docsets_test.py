@@ -0,0 +1,63 @@
+"""This module tests building docsets in-process from minimal Sphinx output"""
+import sqlite3
+import zlib
+
+from click import ClickException
+from pytest import mark, raises
+
+from docset_builder import build_docsets
+from docset_builder.build_docsets import build_docset
+from docset_builder.data_structures import DocBuildInfo
+
+PAGE_COUNT = 3
+
+
+def make_sphinx_output(html_dir):
+    """Write an objects.inv and HTML pages, as Sphinx would, to `html_dir`"""
+    html_dir.mkdir()
+    inventory_lines = []
+    for number in range(PAGE_COUNT):
+        (html_dir / f"page{number}.html").write_text(
+            f'<html><body><h1>Page {number}</h1><dl><dt id="dummy.function{number}">'
+            f'<a class="headerlink" href="#dummy.function{number}">#</a></dt></dl></body></html>'
+        )
+        inventory_lines.append(f"dummy.function{number} py:function 1 page{number}.html#$ -")
+    inventory_lines.append("missing py:function 1 page0.html#missing -")
+    (html_dir / "index.html").write_text("<html><body>Index</body></html>")
+    header = b"# Sphinx inventory version 2\n# Project: dummy\n# Version: 1.0\n"
+    header += b"# The remainder of this file is compressed using zlib.\n"
+    compressed = zlib.compress("\n".join(inventory_lines).encode("utf-8"))
+    (html_dir / "objects.inv").write_bytes(header + compressed)
+
+
+@mark.parametrize("build_jobs", [None, "2"])
+def test_building_docset(tmp_path, monkeypatch, build_jobs):
+    # Patch every file in its own process, to test that too
+    monkeypatch.setattr(build_docsets, "MIN_FILES_FOR_PROCESS_POOL", 1)
+    monkeypatch.setattr(build_docsets, "INDEX_BATCH_SIZE", 2)
+    html_dir = tmp_path / "html"
+    make_sphinx_output(html_dir)
+    docset_build_dir = tmp_path / "docset"
+    docset_build_dir.mkdir()
+    (docset_build_dir / "unrelated").mkdir()
+
+    docbuild_info = DocBuildInfo(start_page="index.html", build_jobs=build_jobs)
+    docset_path = build_docset(html_dir, docbuild_info, docset_build_dir)
+
+    assert docset_path == docset_build_dir / "dummy.docset"
+    resources = docset_path / "Contents" / "Resources"
+    with sqlite3.connect(resources / "docSet.dsidx") as connection:
+        (count,) = connection.execute("SELECT COUNT(*) FROM searchIndex").fetchone()
+    assert count == PAGE_COUNT + 1
+    page = (resources / "Documents" / "page1.html").read_text()
+    assert '<a class="dashAnchor" name="//apple_ref/cpp/Function/dummy.function1">' in page
+
+
+def test_building_docset_with_missing_start_page(tmp_path):
+    html_dir = tmp_path / "html"
+    make_sphinx_output(html_dir)
+
+    with raises(ClickException, match="start page"):
+        build_docset(html_dir, DocBuildInfo(start_page="start.html"), tmp_path)
+    with raises(ClickException, match="documentation format"):
+        build_docset(tmp_path, DocBuildInfo(), tmp_path)
@@ -0,0 +1,20 @@
+"""This module tests the serialization of the data structures"""
+from pathlib import Path
+
+from pytest import raises
+
+from docset_builder.data_structures import DocBuildInfo
+
+
+def test_docbuild_info_round_trip():
+    docbuild_info = DocBuildInfo(
+        basedir_for_building_docs=Path("/repositories/dummy/docs"),
+        doc_build_commands=["make html"],
+        start_page="index.html",
+    )
+    assert DocBuildInfo.from_dict(docbuild_info.to_dict()) == docbuild_info
+
+
+def test_docbuild_info_from_dict_with_unknown_keys():
+    with raises(ValueError, match="docdir"):
+        DocBuildInfo.from_dict({"docdir": "dummy/docs", "start_page": "index.html"})
@@ -0,0 +1,85 @@
+"""This module tests writing docsets as archives for distribution"""
+import gzip
+import json
+import os
+import shutil
+import tarfile
+from pathlib import Path
+
+from click.testing import CliRunner
+from pytest import mark, skip
+
+from docset_builder import docset_archive
+from docset_builder.docset_archive import ArchiveOptions, write_docset_archive
+from docset_builder.main import cli
+
+
+@mark.parametrize("threads", [1, 2])
+def test_writing_docset_archive(tmp_path, threads):
+    if threads > 1 and shutil.which("pigz") is None:
+        skip("pigz is not installed")
+    docset_path = tmp_path / "dummy 1.0.docset"
+    documents_dir = docset_path / "Contents" / "Resources" / "Documents"
+    documents_dir.mkdir(parents=True)
+    (documents_dir / "index.html").write_text("<html>Index</html>")
+    (documents_dir / "latest").symlink_to(documents_dir)
+    options = ArchiveOptions(
+        archive_dir=tmp_path / "archives",
+        compression_level=1,
+        threads=threads,
+        write_index=True,
+        feed_base_url="https://docsets.example.com/",
+    )
+
+    archive_path = write_docset_archive(docset_path, version="1.0 & more", options=options)
+
+    assert archive_path == tmp_path / "archives" / "dummy 1.0.tgz"
+    with tarfile.open(archive_path) as tar:
+        names = tar.getnames()
+        assert tar.getmember("dummy 1.0.docset/Contents/Resources/Documents/latest").issym()
+    assert names[0] == "dummy 1.0.docset"
+    assert "dummy 1.0.docset/Contents/Resources/Documents/index.html" in names
+    index = json.loads((tmp_path / "archives" / "dummy 1.0.tgz.index.json").read_text())
+    assert [member["name"] for member in index] == names
+    feed = (tmp_path / "archives" / "dummy 1.0.xml").read_text()
+    assert "<version>1.0 &amp; more</version>" in feed
+    assert "<url>https://docsets.example.com/dummy%201.0.tgz</url>" in feed
+
+
+@mark.parametrize("threads", [1, 4])
+def test_reading_members_through_archive_index(tmp_path, monkeypatch, threads):
+    monkeypatch.setattr(docset_archive, "INDEX_RESTART_INTERVAL", 4096)
+    docset_path = tmp_path / "dummy.docset"
+    documents_dir = docset_path / "Contents" / "Resources" / "Documents"
+    documents_dir.mkdir(parents=True)
+    contents = {f"page{number}.html": os.urandom(number * 1000) for number in range(20)}
+    for name, content in contents.items():
+        (documents_dir / name).write_bytes(content)
+    options = ArchiveOptions(archive_dir=tmp_path, threads=threads, write_index=True)
+
+    archive_path = write_docset_archive(docset_path, version="1.0", options=options)
+
+    # The archive reads as usual
+    with tarfile.open(archive_path) as tar:
+        names = [name for name in tar.getnames() if name.endswith(".html")]
+    assert sorted(Path(name).name for name in names) == sorted(contents)
+    # The members can be read from the archive by seeking, without decompressing it from the start
+    index = json.loads((tmp_path / "dummy.tgz.index.json").read_text())
+    assert len({member["gzip_member_offset"] for member in index}) > 1
+    with open(archive_path, "rb") as file_:
+        for member in index:
+            file_.seek(member["gzip_member_offset"])
+            stream = gzip.GzipFile(fileobj=file_)
+            stream.read(member["offset"] - member["gzip_member_start"])
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                tarinfo = tar.next()
+                assert tarinfo.name == member["name"]
+                if tarinfo.isreg():
+                    assert tar.extractfile(tarinfo).read() == contents[Path(tarinfo.name).name]
+
+
+@mark.parametrize("option", [["--archive-index"], ["--feed-base-url", "https://example.org"]])
+def test_archive_options_require_archive_dir(option):
+    result = CliRunner().invoke(cli, ["install", *option, "dummy"])
+    assert result.exit_code == 2
+    assert "require --archive-dir" in result.output
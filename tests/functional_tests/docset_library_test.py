@@ -0,0 +1,110 @@
+"""This module tests installing docsets from the versioned docset store"""
+from pytest import fixture
+
+from docset_builder import config, docset_library, metadata_store
+from docset_builder.docset_library import (
+    deduplicate_installed_docsets,
+    install_docset,
+    new_docset_version_dir,
+    undeduplicate_installed_docsets,
+    uninstall_docset,
+    wait_for_garbage_collection,
+)
+
+
+def build_dummy_docset(package_name, version, name="dummy.docset"):
+    with new_docset_version_dir(package_name, version=version) as version_dir:
+        docset_dir = version_dir / name
+        (docset_dir / "Contents").mkdir(parents=True)
+        (docset_dir / "Contents" / "version.txt").write_text(version)
+        (docset_dir / "Contents" / "theme.css").write_text("body {}" * 1000)
+    return docset_dir
+
+
+@fixture
+def install_base_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metadata_store, "METADATA_STORE_PATH", tmp_path / "metadata.sqlite")
+    monkeypatch.setattr(docset_library, "DOCSET_STORE_DIR", tmp_path / "store")
+    content_store_dir = tmp_path / "content_store"
+    content_store_dir.mkdir()
+    monkeypatch.setattr(docset_library, "CONTENT_STORE_DIR", content_store_dir)
+    install_base_dir = tmp_path / "docsets"
+    install_base_dir.mkdir()
+    monkeypatch.setattr(config, "install_base_dir", install_base_dir)
+    return install_base_dir
+
+
+def test_installing_docsets_by_swapping_links(tmp_path, install_base_dir):
+    install_dir = install_base_dir / "dummy.docset"
+
+    # A docset installed as a plain directory, by an older version, is replaced
+    (install_dir / "Contents").mkdir(parents=True)
+    first_docset_dir = build_dummy_docset("dummy", "1.0")
+    install_docset(first_docset_dir, package_name="dummy", version="1.0")
+    wait_for_garbage_collection()
+    assert install_dir.resolve() == first_docset_dir
+    assert [path.name for path in install_base_dir.iterdir()] == ["dummy.docset"]
+
+    # Installing a new version swaps the link and removes the old version from the store
+    second_docset_dir = build_dummy_docset("dummy", "2.0")
+    install_docset(second_docset_dir, package_name="dummy", version="2.0")
+    wait_for_garbage_collection()
+    assert (install_dir / "Contents" / "version.txt").read_text() == "2.0"
+    assert not first_docset_dir.exists()
+
+    # A docset that changes name replaces the one with the old name
+    renamed_docset_dir = build_dummy_docset("dummy", "3.0", name="Dummy.docset")
+    install_docset(renamed_docset_dir, package_name="dummy", version="3.0")
+    wait_for_garbage_collection()
+    assert [path.name for path in install_base_dir.iterdir()] == ["Dummy.docset"]
+    assert [path.parent for path in (tmp_path / "store").glob("dummy/*/*")] == [
+        renamed_docset_dir.parent
+    ]
+
+
+def test_keeping_versions_that_are_being_built(install_base_dir):
+    first_docset_dir = build_dummy_docset("dummy", "1.0")
+    install_docset(first_docset_dir, package_name="dummy", version="1.0")
+    wait_for_garbage_collection()
+
+    # E.g. in another process
+    with new_docset_version_dir("dummy", version="3.0") as concurrent_version_dir:
+        second_docset_dir = build_dummy_docset("dummy", "2.0")
+        install_docset(second_docset_dir, package_name="dummy", version="2.0")
+        garbage_collector = docset_library._GARBAGE_COLLECTORS[-1]
+        garbage_collector.join(timeout=0.2)
+        assert garbage_collector.is_alive()
+        assert first_docset_dir.exists() and concurrent_version_dir.exists()
+
+    wait_for_garbage_collection()
+    assert not first_docset_dir.exists()
+    assert second_docset_dir.exists()
+
+
+def test_deduplicating_static_assets(tmp_path, install_base_dir):
+    for package_name in ("dummy", "other"):
+        docset_dir = build_dummy_docset(package_name, "1.0", name=f"{package_name}.docset")
+        install_docset(docset_dir, package_name=package_name, version="1.0")
+    wait_for_garbage_collection()
+    dummy_css, other_css = (
+        install_base_dir / f"{name}.docset" / "Contents" / "theme.css"
+        for name in ("dummy", "other")
+    )
+
+    report = deduplicate_installed_docsets()
+    assert (report.files, report.linked, report.bytes_reclaimed) == (2, 1, 7000)
+    assert (report.store_files, report.store_bytes) == (1, 7000)
+    assert dummy_css.samefile(other_css)
+    # A second pass has nothing to do
+    assert deduplicate_installed_docsets().linked == 0
+
+    # Uninstalling one docset keeps the file of the other one
+    uninstall_docset("dummy")
+    assert not (install_base_dir / "dummy.docset").exists()
+    assert other_css.stat().st_nlink == 2
+    assert metadata_store.load_installed_docset_for_package("dummy") is None
+
+    report = undeduplicate_installed_docsets()
+    assert report.linked == 1
+    assert other_css.stat().st_nlink == 1
+    assert not list((tmp_path / "content_store").glob("*/*"))
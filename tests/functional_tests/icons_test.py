@@ -0,0 +1,102 @@
+"""This module tests finding and preparing docset icons"""
+from io import BytesIO
+
+from pytest import fixture, importorskip
+
+from docset_builder import icons
+from docset_builder.icons import find_icon, prepare_icons
+from docset_builder.repository_index import build_repository_index
+
+
+@fixture
+def icon_cache_dir(tmp_path, monkeypatch):
+    icon_cache_dir = tmp_path / "icons"
+    monkeypatch.setattr(icons, "ICON_CACHE_DIR", icon_cache_dir)
+    return icon_cache_dir
+
+
+def make_png(width, height):
+    image_module = importorskip("PIL.Image")
+    output = BytesIO()
+    image_module.new("RGBA", (width, height), (255, 0, 0, 255)).save(output, format="PNG")
+    return output.getvalue()
+
+
+def test_finding_icon(tmp_path):
+    for relative_path in ("logo.png", "src/favicon.png", "docs/_static/logo.svg"):
+        (tmp_path / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / relative_path).touch()
+    assert find_icon(build_repository_index(tmp_path)) == tmp_path / "docs/_static/logo.svg"
+
+    (tmp_path / "docs/_static/favicon.ico").touch()
+    assert find_icon(build_repository_index(tmp_path)) == tmp_path / "docs/_static/favicon.ico"
+    assert find_icon(build_repository_index(tmp_path / "src" / "favicon.png")) is None
+
+
+def test_preparing_icons_is_cached(tmp_path, icon_cache_dir, monkeypatch):
+    image_module = importorskip("PIL.Image")
+    icon_path = tmp_path / "logo.png"
+    icon_path.write_bytes(make_png(128, 64))
+
+    icon_dir = prepare_icons(icon_path)
+    assert icon_dir.parent == icon_cache_dir
+    for name, size in icons.ICON_SIZES.items():
+        with image_module.open(icon_dir / name) as image:
+            assert image.size == (size, size)
+
+    def fail(*_):
+        raise AssertionError("Converted a cached icon again")
+
+    monkeypatch.setattr(icons, "_convert", fail)
+    assert prepare_icons(icon_path) == icon_dir
+
+
+def test_preparing_icons_without_pillow(tmp_path, icon_cache_dir, monkeypatch):
+    monkeypatch.setattr(icons, "PILImage", None)
+    monkeypatch.setattr(icons, "cairosvg", None)
+    icon_path = tmp_path / "favicon.png"
+    icon_path.write_bytes(icons.PNG_HEADER + b"rest of the image")
+    icon_dir = prepare_icons(icon_path)
+    assert [path.name for path in icon_dir.iterdir()] == ["icon.png"]
+
+    for name in ("favicon.ico", "favicon.svg"):
+        (tmp_path / name).write_bytes(b"<not a png>")
+        assert prepare_icons(tmp_path / name) is None
+
+
+def test_passthrough_icons_are_not_used_with_pillow(tmp_path, icon_cache_dir, monkeypatch):
+    icon_path = tmp_path / "favicon.png"
+    icon_path.write_bytes(make_png(128, 128))
+    with monkeypatch.context() as context:
+        context.setattr(icons, "PILImage", None)
+        passthrough_icon_dir = prepare_icons(icon_path)
+
+    icon_dir = prepare_icons(icon_path)
+    assert icon_dir != passthrough_icon_dir
+    assert sorted(path.name for path in icon_dir.iterdir()) == ["icon.png", "icon@2x.png"]
+
+
+def test_preparing_icons_from_svg(tmp_path, icon_cache_dir, monkeypatch):
+    image_module = importorskip("PIL.Image")
+
+    class StandInCairoSVG:
+        """Rasterizes any SVG image as a wide rectangle, or fails for a malformed one"""
+
+        @staticmethod
+        def svg2png(bytestring, output_width):
+            if b"<svg" not in bytestring:
+                raise ValueError("Malformed SVG image")
+            return make_png(output_width, output_width // 2)
+
+    monkeypatch.setattr(icons, "cairosvg", StandInCairoSVG)
+    icon_path = tmp_path / "logo.svg"
+    icon_path.write_bytes(b"<svg/>")
+    icon_dir = prepare_icons(icon_path)
+    with image_module.open(icon_dir / "icon@2x.png") as image:
+        assert image.size == (32, 32)
+        # Letterboxed, not stretched
+        assert image.getpixel((16, 0))[3] == 0
+        assert image.getpixel((16, 16))[3] == 255
+
+    icon_path.write_bytes(b"<not svg")
+    assert prepare_icons(icon_path) is None
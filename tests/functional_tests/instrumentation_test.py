@@ -0,0 +1,34 @@
+"""This module tests the instrumentation of install runs"""
+import json
+
+from pytest import raises
+
+from docset_builder import instrumentation
+from docset_builder.data_structures import PackageResult
+
+
+def test_measuring_stages_and_counting_cache_hits(tmp_path):
+    instrumentation.reset()
+    with instrumentation.measure("attrs", "search"):
+        pass
+    with raises(RuntimeError), instrumentation.measure("attrs", "doc_build"):
+        raise RuntimeError("Build failed")
+    instrumentation.count_hit("pypi", hit=True)
+    instrumentation.count_hit("pypi", hit=False)
+    instrumentation.count("package_cache", hits=3, misses=1)
+
+    report_path = tmp_path / "metrics.json"
+    results = [PackageResult(package_name="attrs", succeeded=False, duration=1.0, error="Boom")]
+    instrumentation.write_report(report_path, results, jobs=2)
+    instrumentation.print_metrics_summary()
+
+    report = json.loads(report_path.read_text())
+    assert report["jobs"] == 2
+    assert report["packages"][0]["error"] == "Boom"
+    assert [(stage["stage"], stage["succeeded"]) for stage in report["stages"]] == [
+        ("search", True),
+        ("doc_build", False),
+    ]
+    assert report["counters"]["pypi"] == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+    assert report["counters"]["package_cache"]["hit_rate"] == 0.75
+    assert report["resources"]["max_rss"] > 0
@@ -0,0 +1,89 @@
+"""This module tests the migrations of and concurrent writes to the metadata store"""
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pytest import fixture
+
+from docset_builder import metadata_store
+from docset_builder.data_structures import CacheStatistics, PyPICacheEntry, PyPIInfo
+
+
+@fixture
+def metadata_store_path(tmp_path, monkeypatch):
+    metadata_store_path = tmp_path / "metadata.sqlite"
+    monkeypatch.setattr(metadata_store, "METADATA_STORE_PATH", metadata_store_path)
+    monkeypatch.setattr(
+        metadata_store, "INSTALLED_DOCSETS_INDEX", tmp_path / "installed_docsets.json"
+    )
+    return metadata_store_path
+
+
+def test_migrating_from_an_older_schema_version(metadata_store_path):
+    # A metadata store written by a version with only the first three migrations
+    connection = sqlite3.connect(metadata_store_path)
+    for migration in metadata_store.MIGRATIONS[:3]:
+        for statement in migration:
+            connection.execute(statement)
+    connection.execute("PRAGMA user_version=3")
+    connection.execute(
+        "INSERT INTO installed_docsets (docset_name, package_name, version, installed_at) "
+        "VALUES ('arrow.docset', 'arrow', '1.2.3', 0.0)"
+    )
+    connection.execute("INSERT INTO pypi_info VALUES ('arrow', '{}', '\"etag\"', NULL, 0.0)")
+    connection.commit()
+    connection.close()
+
+    # The data in the older tables is kept and the newer tables are usable
+    installed_docset = metadata_store.load_installed_docset("arrow.docset")
+    assert (installed_docset.package_name, installed_docset.version) == ("arrow", "1.2.3")
+    assert installed_docset.fingerprint is None
+    metadata_store.record_package_cache_statistics("pip", CacheStatistics(hits=1, misses=2))
+    assert metadata_store.load_package_cache_statistics() == {
+        "pip": CacheStatistics(hits=1, misses=2)
+    }
+    # The cached PyPI information, of unknown API, is dropped
+    assert metadata_store.load_pypi_cache_entry("arrow", api="json") is None
+    cache_entry = PyPICacheEntry(pypi_info=PyPIInfo(package_name="arrow"), fetched_at=time.time())
+    metadata_store.store_pypi_cache_entry("arrow", "simple", cache_entry)
+    assert metadata_store.load_pypi_cache_entry("arrow", api="simple") == cache_entry
+
+    connection = sqlite3.connect(metadata_store_path)
+    (schema_version,) = connection.execute("PRAGMA user_version").fetchone()
+    connection.close()
+    assert schema_version == len(metadata_store.MIGRATIONS)
+
+
+def test_importing_installed_docsets_index(metadata_store_path):
+    index_path = metadata_store.INSTALLED_DOCSETS_INDEX
+    index_path.write_text(json.dumps({"arrow.docset": "version", "attrs.docset": "version"}))
+
+    installed_docsets = metadata_store.list_installed_docsets()
+
+    assert [docset.docset_name for docset in installed_docsets] == ["arrow.docset", "attrs.docset"]
+    # The index is imported only once
+    assert not index_path.exists()
+    assert index_path.with_suffix(".json.imported").exists()
+
+
+def test_concurrent_writers(metadata_store_path):
+    package_names = [f"package{number}" for number in range(8)]
+
+    def write(package_name):
+        # Every thread has its own connection to the store
+        for number in range(10):
+            metadata_store.record_checkout(package_name, f"v{number}", f"{number:040x}")
+            metadata_store.record_package_cache_statistics("pip", CacheStatistics(hits=1, misses=0))
+        metadata_store.record_installed_docset(f"{package_name}.docset", package_name, "v9")
+
+    with ThreadPoolExecutor(max_workers=len(package_names)) as executor:
+        list(executor.map(write, package_names))
+
+    # No updates are lost
+    assert metadata_store.load_package_cache_statistics() == {
+        "pip": CacheStatistics(hits=10 * len(package_names), misses=0)
+    }
+    for package_name in package_names:
+        assert metadata_store.load_checkout(package_name) == ("v9", f"{9:040x}")
+    assert len(metadata_store.list_installed_docsets()) == len(package_names)
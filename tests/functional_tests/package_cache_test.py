@@ -0,0 +1,46 @@
+"""This module tests the least recently used eviction of the package cache"""
+import os
+
+from click.testing import CliRunner
+
+from docset_builder import metadata_store
+from docset_builder.data_structures import CacheStatistics
+from docset_builder.main import cli
+from docset_builder.package_cache import parse_size, prune_package_cache
+
+
+def test_pruning_evicts_least_recently_used_entries(tmp_path):
+    # Unpacked wheels in the uv cache are evicted as a whole
+    for last_used, relative_path in enumerate(
+        (
+            "pip/http-v2/a/old",
+            "uv/archive-v0/abc/six.py",
+            "uv/archive-v0/abc/six-1.0.dist-info/RECORD",
+            "wheelhouse/sphinx-7.0-py3-none-any.whl",
+            "pip/http-v2/b/new",
+        )
+    ):
+        path = tmp_path / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (last_used, last_used))
+
+    evicted = prune_package_cache(parse_size("0.25k"), cache_dir=tmp_path)
+
+    assert [entry.path for entry in evicted] == [
+        tmp_path / "pip/http-v2/a/old",
+        tmp_path / "uv/archive-v0/abc",
+    ]
+    assert not (tmp_path / "uv/archive-v0/abc").exists()
+    assert (tmp_path / "wheelhouse/sphinx-7.0-py3-none-any.whl").exists()
+    assert parse_size("2G") == 2 * 1024**3
+
+
+def test_resetting_package_cache_statistics(tmp_path, monkeypatch):
+    monkeypatch.setattr(metadata_store, "METADATA_STORE_PATH", tmp_path / "metadata.sqlite")
+    metadata_store.record_package_cache_statistics("pip", CacheStatistics(hits=3, misses=1))
+    assert metadata_store.load_package_cache_statistics()["pip"].hits == 3
+
+    result = CliRunner().invoke(cli, ["cache", "reset-stats"])
+    assert result.exit_code == 0
+    assert metadata_store.load_package_cache_statistics() == {}
@@ -0,0 +1,232 @@
+"""This module tests fetching PyPI information against a local stand-in for PyPI"""
+import hashlib
+import json
+import threading
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import listdir
+from pathlib import Path
+from unittest.mock import Mock
+
+from pytest import fixture
+
+from docset_builder.data_structures import PyPICacheEntry
+from docset_builder.pypi import (
+    find_latest_release,
+    get_information_for_package,
+    get_information_for_packages,
+    make_pool_manager,
+)
+
+THIS_DIR = Path(__file__).parent.resolve()
+DATA_DIR = THIS_DIR / "data"
+MODULES = listdir(DATA_DIR)
+
+
+class StandInPyPIHandler(BaseHTTPRequestHandler):
+    """Serve the recorded PyPI JSON documents at /pypi/<package>/json
+
+    A PEP 691 Simple API document, generated from the recorded document, is served at
+    /simple/<package>/.
+
+    The package "flaky" fails with a 503 the first time it is requested and the package
+    "malformed" is served a document that is not JSON. Conditional requests with a matching ETag
+    are answered with a 304.
+
+    """
+
+    requests_seen: list[str] = []
+    statuses_sent: list[int] = []
+
+    def do_GET(self):  # noqa: N802
+        self.requests_seen.append(self.path)
+        _, api, package_name, _ = self.path.split("/")
+        if package_name == "flaky" and self.requests_seen.count(self.path) == 1:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        if package_name == "malformed":
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b"{not json")
+            return
+
+        raw_path = DATA_DIR / package_name.replace("flaky", "arrow") / "pypi_raw.json"
+        if not raw_path.exists():
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = raw_path.read_bytes()
+        if api == "simple":
+            body = simple_api_document(body)
+        etag = f'"{hashlib.sha256(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.statuses_sent.append(304)
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.statuses_sent.append(200)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+
+def simple_api_document(raw_pypi_json):
+    """Return a PEP 691 Simple API document generated from `raw_pypi_json`"""
+    releases = json.loads(raw_pypi_json)["releases"]
+    simple_api_json = {
+        "meta": {"api-version": "1.1"},
+        "versions": list(releases),
+        "files": [file_ for files in releases.values() for file_ in files],
+    }
+    return json.dumps(simple_api_json).encode("utf-8")
+
+
+@fixture
+def stand_in_pypi():
+    StandInPyPIHandler.requests_seen = []
+    StandInPyPIHandler.statuses_sent = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInPyPIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_batch_fetching_from_stand_in_pypi(stand_in_pypi):
+    mock_load_pypi_cache = Mock(return_value=None)
+    package_names = MODULES + ["flaky", "does-not-exist", "malformed"]
+
+    errors = {}
+    pypi_infos = get_information_for_packages(
+        package_names,
+        max_concurrency=4,
+        errors=errors,
+        _load_pypi_cache_entry=mock_load_pypi_cache,
+        _cache_pypi_info=Mock(),
+        _http=make_pool_manager(max_concurrency=4, backoff_factor=0),
+        _base_url=f"{stand_in_pypi}/pypi",
+    )
+
+    # The unknown and the malformed packages are left out, the flaky one is retried
+    assert set(pypi_infos) == set(MODULES) | {"flaky"}
+    assert set(errors) == {"does-not-exist", "malformed"}
+    assert StandInPyPIHandler.requests_seen.count("/pypi/flaky/json") == 2
+    for package_name, pypi_info in pypi_infos.items():
+        assert pypi_info.package_name == package_name
+        assert pypi_info.repository_url is not None
+        assert pypi_info.latest_release is not None
+
+
+def test_revalidating_stale_cache_with_etag(stand_in_pypi):
+    cache = {}
+
+    def load_pypi_cache_entry(package_name, api):
+        return cache.get((package_name, api))
+
+    def cache_pypi_info(package_name, pypi_info, api, etag=None, last_modified=None):
+        cache[package_name, api] = PyPICacheEntry(
+            pypi_info=pypi_info, etag=etag, last_modified=last_modified, fetched_at=time.time()
+        )
+
+    def get_information(cache_ttl, use_simple_api=False):
+        return get_information_for_package(
+            MODULES[0],
+            cache_ttl=cache_ttl,
+            use_simple_api=use_simple_api,
+            _load_pypi_cache_entry=load_pypi_cache_entry,
+            _cache_pypi_info=cache_pypi_info,
+            _http=make_pool_manager(),
+            _base_url=f"{stand_in_pypi}/pypi",
+            _simple_base_url=f"{stand_in_pypi}/simple",
+        )
+
+    # The first fetch is a full download, and within the TTL no request is made at all
+    pypi_info = get_information(cache_ttl=3600)
+    assert get_information(cache_ttl=3600) == pypi_info
+    assert StandInPyPIHandler.statuses_sent == [200]
+
+    # After the TTL, the cache entry is revalidated with the stored ETag
+    fetched_at = cache[MODULES[0], "json"].fetched_at
+    assert get_information(cache_ttl=0) == pypi_info
+    assert StandInPyPIHandler.statuses_sent == [200, 304]
+    assert cache[MODULES[0], "json"].fetched_at > fetched_at
+
+    # The Simple API has its own cache entry, so it is not served the JSON API information
+    simple_pypi_info = get_information(cache_ttl=3600, use_simple_api=True)
+    assert simple_pypi_info.repository_url is None
+    assert StandInPyPIHandler.statuses_sent == [200, 304, 200]
+    assert set(cache) == {(MODULES[0], "json"), (MODULES[0], "simple")}
+
+
+def test_releasing_connections_on_not_modified_and_errors(stand_in_pypi):
+    cache = {}
+
+    def load_pypi_cache_entry(package_name, api):
+        return cache.get((package_name, api))
+
+    def cache_pypi_info(package_name, pypi_info, api, etag=None, last_modified=None):
+        cache[package_name, api] = PyPICacheEntry(
+            pypi_info=pypi_info, etag=etag, last_modified=last_modified, fetched_at=time.time()
+        )
+
+    # With a pool of a single connection, any connection not given back blocks the next request
+    http = make_pool_manager(max_concurrency=1, retries=0)
+    get_information = partial(
+        get_information_for_packages,
+        MODULES + ["typo-one", "typo-two"],
+        max_concurrency=1,
+        cache_ttl=0,
+        _load_pypi_cache_entry=load_pypi_cache_entry,
+        _cache_pypi_info=cache_pypi_info,
+        _http=http,
+        _base_url=f"{stand_in_pypi}/pypi",
+    )
+    results = []
+    for _ in range(2):
+        thread = threading.Thread(target=lambda: results.append(get_information()), daemon=True)
+        thread.start()
+        thread.join(timeout=30)
+        assert not thread.is_alive()
+
+    assert set(results[0]) == set(results[1]) == set(MODULES)
+    assert StandInPyPIHandler.statuses_sent == [200] * len(MODULES) + [304] * len(MODULES)
+
+
+def test_json_and_simple_api_agree_on_latest_release(stand_in_pypi):
+    for package_name in MODULES:
+        pypi_infos = [
+            get_information_for_package(
+                package_name,
+                use_cache=False,
+                use_simple_api=use_simple_api,
+                _cache_pypi_info=Mock(),
+                _http=make_pool_manager(),
+                _base_url=f"{stand_in_pypi}/pypi",
+                _simple_base_url=f"{stand_in_pypi}/simple",
+            )
+            for use_simple_api in (False, True)
+        ]
+        assert pypi_infos[0].latest_release == pypi_infos[1].latest_release
+        # The Simple API holds no project URLs
+        assert pypi_infos[1].repository_url is None
+    assert f"/simple/{MODULES[0]}/" in StandInPyPIHandler.requests_seen
+
+
+def test_finding_latest_release():
+    releases = [("1.0", False), ("10.0rc1", False), ("9.1", False), ("9.2", True), ("junk", False)]
+    assert find_latest_release(releases) == "9.1"
+    assert find_latest_release([("2.0b1", False), ("2.0a1", False)]) == "2.0b1"
+    assert find_latest_release([]) is None
@@ -0,0 +1,74 @@
+"""This module tests updating repositories against a local upstream repository"""
+import subprocess
+
+from pytest import fixture
+
+from docset_builder import repositories
+from docset_builder.repositories import (
+    LOG,
+    current_commit_hash,
+    select_release_tag,
+    update_repository,
+)
+
+
+def git(*arguments, cwd):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *arguments],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+    )
+
+
+@fixture
+def upstream(tmp_path):
+    upstream = tmp_path / "upstream"
+    upstream.mkdir()
+    git("init", "--initial-branch=main", cwd=upstream)
+    for release in ("1.0", "1.1", "2.0"):
+        (upstream / "version.txt").write_text(release)
+        git("add", "version.txt", cwd=upstream)
+        git("commit", "-m", release, cwd=upstream)
+        git("tag", "-a", f"v{release}", "-m", release, cwd=upstream)
+    (upstream / "version.txt").write_text("unreleased")
+    git("commit", "-am", "unreleased", cwd=upstream)
+    return upstream
+
+
+def test_shallow_update_fetches_only_the_release_tag(tmp_path, upstream):
+    local = tmp_path / "local"
+    git("init", "--initial-branch=main", str(local), cwd=tmp_path)
+    git("remote", "add", "origin", f"file://{upstream}", cwd=local)
+
+    assert update_repository(local, LOG, release="1.1") == "v1.1"
+    assert (local / "version.txt").read_text() == "1.1"
+    local_tags = subprocess.check_output(["git", "tag"], cwd=local).decode("utf-8").split()
+    assert local_tags == ["v1.1"]
+    # Without truncating the history
+    assert not (local / ".git" / "shallow").exists()
+
+    # Updating again to the same release is a no-op checkout of the already fetched tag
+    commit_hash = current_commit_hash(local)
+    assert update_repository(local, LOG, release="1.1.0") == "v1.1"
+    assert current_commit_hash(local) == commit_hash
+
+
+def test_update_falls_back_to_full_fetch(tmp_path, upstream, monkeypatch):
+    def fail_to_list_remote_tags(repository_dir):
+        raise subprocess.CalledProcessError(128, ["git", "ls-remote"])
+
+    monkeypatch.setattr(repositories, "_list_remote_tags", fail_to_list_remote_tags)
+    git("clone", f"file://{upstream}", "local", cwd=tmp_path)
+    assert update_repository(tmp_path / "local", LOG, release="1.1") == "v1.1"
+    assert (tmp_path / "local" / "version.txt").read_text() == "1.1"
+
+
+def test_selecting_release_tag():
+    tags = ["v1.0", "v10.2", "v9.0", "v11.0rc1", "v11.1.dev0", "docs-fix", "latest"]
+    assert select_release_tag(tags) == "v10.2"
+    assert select_release_tag(tags, release="9.0") == "v9.0"
+    assert select_release_tag(tags, release="12.0") == "v10.2"
+    assert select_release_tag(tags, allow_prereleases=True) == "v11.1.dev0"
+    assert select_release_tag(["attrs-22.2.0", "attrs-23.1.0", "attrs-3.0"]) == "attrs-23.1.0"
+    assert select_release_tag(["latest"]) is None
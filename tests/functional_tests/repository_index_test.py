@@ -0,0 +1,35 @@
+"""This module tests the repository index against the pathlib globs it replaces"""
+from docset_builder.repository_index import build_repository_index
+
+
+def test_repository_index_matches_pathlib(tmp_path):
+    for relative_path in (
+        "requirements.txt",
+        "docs/requirements-docs.txt",
+        "docs/_static/favicon.png",
+        "requirements/tests.txt",
+        "src/package/__init__.py",
+        ".git/objects/requirements.txt",
+        ".tox/docs/requirements.txt",
+        "venv/pyvenv.cfg",
+        "venv/lib/requirements.txt",
+    ):
+        (tmp_path / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / relative_path).touch()
+
+    repository_index = build_repository_index(tmp_path)
+
+    def pruned(paths):
+        return {p for p in paths if not {".git", ".tox", "venv"} & set(p.parts)}
+
+    assert set(repository_index.rglob("*requirements*.txt")) == pruned(
+        tmp_path.rglob("*requirements*.txt")
+    )
+    assert set(repository_index.glob("*.txt", directory=tmp_path / "requirements")) == set(
+        (tmp_path / "requirements").glob("*.txt")
+    )
+    assert set(repository_index.directories) == pruned(tmp_path.rglob(""))
+    assert repository_index.with_name("favicon.png") == [tmp_path / "docs/_static/favicon.png"]
+    assert list(repository_index.rglob("*", start=tmp_path / "src")) == [
+        tmp_path / "src/package/__init__.py"
+    ]
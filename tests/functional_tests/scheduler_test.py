@@ -0,0 +1,70 @@
+"""This module tests running the per-package pipelines on the scheduler"""
+import threading
+import time
+
+from click import ClickException
+from pytest import raises
+
+from docset_builder.scheduler import (
+    make_stage_limits,
+    print_summary,
+    resolve_stage_limits,
+    run_pipelines,
+    stage,
+)
+
+PACKAGE_NAMES = ["attrs", "broken", "arrow", "unknown", "skipped", "rich"]
+
+
+def test_running_pipelines_with_failing_packages(capsys):
+    lock = threading.Lock()
+    in_build_stage = []
+    max_in_build_stage = 0
+
+    def pipeline(package_name, stage_limits):
+        nonlocal max_in_build_stage
+        # The first packages finish last, to check that the results keep the input order
+        time.sleep(0.01 * (len(PACKAGE_NAMES) - PACKAGE_NAMES.index(package_name)))
+        if package_name == "broken":
+            raise RuntimeError("Bug in the pipeline")
+        if package_name == "unknown":
+            raise ClickException("No such package")
+        if package_name == "skipped":
+            return "Already up to date"
+        with stage(stage_limits, "build"):
+            with lock:
+                in_build_stage.append(package_name)
+                max_in_build_stage = max(max_in_build_stage, len(in_build_stage))
+            time.sleep(0.01)
+            with lock:
+                in_build_stage.remove(package_name)
+        return None
+
+    stage_limits = make_stage_limits(jobs=4, stage_limit_overrides={"build": 1})
+    results = run_pipelines(PACKAGE_NAMES, pipeline, jobs=4, stage_limits=stage_limits)
+
+    # One failing package does not stop the others
+    assert [result.package_name for result in results] == PACKAGE_NAMES
+    assert [result.succeeded for result in results] == [True, False, True, False, True, True]
+    assert results[1].error == "RuntimeError: Bug in the pipeline"
+    assert results[3].error == "No such package"
+    assert results[4].note == "Already up to date"
+    assert all(result.duration > 0 for result in results)
+    assert max_in_build_stage == 1
+
+    print_summary(results)
+    summary = capsys.readouterr().out
+    assert summary.count("OK") == 4
+    assert summary.count("FAILED") == 2
+    assert "Already up to date" in summary
+
+
+def test_resolving_stage_limits():
+    # No stage limit exceeds the number of workers
+    assert set(resolve_stage_limits(jobs=1).values()) == {1}
+    stage_limits = resolve_stage_limits(jobs=4, stage_limit_overrides={"build": 3, "install": 0})
+    assert stage_limits["pypi"] == 4
+    assert stage_limits["build"] == 3
+    assert stage_limits["install"] == 1
+    with raises(ClickException, match="Unknown pipeline stage 'compile'"):
+        resolve_stage_limits(jobs=4, stage_limit_overrides={"compile": 2})
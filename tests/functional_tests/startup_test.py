@@ -0,0 +1,51 @@
+"""This module tests that the cli starts fast and without side effects"""
+import os
+import subprocess
+import sys
+
+# The cumulative import time of the cli module, in microseconds. It is around 100 ms, the budget
+# leaves room for slow machines, but not for importing the pipeline modules.
+IMPORT_TIME_BUDGET = 300_000
+# Modules that are slow to import and only needed once a command runs
+DEFERRED_MODULES = (
+    "structlog",
+    "rich",
+    "toml",
+    "urllib3",
+    "packaging",
+    "doc2dash",
+)
+
+
+def import_times(arguments, environment=None):
+    """Return the cumulative import times, by module, of running python with `arguments`"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *arguments],
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Lines are like: "import time:   self [us] | cumulative | imported package"
+    times = {}
+    for line in result.stderr.splitlines()[1:]:
+        _, cumulative, module = line.split("|")
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_import_time():
+    times = import_times(["-c", "import docset_builder.main"])
+    assert times["docset_builder.main"] < IMPORT_TIME_BUDGET
+    top_level_modules = {module.split(".")[0] for module in times}
+    assert not top_level_modules & set(DEFERRED_MODULES)
+    assert "docset_builder.core" not in times
+
+
+def test_cli_help_is_fast_and_creates_no_directories(tmp_path):
+    environment = dict(os.environ, XDG_DATA_HOME=str(tmp_path), XDG_CONFIG_HOME=str(tmp_path))
+    for arguments in (["--help"], ["install", "--help"], ["library", "uninstall", "--help"]):
+        times = import_times(["-m", "docset_builder.main", *arguments], environment)
+        top_level_modules = {module.split(".")[0] for module in times}
+        assert not top_level_modules & set(DEFERRED_MODULES), arguments
+    assert not list(tmp_path.iterdir())
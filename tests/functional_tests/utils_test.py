@@ -0,0 +1,86 @@
+"""This module tests extracting the commands for targets from makefiles"""
+from pytest import raises
+
+from docset_builder.utils import extract_sections_from_makefile
+
+MAKEFILE = """\
+SPHINXBUILD ?= sphinx-build
+SPHINXOPTS = -W \\
+\t--keep-going
+BUILDDIR := docs/_build
+include common.mk
+-include generated.mk
+
+.PHONY: docs docs-init clean
+
+docs-init: deps
+\t@pip install -e .
+
+deps: ; echo deps
+docs: docs-init $(BUILDDIR)/stamp | deps
+\t-$(SPHINXBUILD) $(SPHINXOPTS) -b html docs $(BUILDDIR)/html $(O)
+ifeq ($(SPHINXBUILD), sphinx-build)
+\techo default sphinx-build
+ifdef NOT_DEFINED
+\techo nested
+endif
+else ifdef SPHINXBUILD
+\techo custom sphinx-build
+else
+\techo no sphinx-build
+endif
+\techo $$HOME $@
+
+ifeq ($(OS),Windows)
+clean:
+\tdel
+else
+clean:
+\trm -rf $(BUILDDIR)
+endif
+
+define HELP
+docs: not a rule
+endef
+
+%.o: %.c
+\tcc $<
+loop: loop-back
+loop-back: loop
+\techo loop
+"""
+
+
+def test_extracting_sections_from_makefile(tmp_path):
+    (tmp_path / "Makefile").write_text(MAKEFILE)
+    (tmp_path / "common.mk").write_text("common: ; echo common\n")
+
+    sections = extract_sections_from_makefile(
+        tmp_path / "Makefile", targets=("docs-init", "docs", "html")
+    )
+
+    # Shared prerequisites run once and prerequisites that are files are skipped
+    assert sections == {
+        "docs-init": ["echo deps", "pip install -e ."],
+        "docs": [
+            "echo deps",
+            "pip install -e .",
+            # Undefined variables are empty and errors are ignored, like make does
+            "sphinx-build -W --keep-going -b html docs docs/_build/html  || true",
+            "echo default sphinx-build",
+            "echo $HOME docs",
+        ],
+    }
+
+    sections = extract_sections_from_makefile(tmp_path / "Makefile")
+    assert set(sections) == {"common", "deps", "docs-init", "docs", "clean", "loop", "loop-back"}
+    assert sections["loop"] == ["echo loop"]
+    assert sections["clean"] == ["rm -rf docs/_build"]
+
+
+def test_refusing_makefile_conditionals_that_cannot_be_evaluated(tmp_path):
+    (tmp_path / "Makefile").write_text(
+        "docs:\nifeq ($(shell uname),Darwin)\n\topen docs\nendif\n\tsphinx-build docs out\n"
+    )
+    with raises(ValueError, match="Unable to evaluate makefile conditional"):
+        extract_sections_from_makefile(tmp_path / "Makefile")
@@ -0,0 +1,217 @@
+"""This module tests the installer backends offline, against a local directory of wheels"""
+import shlex
+import shutil
+import subprocess
+import zipfile
+
+from pytest import mark, raises, skip
+
+from docset_builder import metadata_store, virtual_environments
+from docset_builder.virtual_environments import (
+    REQUIREMENTS_HASH_FILENAME,
+    _cmd_in_venv,
+    _install_requirements,
+    _layer_base_environment,
+    _pip_install_arguments,
+    _requirements_hash,
+    add_build_parallelism,
+    ensure_base_environment,
+    get_installer_backend,
+    redirect_build_output,
+    split_toolchain_requirements,
+)
+
+
+def make_wheel(wheel_dir, name, version, script_name=None):
+    """Write a minimal pure Python wheel for `name` to `wheel_dir`
+
+    If `script_name` is given, the wheel has a console script that prints `sys.prefix`.
+
+    """
+    dist_info = f"{name}-{version}.dist-info"
+    files = {
+        f"{name}/__init__.py": (
+            f"__version__ = '{version}'\n\ndef main():\n    import sys\n    print(sys.prefix)\n"
+        ),
+        f"{dist_info}/METADATA": f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n",
+        f"{dist_info}/WHEEL": "Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: py3-none-any\n",
+    }
+    if script_name:
+        files[f"{dist_info}/entry_points.txt"] = f"[console_scripts]\n{script_name} = {name}:main\n"
+    files[f"{dist_info}/RECORD"] = (
+        "".join(f"{path},,\n" for path in files) + f"{dist_info}/RECORD,,\n"
+    )
+    with zipfile.ZipFile(wheel_dir / f"{name}-{version}-py3-none-any.whl", "w") as wheel:
+        for path, content in files.items():
+            wheel.writestr(path, content)
+
+
+def installed_version(venv_dir):
+    version = subprocess.check_output(
+        [venv_dir / "bin" / "python", "-c", "import docset_dummy; print(docset_dummy.__version__)"]
+    )
+    return version.decode("utf-8").strip()
+
+
+@mark.parametrize("installer_name", ["pip", "uv"])
+def test_installing_from_local_wheels(tmp_path, monkeypatch, installer_name):
+    if installer_name == "uv" and shutil.which("uv") is None:
+        skip("uv is not installed")
+    monkeypatch.setattr(metadata_store, "METADATA_STORE_PATH", tmp_path / "metadata.sqlite")
+    wheel_dir = tmp_path / "wheels"
+    wheel_dir.mkdir()
+    make_wheel(wheel_dir, "docset_dummy", "1.0")
+    requirements_path = tmp_path / "requirements.txt"
+    requirements_path.write_text("docset_dummy==1.0\n")
+
+    installer = get_installer_backend(
+        installer_name, find_links=[wheel_dir], cache_dir=tmp_path / "cache"
+    )
+    venv_dir = tmp_path / "venv"
+    installer.create_venv(venv_dir)
+    requirements = ["--no-index", "-r requirements.txt"]
+    _install_requirements(installer, venv_dir, requirements, local_repository=tmp_path)
+
+    assert installed_version(venv_dir) == "1.0"
+    requirements_hash = (venv_dir / REQUIREMENTS_HASH_FILENAME).read_text()
+
+    # A change to a requirements file changes the hash and the requirements are installed again
+    make_wheel(wheel_dir, "docset_dummy", "2.0")
+    requirements_path.write_text("docset_dummy==2.0\n")
+    _install_requirements(installer, venv_dir, requirements, local_repository=tmp_path)
+    assert (venv_dir / REQUIREMENTS_HASH_FILENAME).read_text() != requirements_hash
+    assert installed_version(venv_dir) == "2.0"
+
+    # Each install got the one package from the wheel directory (pip) or prepared it (uv)
+    statistics = metadata_store.load_package_cache_statistics()[installer_name]
+    assert statistics.hits + statistics.misses == 2
+
+
+def test_layering_base_environment(tmp_path, monkeypatch):
+    monkeypatch.setattr(metadata_store, "METADATA_STORE_PATH", tmp_path / "metadata.sqlite")
+    monkeypatch.setattr(virtual_environments, "BASE_VENV_DIR", tmp_path)
+    wheel_dir = tmp_path / "wheels"
+    wheel_dir.mkdir()
+    make_wheel(wheel_dir, "sphinx_dummy_theme", "1.0", script_name="sphinx-dummy")
+    make_wheel(wheel_dir, "docset_dummy", "1.0")
+
+    toolchain, others = split_toolchain_requirements(
+        ["Sphinx_Dummy_Theme>=1.0", "docset_dummy", "-r requirements.txt", "sphinx @ file:///x"]
+    )
+    assert toolchain == ["Sphinx_Dummy_Theme>=1.0"]
+    assert others == ["docset_dummy", "-r requirements.txt", "sphinx @ file:///x"]
+
+    installer = get_installer_backend("pip", find_links=[wheel_dir], cache_dir=None)
+    base_venv_dir = ensure_base_environment(installer, ["--no-index", "sphinx_dummy_theme"])
+    venv_dir = tmp_path / "venv"
+    installer.create_venv(venv_dir)
+    _layer_base_environment(venv_dir, base_venv_dir)
+    _install_requirements(installer, venv_dir, ["--no-index", "docset_dummy"], tmp_path)
+
+    # The base environment script runs with the interpreter of the package venv, which sees both
+    # the base environment packages and its own
+    prefix = subprocess.check_output([venv_dir / "bin" / "sphinx-dummy"])
+    assert prefix.decode("utf-8").strip() == str(venv_dir)
+    subprocess.check_call(
+        [venv_dir / "bin" / "python", "-c", "import sphinx_dummy_theme, docset_dummy"]
+    )
+    assert not list(base_venv_dir.glob("lib/python*/site-packages/docset_dummy"))
+
+
+def test_running_commands_in_venv_without_activating_it(tmp_path):
+    venv_dir = tmp_path / "venv"
+    (venv_dir / "bin").mkdir(parents=True)
+    script = venv_dir / "bin" / "where-am-i"
+    script.write_text('#!/bin/sh\necho "$VIRTUAL_ENV" "$1"\n')
+    script.chmod(0o755)
+    output_path = tmp_path / "output.txt"
+
+    # Plain commands are run directly, the redirection needs a shell
+    _cmd_in_venv(venv_dir, f"where-am-i 'with space' > {output_path}")
+    assert output_path.read_text() == f"{venv_dir} with space\n"
+    _cmd_in_venv(venv_dir, "where-am-i", working_dir=tmp_path)
+
+    with raises(subprocess.CalledProcessError) as exception_info:
+        _cmd_in_venv(venv_dir, "where-am-i failing && false")
+    assert exception_info.value.output == f"{venv_dir} failing"
+
+
+def test_adding_build_parallelism():
+    assert add_build_parallelism("make html", "4") == "make html 'O=-j 4'"
+    assert add_build_parallelism("make html SPHINXOPTS=-W", "4") == (
+        "make html SPHINXOPTS=-W 'O=-j 4'"
+    )
+    assert add_build_parallelism("make html O=-v", "4") == "make html O=-v"
+    assert add_build_parallelism("sphinx-build docs out", "4") == "sphinx-build -j 4 docs out"
+    # In make-mode, -M and its arguments must come first
+    assert add_build_parallelism("sphinx-build -M html docs build -W", "4") == (
+        "sphinx-build -M html docs build -j 4 -W"
+    )
+    assert add_build_parallelism("python -m sphinx -M html docs build", "4") == (
+        "python -m sphinx -M html docs build -j 4"
+    )
+    assert add_build_parallelism("spin docs", "4") == "spin docs --jobs 4"
+    assert add_build_parallelism("tox -e docs -- -j {build_jobs}", None) == "tox -e docs -- -j 1"
+    assert add_build_parallelism("cd docs && make html", "4") == "cd docs && make html"
+    assert add_build_parallelism("make html", None) == "make html"
+
+
+def test_adding_build_parallelism_keeps_makefile_sphinxopts(tmp_path):
+    (tmp_path / "Makefile").write_text(
+        "SPHINXOPTS ?= -W --keep-going -n\n"
+        "html:\n"
+        "\t@echo sphinx-build -M html docs build $(SPHINXOPTS) $(O)\n"
+    )
+    command = add_build_parallelism("make html", "4")
+    output = subprocess.check_output(shlex.split(command), cwd=tmp_path, text=True)
+    assert output == "sphinx-build -M html docs build -W --keep-going -n -j 4\n"
+
+
+def test_pip_install_arguments():
+    requirements = [
+        "-r docs/requirements.txt",
+        "-cconstraints.txt",
+        "--requirement=more.txt",
+        "--editable .",
+        "--index-url https://example.org/simple",
+        "sphinx>=5",
+    ]
+    assert list(_pip_install_arguments(requirements)) == [
+        *("-r", "docs/requirements.txt", "-c", "constraints.txt", "-r", "more.txt", "-e", "."),
+        *("--index-url", "https://example.org/simple", "sphinx>=5"),
+    ]
+
+
+def test_requirements_hash_with_cyclic_includes(tmp_path):
+    (tmp_path / "a.txt").write_text("sphinx\n-r a.txt\n--requirement b.txt\n")
+    (tmp_path / "b.txt").write_text("-r a.txt\n")
+    arguments = list(_pip_install_arguments(["-r a.txt"]))
+    first_hash = _requirements_hash(arguments, tmp_path)
+
+    (tmp_path / "b.txt").write_text("-r a.txt\nfuro\n")
+    assert _requirements_hash(arguments, tmp_path) != first_hash
+
+
+def test_redirecting_build_output(tmp_path):
+    assert redirect_build_output("make html", tmp_path) == f"make html BUILDDIR={tmp_path}"
+    assert redirect_build_output("make html BUILDDIR=out", tmp_path) == "make html BUILDDIR=out"
+    assert redirect_build_output("sphinx-build -b html -j 4 docs out index", tmp_path) == (
+        f"sphinx-build -d {tmp_path}/doctrees -b html -j 4 docs {tmp_path}/html index"
+    )
+    assert redirect_build_output("sphinx-build -b latex docs out", tmp_path) == (
+        "sphinx-build -b latex docs out"
+    )
+    assert redirect_build_output("sphinx-build -b dirhtml docs out", tmp_path) == (
+        "sphinx-build -b dirhtml docs out"
+    )
+    # In make-mode, the build directory gets the output in html and the doctrees
+    assert redirect_build_output("sphinx-build -M html docs docs/_build -W", tmp_path) == (
+        f"sphinx-build -M html docs {tmp_path} -W"
+    )
+    assert redirect_build_output("python -m sphinx -M html docs build", tmp_path) == (
+        f"python -m sphinx -M html docs {tmp_path}"
+    )
+    assert redirect_build_output("sphinx-build -M latexpdf docs build", tmp_path) == (
+        "sphinx-build -M latexpdf docs build"
+    )
+    assert redirect_build_output("spin docs", tmp_path) == "spin docs"